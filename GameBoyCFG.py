@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# headless whole-ROM CFG recovery, main export:
+# recover_cfg()
+#
+# every 16 KB bank is analyzed by recursive descent in a ProcessPoolExecutor
+# worker, using the same branch semantics as get_instruction_info()
+# (LR35902Flow.walk_blocks()), jump tables and inline rst arguments included.
+# The workers' functions are merged into one function list and call graph:
+#
+#   python -m LR35902.GameBoyCFG game.gbc -o game.cfg.json
+#   python -m LR35902.GameBoyCFG --jobs 8 --seed 3:0x4000 game.gbc
+#
+# analysis starts at START_ADDR and the INTERRUPT_HANDLERS vectors in bank 0
+# and runs in rounds: calls from one bank into another seed the target bank
+# in the next round. Far calls resolved by the bank switch index
+# (GameBoyMBC) seed the bank they go to. Other calls from bank 0 into
+# 0x4000-0x7FFF could go to any switchable bank; with --speculative they
+# seed every bank, and a speculative function is only kept if all of its
+# code decodes and stays in the bank. The ROM's rst conventions are found
+# once, the far calls of a bank the first time it's analyzed.
+
+import os
+import sys
+import json
+import mmap
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from .GameBoyROM import START_ADDR, INTERRUPT_HANDLERS, BANK_SIZE, ROM1_OFFSET, HDR_OFFSET, bank_count, bank_base
+from .GameBoyMBC import Trampolines, sweep_bank_switches, mbc_type
+from .LR35902Flow import NO_RST_CONVENTIONS, walk_blocks, rst_conventions
+
+#------------------------------------------------------------------------------
+# BANK ADDRESSING
+#------------------------------------------------------------------------------
+
+def target_bank(bank, target, banks):
+    """ bank an address referenced from code in `bank` lives in, None if
+        that isn't known statically (or the target isn't ROM) """
+    if target < ROM1_OFFSET:
+        return 0
+    if target < ROM1_OFFSET + BANK_SIZE:
+        if bank != 0:
+            return bank
+        # no MBC, bank 1 is always mapped
+        if banks == 2:
+            return 1
+    return None
+
+def is_switchable(addr):
+    return ROM1_OFFSET <= addr < ROM1_OFFSET + BANK_SIZE
+
+#------------------------------------------------------------------------------
+# RECURSIVE DESCENT (runs in the workers)
+#------------------------------------------------------------------------------
+
+def explore(data, base, start, rst=NO_RST_CONVENTIONS, far_calls=None):
+    """ recursive descent of the function at start over one bank's bytes,
+        rst being the ROM's rst_conventions() and far_calls {addr: (bank,
+        target)} the bank's resolved far calls
+
+        returns a dict of its blocks ([start, end) pairs), call targets,
+        far calls ([bank, target] pairs), exits (jump targets and
+        fall-throughs outside of the bank), jump tables ([addr, targets]
+        pairs) and whether all of its code decoded """
+    walk = walk_blocks(data, base, start, rst)
+    blocks = [[block_start, block_end] for block_start, block_end, _ in walk['blocks']]
+    calls = []
+    far = []
+    for addr, target in walk['calls']:
+        if far_calls and addr in far_calls:
+            far.append(list(far_calls[addr]))
+            # a trampoline is a callee of its own
+            if target >= ROM1_OFFSET:
+                continue
+        calls.append(target)
+    return {
+        'blocks': blocks,
+        'size': sum(block_end - block_start for block_start, block_end in blocks),
+        'calls': calls,
+        'far_calls': far,
+        'exits': walk['exits'],
+        'jump_tables': sorted([addr, targets] for addr, targets in walk['jump_tables'].items()),
+        'valid': walk['valid'],
+    }
+
+def bank_far_calls(rom, bank):
+    """ {addr: (bank, target)} of the far calls of a bank the bank switch
+        index resolves """
+    _, far_calls = sweep_bank_switches(rom, bank, Trampolines(rom[:BANK_SIZE]), mbc_type(rom))
+    return {addr: (target_bank, target) for addr, target_bank, target in far_calls}
+
+def analyze_bank(path, bank, banks, seeds, known, rst=None, far_calls=None):
+    """ worker entry: explores the (addr, speculative) seeds of a bank and
+        every function they call within it, skipping the addresses in known.
+        rst is the ROM's rst_conventions() and far_calls the bank's
+        bank_far_calls(), found here if None
+
+        returns (bank, {addr: function}, far_calls) """
+    with open(path, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as rom:
+            data = rom[bank*BANK_SIZE:(bank+1)*BANK_SIZE]
+            if rst is None:
+                rst = rst_conventions(rom[:BANK_SIZE])
+            if far_calls is None:
+                far_calls = bank_far_calls(rom, bank)
+
+    base = bank_base(bank)
+    functions = {}
+    worklist = list(seeds)
+    while worklist:
+        addr, speculative = worklist.pop()
+        if addr in functions or addr in known:
+            continue
+        if not base <= addr < base + len(data):
+            continue
+
+        func = explore(data, base, addr, rst, far_calls)
+        if speculative and (not func['valid'] or func['exits']):
+            continue
+        func['speculative'] = speculative
+        functions[addr] = func
+
+        for target in func['calls']:
+            if target_bank(bank, target, banks) == bank:
+                worklist.append((target, speculative))
+
+    return bank, functions, far_calls
+
+#------------------------------------------------------------------------------
+# MERGING
+#------------------------------------------------------------------------------
+
+def rom_bank_count(path):
+    with open(path, 'rb') as fp:
+        length = os.fstat(fp.fileno()).st_size
+        fp.seek(HDR_OFFSET + 20)
+        size_code = fp.read(1)
+    return bank_count(length, size_code[0] if size_code else None)
+
+def recover_cfg(path, jobs=None, seeds=(), speculative=False):
+    """ recovers the functions of every bank of the ROM at path, speculative
+        seeding every switchable bank with the calls out of bank 0 whose
+        bank isn't known
+
+        returns ({(bank, addr): function}, call graph as a list of
+        ((bank, addr), (bank or None, addr)) edges) """
+    banks = rom_bank_count(path)
+
+    functions = {}
+    pending = {0: [(START_ADDR, False)] + [(addr, False) for _, addr in INTERRUPT_HANDLERS]}
+    for bank, addr in seeds:
+        pending.setdefault(bank, []).append((addr, False))
+    far_seeded = set()
+    with open(path, 'rb') as fp:
+        rst = rst_conventions(fp.read(BANK_SIZE))
+    # bank -> bank_far_calls(), once a worker found them
+    far_calls = {}
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while pending:
+            futures = []
+            for bank, bank_seeds in pending.items():
+                if not 0 <= bank < banks:
+                    continue
+                known = frozenset(addr for (b, addr) in functions if b == bank)
+                futures.append(pool.submit(analyze_bank, path, bank, banks, bank_seeds, known, rst, far_calls.get(bank)))
+
+            pending = {}
+            for future in futures:
+                bank, found, far_calls[bank] = future.result()
+                for addr, func in found.items():
+                    if (bank, addr) in functions:
+                        continue
+                    functions[(bank, addr)] = func
+
+                    for tbank, target in func['far_calls']:
+                        if tbank < banks and (tbank, target) not in functions:
+                            pending.setdefault(tbank, []).append((target, False))
+                    for target in func['calls'] + func['exits']:
+                        tbank = target_bank(bank, target, banks)
+                        if tbank is None and is_switchable(target):
+                            if not speculative:
+                                continue
+                            # far call out of bank 0, could be any bank
+                            if target not in far_seeded:
+                                far_seeded.add(target)
+                                for b in range(1, banks):
+                                    pending.setdefault(b, []).append((target, True))
+                        elif tbank is not None and tbank != bank and (tbank, target) not in functions:
+                            pending.setdefault(tbank, []).append((target, False))
+
+    call_graph = []
+    for (bank, addr), func in sorted(functions.items()):
+        for target in func['calls']:
+            call_graph.append(((bank, addr), (target_bank(bank, target, banks), target)))
+        for tbank, target in func['far_calls']:
+            call_graph.append(((bank, addr), (tbank, target)))
+
+    return functions, call_graph
+
+#------------------------------------------------------------------------------
+# MAIN
+#------------------------------------------------------------------------------
+
+def parse_seed(s):
+    bank, addr = s.split(':')
+    return int(bank, 0), int(addr, 0)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='GameBoyCFG', description='recover the CFG of a whole GameBoy ROM')
+    parser.add_argument('rom', help='.gb/.gbc file')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--seed', type=parse_seed, action='append', default=[],
+                        metavar='BANK:ADDR', help='additional function start (repeatable)')
+    parser.add_argument('--speculative', action='store_true',
+                        help='look for the targets of unresolved far calls in every switchable bank')
+    parser.add_argument('-o', '--output', help='write the functions and call graph as JSON')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    functions, call_graph = recover_cfg(args.rom, args.jobs, args.seed, args.speculative)
+    elapsed = time.perf_counter() - start
+
+    sys.stderr.write('%s: %d functions, %d call edges in %.2fs\n' % (
+        args.rom, len(functions), len(call_graph), elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'rom': args.rom,
+                'functions': [
+                    dict(bank=bank, addr=addr, **func)
+                    for (bank, addr), func in sorted(functions.items())
+                ],
+                'call_graph': call_graph,
+            }, fp)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,690 @@
+#!/usr/bin/env python
+#
+# table-driven LR35902 emulator for dynamic tracing, main exports:
+# Emulator
+# TraceStop
+#
+# one handler per opcode, generated from the decoder's tables (OPCODE_OP,
+# OPCODE_OPERANDS, OPCODE_LEN) as Python source and compiled once. A handler
+# takes (pc, regs, mem) and returns the next pc. RAM runs through them an
+# instruction at a time; ROM runs as blocks, the handler bodies of a run of
+# instructions inlined into one function compiled the first time it's
+# reached, so the run loop is only:
+#
+#   while regs[R_CYCLES] < stop: pc = blocks[pc](pc, regs, mem)
+#
+# regs is a list (B C D E H L F A SP, cycles, IME, instructions), mem a
+# bytearray of the whole address space laid out from RAM_SEGMENTS with ROM0
+# and the mapped bank copied in; MBC writes copy another bank in
+# (GameBoyMBC's bank register ranges). The hardware is modelled only as far
+# as tracing code needs it:
+#
+#   LY, STAT, DIV   advance on every read, so polling loops end
+#   joypad          no button pressed
+#   interrupts      vblank (LCD on) and timer (TAC enabled) once a frame,
+#                   halt waits for the end of the frame
+#   cartridge RAM   one bank, never disabled
+#
+# what's recorded: executed addresses (a flag per address per ROM bank) and
+# the targets of jp hl (three parallel arrays), no Binary Ninja needed.
+
+import re
+import functools
+from array import array
+
+from lr35902dis.lr35902 import OP, OPER_TYPE, REG, CC
+
+from .GameBoyROM import BANK_SIZE, ROM1_OFFSET, START_ADDR, RAM_SEGMENTS, bank_base, bank_count
+from .GameBoyMBC import is_bank_register, mbc_type, select_bank
+from .LR35902Decoder import OPCODE_COUNT, OPCODE_LEN, OPCODE_OP, OPCODE_OPERANDS
+from .LR35902Decoder import SRC_FIXED, SRC_IMM8, SRC_SIMM8, SRC_IMM16
+
+SEGMENTS = dict((name, (address, length)) for name, address, length in RAM_SEGMENTS)
+VRAM_START = SEGMENTS['VRAM'][0]
+ECHO_START, ECHO_LENGTH = SEGMENTS['ECHO']
+ECHO_OFFSET = ECHO_START - SEGMENTS['RAM0'][0]
+IO_START = SEGMENTS['IO'][0]
+HRAM_START = SEGMENTS['HRAM'][0]
+
+VOID_START = SEGMENTS['VOID'][0]
+
+# pc pushed when tracing a function, its return ends the trace. Unusable
+# memory, holding an illegal opcode.
+RETURN_TRAP = VOID_START
+ILLEGAL_OPCODE = 0xD3
+
+# IO registers
+JOYP = 0xFF00
+DIV = 0xFF04
+TAC = 0xFF07
+IF = 0xFF0F
+LCDC = 0xFF40
+STAT = 0xFF41
+LY = 0xFF44
+IE = 0xFFFF
+
+# DMG state after the boot ROM
+POST_BOOT_REGS = (0x00, 0x13, 0x00, 0xD8, 0x01, 0x4D, 0xB0, 0x01, 0xFFFE)
+POST_BOOT_IO = {JOYP: 0xCF, LCDC: 0x91, STAT: 0x85, 0xFF47: 0xFC, 0xFF48: 0xFF, 0xFF49: 0xFF}
+
+# cycles (T-states) per second and per frame, LY lines
+CPU_HZ = 4194304
+FRAME_CYCLES = 70224
+LINES = 154
+
+# cycles by opcode, branches not taken, 0xCB's are in CB_CYCLES
+CYCLES = array('H', [
+    4,12, 8, 8, 4, 4, 8, 4,20, 8, 8, 8, 4, 4, 8, 4,
+    4,12, 8, 8, 4, 4, 8, 4,12, 8, 8, 8, 4, 4, 8, 4,
+    8,12, 8, 8, 4, 4, 8, 4, 8, 8, 8, 8, 4, 4, 8, 4,
+    8,12, 8, 8,12,12,12, 4, 8, 8, 8, 8, 4, 4, 8, 4,
+    4, 4, 4, 4, 4, 4, 8, 4, 4, 4, 4, 4, 4, 4, 8, 4,
+    4, 4, 4, 4, 4, 4, 8, 4, 4, 4, 4, 4, 4, 4, 8, 4,
+    4, 4, 4, 4, 4, 4, 8, 4, 4, 4, 4, 4, 4, 4, 8, 4,
+    8, 8, 8, 8, 8, 8, 4, 8, 4, 4, 4, 4, 4, 4, 8, 4,
+    4, 4, 4, 4, 4, 4, 8, 4, 4, 4, 4, 4, 4, 4, 8, 4,
+    4, 4, 4, 4, 4, 4, 8, 4, 4, 4, 4, 4, 4, 4, 8, 4,
+    4, 4, 4, 4, 4, 4, 8, 4, 4, 4, 4, 4, 4, 4, 8, 4,
+    4, 4, 4, 4, 4, 4, 8, 4, 4, 4, 4, 4, 4, 4, 8, 4,
+    8,12,12,16,12,16, 8,16, 8,16,12, 0,12,24, 8,16,
+    8,12,12, 4,12,16, 8,16, 8,16,12, 4,12, 4, 8,16,
+   12,12, 8, 4, 4,16, 8,16,16, 4,16, 4, 4, 4, 8,16,
+   12,12, 8, 4, 4,16, 8,16,12, 8,16, 4, 4, 4, 8,16,
+])
+CB_CYCLES = array('H', [
+    (12 if opcode >> 6 == 1 else 16) if opcode & 7 == 6 else 8 for opcode in range(256)
+])
+
+# extra cycles of a taken conditional branch
+TAKEN_CYCLES = {OP.JR: 4, OP.JP: 4, OP.CALL: 12, OP.RET: 12}
+
+# indices into the register list
+R8 = {REG.B: 0, REG.C: 1, REG.D: 2, REG.E: 3, REG.H: 4, REG.L: 5, REG.F: 6, REG.A: 7}
+PAIRS = {REG.BC: (0, 1), REG.DE: (2, 3), REG.HL: (4, 5), REG.AF: (7, 6)}
+R_F, R_A, R_SP, R_CYCLES, R_IME, R_COUNT = 6, 7, 8, 9, 10, 11
+
+# F of an 8-bit result: z
+ZERO = bytes(0x80 if value == 0 else 0 for value in range(256))
+
+class TraceStop(Exception):
+    """ execution can't go on: an illegal opcode, or the traced function
+        returned """
+
+class Halt(Exception):
+    """ raised by halt at pc """
+    def __init__(self, pc):
+        Exception.__init__(self, pc)
+        self.pc = pc
+
+class IllegalOpcode(Halt):
+    pass
+
+#------------------------------------------------------------------------------
+# HANDLER GENERATION
+#------------------------------------------------------------------------------
+
+# reads and writes of the address in variable ad: the fast path is a plain
+# index of mem, rd()/wr() handle ROM (MBC registers), echo RAM, OAM and the
+# IO registers that move on their own
+def read(ad):
+    return '(m[{0}] if {0} < 0x{1:X} or {0} >= 0x{2:X} else rd({0}))'.format(ad, ECHO_START, HRAM_START)
+
+def read_high(ad):
+    """ read of 0xFF00-0xFFFF """
+    return '(m[{0}] if {0} >= 0x{1:X} else rd({0}))'.format(ad, HRAM_START)
+
+def write(ad, value):
+    return ['if 0x{1:X} <= {0} < 0x{2:X} or {0} >= 0x{3:X}: m[{0}] = {4}'.format(ad, VRAM_START, ECHO_START, IO_START, value),
+            'else: wr({0}, {1})'.format(ad, value)]
+
+def get16(reg):
+    if reg == REG.SP:
+        return 'r[%d]' % R_SP
+    high, low = PAIRS[reg]
+    return '(r[%d] << 8 | r[%d])' % (high, low)
+
+def set16(reg, value):
+    """ value being 16 bits """
+    if reg == REG.SP:
+        return ['r[%d] = %s' % (R_SP, value)]
+    high, low = PAIRS[reg]
+    return ['w = %s' % value, 'r[%d] = w >> 8' % high, 'r[%d] = w & 0x%X' % (low, 0xF0 if reg == REG.AF else 0xFF)]
+
+def immediate(src, value):
+    if src == SRC_FIXED:
+        return str(value)
+    if src == SRC_IMM8:
+        return 'm[pc + 1]'
+    if src == SRC_SIMM8:
+        return '(m[pc + 1] ^ 0x80) - 0x80'
+    if src == SRC_IMM16:
+        return '(m[pc + 1] | m[pc + 2] << 8)'
+    raise ValueError('no immediate of source %d' % src)
+
+class Operand(object):
+    """ code of an 8-bit operand: setup lines (its address into ad), the
+        expression loading it, the lines storing {value} and the lines
+        after the instruction (hl+/-) """
+
+    def __init__(self, oper):
+        oper_type, src, value = oper
+        self.setup = []
+        self.post = []
+        self.reg = None
+        if oper_type == OPER_TYPE.REG:
+            self.reg = R8[value]
+            self.load = 'r[%d]' % self.reg
+        elif oper_type == OPER_TYPE.IMM:
+            self.load = immediate(src, value)
+        elif oper_type in (OPER_TYPE.REG_DEREF, OPER_TYPE.REG_DEREF_INC, OPER_TYPE.REG_DEREF_DEC):
+            self.setup = ['ad = %s' % get16(value)]
+            self.load = read('ad')
+            if oper_type != OPER_TYPE.REG_DEREF:
+                self.post = set16(REG.HL, '(ad %s 1) & 0xFFFF' % ('+' if oper_type == OPER_TYPE.REG_DEREF_INC else '-'))
+        elif oper_type in (OPER_TYPE.REG_DEREF_FF00, OPER_TYPE.ADDR_DEREF_FF00):
+            offset = 'r[%d]' % R8[value] if oper_type == OPER_TYPE.REG_DEREF_FF00 else 'm[pc + 1]'
+            self.setup = ['ad = 0xFF00 | %s' % offset]
+            self.load = read_high('ad')
+        elif oper_type == OPER_TYPE.ADDR_DEREF:
+            self.setup = ['ad = m[pc + 1] | m[pc + 2] << 8']
+            self.load = read('ad')
+        else:
+            raise ValueError('no 8-bit operand %s' % oper_type.name)
+        self.oper_type = oper_type
+
+    def store(self, value):
+        if self.reg is not None:
+            return ['r[%d] = %s' % (self.reg, value)]
+        if self.oper_type in (OPER_TYPE.REG_DEREF_FF00, OPER_TYPE.ADDR_DEREF_FF00):
+            # IO and HRAM, the IO registers are plain memory to writes
+            return ['m[ad] = %s' % value]
+        return write('ad', value)
+
+def is16(oper):
+    oper_type, _, value = oper
+    return oper_type == OPER_TYPE.REG and (value in PAIRS or value == REG.SP)
+
+def condition(cc):
+    return {
+        CC.Z: 'r[6] & 0x80',
+        CC.NOT_Z: 'not r[6] & 0x80',
+        CC.C: 'r[6] & 0x10',
+        CC.NOT_C: 'not r[6] & 0x10',
+    }[cc]
+
+def push(value):
+    return ['sp = (r[8] - 2) & 0xFFFF', 'r[8] = sp', 'v = %s' % value] + \
+        write('sp', 'v & 0xFF') + ['sp = (sp + 1) & 0xFFFF'] + write('sp', 'v >> 8')
+
+def pop(var):
+    return ['sp = r[8]', 'sp1 = (sp + 1) & 0xFFFF', 'r[8] = (sp + 2) & 0xFFFF',
+            '%s = %s | %s << 8' % (var, read('sp'), read('sp1'))]
+
+# flags of 8-bit results x from a and v: h is bit 4 of a ^ v ^ x, c bit 8 of x
+ALU = {
+    OP.ADD: ['x = a + v', 'r[7] = x & 0xFF', 'r[6] = ZERO[x & 0xFF] | (a ^ v ^ x) << 1 & 0x20 | x >> 4 & 0x10'],
+    OP.ADC: ['x = a + v + (r[6] >> 4 & 1)', 'r[7] = x & 0xFF', 'r[6] = ZERO[x & 0xFF] | (a ^ v ^ x) << 1 & 0x20 | x >> 4 & 0x10'],
+    OP.SUB: ['x = a - v', 'r[7] = x & 0xFF', 'r[6] = ZERO[x & 0xFF] | 0x40 | (a ^ v ^ x) << 1 & 0x20 | x >> 4 & 0x10'],
+    OP.SBC: ['x = a - v - (r[6] >> 4 & 1)', 'r[7] = x & 0xFF', 'r[6] = ZERO[x & 0xFF] | 0x40 | (a ^ v ^ x) << 1 & 0x20 | x >> 4 & 0x10'],
+    OP.CP: ['x = a - v', 'r[6] = ZERO[x & 0xFF] | 0x40 | (a ^ v ^ x) << 1 & 0x20 | x >> 4 & 0x10'],
+    OP.AND: ['x = a & v', 'r[7] = x', 'r[6] = ZERO[x] | 0x20'],
+    OP.XOR: ['x = a ^ v', 'r[7] = x', 'r[6] = ZERO[x]'],
+    OP.OR: ['x = a | v', 'r[7] = x', 'r[6] = ZERO[x]'],
+}
+
+# rotates and shifts of v into x, c being the bit shifted out
+SHIFTS = {
+    OP.RLC: ['c = v >> 7', 'x = (v << 1 | c) & 0xFF'],
+    OP.RRC: ['c = v & 1', 'x = v >> 1 | c << 7'],
+    OP.RL: ['c = v >> 7', 'x = (v << 1 | r[6] >> 4 & 1) & 0xFF'],
+    OP.RR: ['c = v & 1', 'x = v >> 1 | (r[6] & 0x10) << 3'],
+    OP.SLA: ['c = v >> 7', 'x = v << 1 & 0xFF'],
+    OP.SRA: ['c = v & 1', 'x = v >> 1 | v & 0x80'],
+    OP.SRL: ['c = v & 1', 'x = v >> 1'],
+    OP.SWAP: ['c = 0', 'x = (v << 4 | v >> 4) & 0xFF'],
+}
+ACCUMULATOR_SHIFTS = {OP.RLCA: OP.RLC, OP.RRCA: OP.RRC, OP.RLA: OP.RL, OP.RRA: OP.RR}
+
+def gen_body(opcode):
+    """ lines of the handler of opcode, ending in a return of the next pc """
+    op = OPCODE_OP[opcode]
+    layout = OPCODE_OPERANDS[opcode]
+    nxt = '(pc + %d) & 0xFFFF' % OPCODE_LEN[opcode]
+    ret = ['return ' + nxt]
+
+    if opcode == 0xCB:
+        return ['op = m[pc + 1]', 'r[%d] += CB_CYCLES[op]' % R_CYCLES, 'return CB[op](pc, r, m)']
+    if op is None:
+        return ['raise IllegalOpcode(pc)']
+
+    if op in (OP.LD, OP.LDI, OP.LDD):
+        dst, src = layout
+        if src[0] == OPER_TYPE.SP_OFFSET:
+            # ld hl,sp+e: h and c of the low byte's unsigned add
+            return ['e = %s' % immediate(src[1], src[2]), 'sp = r[8]', 'u = (sp & 0xFF) + (e & 0xFF)',
+                'r[6] = ((sp & 0xF) + (e & 0xF)) << 1 & 0x20 | u >> 4 & 0x10'] + set16(REG.HL, '(sp + e) & 0xFFFF') + ret
+        if dst[0] == OPER_TYPE.ADDR_DEREF and is16(src):
+            # ld (nn),sp
+            return ['ad = m[pc + 1] | m[pc + 2] << 8', 'v = r[8]'] + write('ad', 'v & 0xFF') + \
+                ['ad = (ad + 1) & 0xFFFF'] + write('ad', 'v >> 8') + ret
+        if is16(dst):
+            value = get16(src[2]) if is16(src) else immediate(src[1], src[2])
+            return set16(dst[2], value) + ret
+        source, dest = Operand(src), Operand(dst)
+        return source.setup + ['v = ' + source.load] + dest.setup + dest.store('v') + source.post + dest.post + ret
+
+    if op in ALU:
+        if op == OP.ADD and is16(layout[0]):
+            if layout[1][0] == OPER_TYPE.IMM:
+                # add sp,e
+                return ['e = %s' % immediate(layout[1][1], layout[1][2]), 'sp = r[8]', 'u = (sp & 0xFF) + (e & 0xFF)',
+                    'r[6] = ((sp & 0xF) + (e & 0xF)) << 1 & 0x20 | u >> 4 & 0x10', 'r[8] = (sp + e) & 0xFFFF'] + ret
+            # add hl,rr: z kept, h and c out of bits 11 and 15
+            return ['a = %s' % get16(REG.HL), 'v = %s' % get16(layout[1][2]), 'x = a + v',
+                'r[6] = r[6] & 0x80 | (a ^ v ^ x) >> 7 & 0x20 | x >> 12 & 0x10'] + set16(REG.HL, 'x & 0xFFFF') + ret
+        source = Operand(layout[-1])
+        return source.setup + ['v = ' + source.load, 'a = r[7]'] + ALU[op] + ret
+
+    if op in (OP.INC, OP.DEC):
+        if is16(layout[0]):
+            return set16(layout[0][2], '(%s %s 1) & 0xFFFF' % (get16(layout[0][2]), '+' if op == OP.INC else '-')) + ret
+        operand = Operand(layout[0])
+        if op == OP.INC:
+            flags = ['r[6] = ZERO[x] | (0 if x & 0xF else 0x20) | r[6] & 0x10']
+        else:
+            flags = ['r[6] = ZERO[x] | 0x40 | (0x20 if x & 0xF == 0xF else 0) | r[6] & 0x10']
+        return operand.setup + ['x = (%s %s 1) & 0xFF' % (operand.load, '+' if op == OP.INC else '-')] + \
+            operand.store('x') + flags + ret
+
+    if op in ACCUMULATOR_SHIFTS:
+        # z cleared unlike the CB forms
+        return ['v = r[7]'] + SHIFTS[ACCUMULATOR_SHIFTS[op]] + ['r[7] = x', 'r[6] = c << 4'] + ret
+    if op in SHIFTS:
+        operand = Operand(layout[0])
+        return operand.setup + ['v = ' + operand.load] + SHIFTS[op] + operand.store('x') + \
+            ['r[6] = ZERO[x] | c << 4'] + ret
+    if op in (OP.BIT, OP.SET, OP.RES):
+        mask = 1 << layout[0][2]
+        operand = Operand(layout[1])
+        if op == OP.BIT:
+            return operand.setup + ['r[6] = (0 if %s & 0x%02X else 0x80) | 0x20 | r[6] & 0x10' % (operand.load, mask)] + ret
+        value = '%s | 0x%02X' % (operand.load, mask) if op == OP.SET else '%s & 0x%02X' % (operand.load, ~mask & 0xFF)
+        return operand.setup + ['x = ' + value] + operand.store('x') + ret
+
+    if op == OP.DAA:
+        return ['a = r[7]', 'f = r[6]',
+            'if not f & 0x40:',
+            '    if f & 0x10 or a > 0x99: a += 0x60; f |= 0x10',
+            '    if f & 0x20 or a & 0xF > 9: a += 0x06',
+            'else:',
+            '    if f & 0x10: a -= 0x60',
+            '    if f & 0x20: a -= 0x06',
+            'a &= 0xFF', 'r[7] = a', 'r[6] = ZERO[a] | f & 0x50'] + ret
+    if op == OP.CPL:
+        return ['r[7] ^= 0xFF', 'r[6] |= 0x60'] + ret
+    if op == OP.SCF:
+        return ['r[6] = r[6] & 0x80 | 0x10'] + ret
+    if op == OP.CCF:
+        return ['r[6] = r[6] & 0x80 | ~r[6] & 0x10'] + ret
+
+    if op == OP.PUSH:
+        return push(get16(layout[0][2])) + ret
+    if op == OP.POP:
+        return pop('v') + set16(layout[0][2], 'v') + ret
+
+    # control flow, conditionals count their extra cycles when taken
+    cond = None
+    if layout and layout[0][0] == OPER_TYPE.COND:
+        cond, layout = layout[0][2], layout[1:]
+    if op == OP.JP and layout[0][0] == OPER_TYPE.REG:
+        return ['v = %s' % get16(REG.HL), 'jump(pc, v)', 'return v']
+    if op in (OP.JP, OP.JR, OP.CALL, OP.RST, OP.RET, OP.RETI):
+        if op == OP.JR:
+            target = ['t = (pc + 2 + %s) & 0xFFFF' % immediate(SRC_SIMM8, None)]
+        elif op in (OP.JP, OP.CALL, OP.RST):
+            target = ['t = %s' % immediate(layout[0][1], layout[0][2])]
+        else:
+            target = pop('t')
+        if op in (OP.CALL, OP.RST):
+            target += push(nxt)
+        if op == OP.RETI:
+            target += ['r[%d] = 1' % R_IME]
+        if cond is None:
+            return target + ['return t']
+        return ['if %s:' % condition(cond)] + ['    ' + line for line in target] + \
+            ['    r[%d] += %d' % (R_CYCLES, TAKEN_CYCLES[op]), '    return t'] + ret
+
+    if op == OP.EI or op == OP.DI:
+        return ['r[%d] = %d' % (R_IME, op == OP.EI)] + ret
+    if op == OP.HALT:
+        return ['raise Halt(pc)']
+    if op in (OP.NOP, OP.STOP):
+        # stop: the CGB speed switch, or waiting for a button that's never
+        # pressed
+        return ret
+
+    raise ValueError('no handler for %s' % op.name)
+
+def handler_name(opcode):
+    return 'op_%03x' % opcode
+
+@functools.lru_cache(maxsize=None)
+def handler_bodies():
+    """ gen_body() of every opcode """
+    return [gen_body(opcode) for opcode in range(OPCODE_COUNT)]
+
+@functools.lru_cache(maxsize=None)
+def handlers_code():
+    """ the compiled handlers, defining op_000 ... op_1ff """
+    lines = []
+    for opcode, body in enumerate(handler_bodies()):
+        lines.append('def %s(pc, r, m):' % handler_name(opcode))
+        lines.extend('    ' + line for line in body)
+    return compile('\n'.join(lines) + '\n', '<LR35902 handlers>', 'exec')
+
+#------------------------------------------------------------------------------
+# BLOCKS
+#------------------------------------------------------------------------------
+
+# ROM code runs as blocks: the handler bodies of a straight run of
+# instructions up to the first one that may not fall through, compiled into
+# one function with the operands folded in. ROM doesn't change under a block
+# (a bank's blocks are swapped out with it), RAM is run an instruction at a
+# time through the handlers.
+
+MAX_BLOCK_INSTRUCTIONS = 64
+
+DEREFS = (OPER_TYPE.REG_DEREF, OPER_TYPE.REG_DEREF_INC, OPER_TYPE.REG_DEREF_DEC, OPER_TYPE.ADDR_DEREF)
+
+PC = re.compile(r'\bpc\b')
+
+def writes_memory(opcode):
+    """ whether opcode may store outside IO and HRAM (the stack aside), a
+        write that can switch the bank a block is running from """
+    op = OPCODE_OP[opcode]
+    layout = OPCODE_OPERANDS[opcode]
+    if not layout or op in ALU or op == OP.BIT:
+        return False
+    if op in (OP.SET, OP.RES):
+        return layout[1][0] in DEREFS
+    return layout[0][0] in DEREFS
+
+def falls_through(body):
+    """ whether a handler body only returns the next pc, at its end """
+    return body[-1].startswith('return (pc + ') and \
+        not any('return' in line or 'raise' in line for line in body[:-1])
+
+def block_source(mem, pc, end):
+    """ (source of the function 'block', addresses of its instructions) of
+        the block at pc, which doesn't run past end """
+    bodies = handler_bodies()
+    lines = []
+    addresses = []
+    cycles = 0
+    addr = pc
+    while True:
+        opcode = mem[addr]
+        if opcode == 0xCB:
+            opcode = 0x100 | mem[addr + 1]
+            cycles += CB_CYCLES[opcode & 0xFF]
+        else:
+            cycles += CYCLES[opcode]
+        addresses.append(addr)
+        body = bodies[opcode]
+        nxt = addr + OPCODE_LEN[opcode]
+        through = falls_through(body)
+        last = not through or nxt >= end or len(addresses) == MAX_BLOCK_INSTRUCTIONS or \
+            (addr >= ROM1_OFFSET and writes_memory(opcode))
+        if through:
+            body = body[:-1] + (['return 0x%04x' % nxt] if last else [])
+        if nxt <= end:
+            body = [line.replace('m[pc + 1]', str(mem[addr + 1])).replace('m[pc + 2]', str(mem[addr + 2])) for line in body]
+        if any(PC.search(line) for line in body):
+            lines.append('pc = 0x%04x' % addr)
+        lines.extend(body)
+        if last:
+            break
+        addr = nxt
+    source = ['def block(pc, r, m):', 'r[%d] += %d' % (R_CYCLES, cycles), 'r[%d] += %d' % (R_COUNT, len(addresses))] + lines
+    return '\n    '.join(source) + '\n', addresses
+
+#------------------------------------------------------------------------------
+# EMULATOR
+#------------------------------------------------------------------------------
+
+class Emulator(object):
+    """ a GameBoy running rom, from the state the boot ROM leaves """
+    __slots__ = ('rom', 'bank_count', 'mbc', 'rom_bank', 'regs', 'mem', 'pc', 'called', 'namespace', 'ops',
+        'blocks', 'bank_blocks', 'seen', 'bank_seen', 'jump_keys', 'jump_banks', 'jump_sites', 'jump_targets',
+        'line', 'polls')
+
+    def __init__(self, rom, bank=1):
+        self.rom = rom
+        self.bank_count = max(bank_count(len(rom), None), 2)
+        self.mbc = mbc_type(rom)
+
+        # B C D E H L F A SP, cycles, IME, instructions
+        self.regs = list(POST_BOOT_REGS) + [0, 0, 0]
+        # two bytes past the end for the operands of an instruction at 0xFFFF
+        self.mem = bytearray(0x10002)
+        self.mem[0:BANK_SIZE] = self.bank_bytes(0)
+        for address, value in POST_BOOT_IO.items():
+            self.mem[address] = value
+        self.mem[RETURN_TRAP] = ILLEGAL_OPCODE
+        self.pc = START_ADDR
+        self.called = False
+        self.line = 0
+        self.polls = 0
+
+        self.namespace = {
+            'ZERO': ZERO, 'CB_CYCLES': CB_CYCLES, 'Halt': Halt, 'IllegalOpcode': IllegalOpcode,
+            'rd': self.read, 'wr': self.write, 'jump': self.jump,
+        }
+        exec(handlers_code(), self.namespace)
+        handlers = [self.namespace[handler_name(opcode)] for opcode in range(OPCODE_COUNT)]
+        self.ops = handlers[:256]
+        self.namespace['CB'] = handlers[256:]
+
+        # what runs at each address of the current mapping, the blocks of
+        # the switchable banks mapped out in bank_blocks
+        self.blocks = [self.compile_block] * VRAM_START + [self.interpret] * (0x10000 - VRAM_START)
+        self.bank_blocks = {}
+        # executed addresses, likewise
+        self.seen = bytearray(0x10000)
+        self.bank_seen = {}
+        # jp hl: (bank, site, target) once each, the bank being the one
+        # mapped when it ran
+        self.jump_keys = set()
+        self.jump_banks = array('H')
+        self.jump_sites = array('H')
+        self.jump_targets = array('H')
+
+        self.rom_bank = None
+        self.map_bank(min(max(bank, 1), self.bank_count - 1))
+
+    @property
+    def cycles(self):
+        return self.regs[R_CYCLES]
+
+    @property
+    def instructions(self):
+        return self.regs[R_COUNT]
+
+    def bank_bytes(self, bank):
+        data = self.rom[bank * BANK_SIZE:(bank + 1) * BANK_SIZE]
+        return bytes(data) + b'\xff' * (BANK_SIZE - len(data))
+
+    #--------------------------------------------------------------------------
+    # MEMORY
+    #--------------------------------------------------------------------------
+
+    def map_bank(self, bank):
+        if bank == self.rom_bank:
+            return
+        end = ROM1_OFFSET + BANK_SIZE
+        if self.rom_bank is not None:
+            self.bank_seen[self.rom_bank] = self.seen[ROM1_OFFSET:end]
+            self.bank_blocks[self.rom_bank] = self.blocks[ROM1_OFFSET:end]
+        self.seen[ROM1_OFFSET:end] = self.bank_seen.get(bank, bytes(BANK_SIZE))
+        self.blocks[ROM1_OFFSET:end] = self.bank_blocks.get(bank) or [self.compile_block] * BANK_SIZE
+        self.mem[ROM1_OFFSET:end] = self.bank_bytes(bank)
+        self.rom_bank = bank
+
+    def write_mbc(self, address, value):
+        """ a write to ROM, the ROM bank register as GameBoyMBC.select_bank()
+            has it (RAM enable, RAM banks and MBC1's upper bits aren't
+            modelled) """
+        if is_bank_register(address, self.mbc):
+            self.map_bank(select_bank(self.mbc, self.rom_bank, address, value) % self.bank_count)
+
+    def read(self, address):
+        """ the reads the handlers don't do themselves: echo RAM, OAM and
+            the IO registers """
+        mem = self.mem
+        if address < ECHO_START + ECHO_LENGTH:
+            return mem[address - ECHO_OFFSET]
+        if address == LY:
+            self.line = (self.line + 1) % LINES
+            return self.line
+        if address == STAT:
+            self.polls += 1
+            return mem[address] & 0xFC | self.polls & 3
+        if address == DIV:
+            self.polls += 1
+            return self.polls & 0xFF
+        if address == JOYP:
+            return mem[address] | 0xCF
+        return mem[address]
+
+    def write(self, address, value):
+        if address < VRAM_START:
+            self.write_mbc(address, value)
+        elif ECHO_START <= address < ECHO_START + ECHO_LENGTH:
+            self.mem[address - ECHO_OFFSET] = value
+        elif VOID_START <= address < IO_START:
+            # unusable, writes are ignored (and RETURN_TRAP stays)
+            return
+        else:
+            self.mem[address] = value
+
+    def jump(self, site, target):
+        key = (self.rom_bank, site, target)
+        if key not in self.jump_keys:
+            self.jump_keys.add(key)
+            self.jump_banks.append(self.rom_bank)
+            self.jump_sites.append(site)
+            self.jump_targets.append(target)
+
+    def push(self, value):
+        sp = (self.regs[R_SP] - 2) & 0xFFFF
+        self.regs[R_SP] = sp
+        self.write(sp, value & 0xFF)
+        self.write((sp + 1) & 0xFFFF, value >> 8)
+
+    #--------------------------------------------------------------------------
+    # RUNNING
+    #--------------------------------------------------------------------------
+
+    def compile_block(self, pc, regs, mem):
+        """ what ROM addresses run first, compiles the block at pc and runs
+            it """
+        source, addresses = block_source(mem, pc, ROM1_OFFSET if pc < ROM1_OFFSET else VRAM_START)
+        exec(compile(source, '<block %02x:%04x>' % (self.rom_bank if pc >= ROM1_OFFSET else 0, pc), 'exec'), self.namespace)
+        block = self.blocks[pc] = self.namespace.pop('block')
+        seen = self.seen
+        for address in addresses:
+            seen[address] = 1
+        return block(pc, regs, mem)
+
+    def interpret(self, pc, regs, mem):
+        """ what RAM addresses run, one instruction """
+        op = mem[pc]
+        self.seen[pc] = 1
+        regs[R_CYCLES] += CYCLES[op]
+        regs[R_COUNT] += 1
+        return self.ops[op](pc, regs, mem)
+
+    def call(self, address):
+        """ starts at address as if called, the trace stopping when it
+            returns """
+        self.push(RETURN_TRAP)
+        self.pc = address
+        self.called = True
+
+    def run(self, cycles):
+        """ runs for about cycles more cycles, raises TraceStop if execution
+            can't go on (self.pc being where it stopped) """
+        blocks = self.blocks
+        regs = self.regs
+        mem = self.mem
+        pc = self.pc
+        end = regs[R_CYCLES] + cycles
+        while regs[R_CYCLES] < end:
+            # up to the end of the frame, or of the run
+            frame_end = (regs[R_CYCLES] // FRAME_CYCLES + 1) * FRAME_CYCLES
+            stop = min(end, frame_end)
+            try:
+                while regs[R_CYCLES] < stop:
+                    pc = blocks[pc](pc, regs, mem)
+            except IllegalOpcode as e:
+                self.pc = e.pc
+                self.seen[e.pc] = 0
+                regs[R_COUNT] -= 1
+                if e.pc == RETURN_TRAP:
+                    raise TraceStop('returned' if self.called else 'ran into unusable memory at 0x%04x' % e.pc)
+                raise TraceStop('illegal opcode 0x%02x at 0x%04x' % (mem[e.pc], e.pc))
+            except Halt as e:
+                # waits for the interrupts at the end of the frame
+                pc = (e.pc + 1) & 0xFFFF
+                regs[R_CYCLES] = max(regs[R_CYCLES], stop)
+            if regs[R_CYCLES] >= frame_end:
+                pc = self.end_frame(pc)
+        self.pc = pc
+
+    def end_frame(self, pc):
+        """ requests the frame's interrupts, returns pc or that of the
+            interrupt taken """
+        mem = self.mem
+        if mem[LCDC] & 0x80:
+            mem[IF] |= 0x01
+        if mem[TAC] & 0x04:
+            mem[IF] |= 0x04
+        pending = mem[IE] & mem[IF] & 0x1F
+        if not pending or not self.regs[R_IME]:
+            return pc
+        bit = (pending & -pending).bit_length() - 1
+        mem[IF] &= ~(1 << bit) & 0xFF
+        self.regs[R_IME] = 0
+        self.push(pc)
+        return 0x40 + 8 * bit
+
+    #--------------------------------------------------------------------------
+    # TRACE
+    #--------------------------------------------------------------------------
+
+    def visited(self):
+        """ {bank: bytearray} of the executed addresses, bank 0 holding
+            everything outside 0x4000-0x7FFF and each switchable bank its
+            0x4000-0x7FFF (at offset 0) """
+        end = ROM1_OFFSET + BANK_SIZE
+        banks = dict(self.bank_seen)
+        banks[self.rom_bank] = self.seen[ROM1_OFFSET:end]
+        outside = bytearray(self.seen)
+        outside[ROM1_OFFSET:end] = bytes(BANK_SIZE)
+        banks[0] = outside
+        return dict((bank, seen) for bank, seen in banks.items() if any(seen))
+
+    def visited_addresses(self):
+        """ array of bank << 16 | address of every executed address """
+        found = array('L')
+        for bank, seen in sorted(self.visited().items()):
+            base = bank_base(bank)
+            start = seen.find(1)
+            while start >= 0:
+                found.append(bank << 16 | base + start)
+                start = seen.find(1, start + 1)
+        return found
+
+    def indirect_branches(self):
+        """ [(bank, site, target)] of the jp hl executed """
+        return list(zip(self.jump_banks, self.jump_sites, self.jump_targets))
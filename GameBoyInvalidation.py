@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# invalidation of the plugin's derived state on byte patches, main exports:
+# functions_to_relift()
+# PatchInvalidator
+#
+# a write of [offset, offset+length) changes the instructions overlapping
+# it, which start up to max_instr_length-1 bytes before it. What the plugin
+# derives from the bytes, and what a write does to it:
+#
+#   DECODE_CACHE        keyed by the instruction bytes themselves (and the
+#                       address for jr), a patch can't make an entry stale
+#   LifterContext       only lives for the lifting of one instruction
+#   rst conventions     session_data, found again on writes to ROM0; if they
+#                       changed every function is lifted again
+#   jump tables         read by walk_blocks() outside of the basic blocks,
+#                       view_jump_tables() knows whose they were
+#   bank switch index   metadata, the written bank is swept again
+#
+# Binja reanalyzes the functions whose basic blocks were written on its own,
+# the others in functions_to_relift() are reanalyzed here.
+
+from binaryninja.binaryview import BinaryDataNotification
+from binaryninja.log import log_debug
+
+from .GameBoyROM import ROM0_SIZE, ROM1_OFFSET, ROM1_SIZE
+from .LR35902Arch import LR35902
+from .LR35902Flow import RST_SESSION_KEY, rst_conventions, view_jump_tables
+
+# writes longer than this look for the functions overlapping them through
+# all the basic blocks instead of address by address
+MAX_ADDRESS_LOOKUPS = 0x100
+
+def patch_window(offset, length):
+    """ [start, end) of the instructions a write can have changed """
+    return max(0, offset - (LR35902.max_instr_length - 1)), offset + length
+
+def overlaps(start, end, span_start, span_end):
+    return span_start < end and start < span_end
+
+def functions_overlapping(view, start, end):
+    """ the functions with a basic block overlapping [start, end) """
+    found = {}
+    if end - start <= MAX_ADDRESS_LOOKUPS:
+        for addr in range(start, end):
+            for func in view.get_functions_containing(addr):
+                found[func.start] = func
+    else:
+        for func in view.functions:
+            if any(overlaps(start, end, block.start, block.end) for block in func.basic_blocks):
+                found[func.start] = func
+    return found
+
+def functions_to_relift(view, offset, length):
+    """ ({start: function} of every function a write of [offset,
+        offset+length) leaves stale, whether the rst conventions changed),
+        the rst conventions and the jump table registry are updated """
+    start, end = patch_window(offset, length)
+    stale = functions_overlapping(view, start, end)
+
+    # functions whose jump tables were written
+    for func_start, tables in list(view_jump_tables(view).items()):
+        if func_start not in stale and any(overlaps(offset, offset + length, *table) for table in tables):
+            func = view.get_function_at(func_start)
+            if func is not None:
+                stale[func_start] = func
+
+    # rst helpers are in ROM0, a change means every rst lifts differently
+    rst_changed = False
+    if offset < ROM0_SIZE and RST_SESSION_KEY in view.session_data:
+        rst = rst_conventions(view.read(0, ROM0_SIZE))
+        if rst != view.session_data[RST_SESSION_KEY]:
+            view.session_data[RST_SESSION_KEY] = rst
+            rst_changed = True
+            stale = dict((func.start, func) for func in view.functions)
+
+    return stale, rst_changed
+
+def written_banks(view, offset, length):
+    """ ROM banks a write of the view's address space went to """
+    banks = []
+    if offset < ROM0_SIZE:
+        banks.append(0)
+    if overlaps(offset, offset + length, ROM1_OFFSET, ROM1_OFFSET + ROM1_SIZE) and view.rom_bank is not None:
+        banks.append(view.rom_bank)
+    return banks
+
+class PatchInvalidator(BinaryDataNotification):
+    """ keeps a GameBoyRomView's derived state in step with byte patches """
+
+    def __init__(self):
+        BinaryDataNotification.__init__(self)
+        # function starts left stale by the last write, for scripts
+        self.last_stale = []
+
+    def data_written(self, view, offset, length):
+        stale, rst_changed = functions_to_relift(view, offset, length)
+
+        # Binja already reanalyzes what overlaps the write itself
+        start, end = patch_window(offset, length)
+        for func in stale.values():
+            if rst_changed or not any(overlaps(start, end, block.start, block.end) for block in func.basic_blocks):
+                func.reanalyze()
+
+        for bank in written_banks(view, offset, length):
+            view.reindex_bank_switches(bank)
+
+        self.last_stale = sorted(stale)
+        log_debug('write of 0x%x bytes at 0x%04x: %d functions to lift again%s' % (
+            length, offset, len(stale), ' (rst helpers changed)' if rst_changed else ''))
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+#
+# MBC bank switch index, main exports:
+# bank_switch_index()
+# sweep_bank_switches()
+#
+# calls from ROM0 into 0x4000-0x7FFF go to whichever bank was last written to
+# the MBC ROM bank register. One linear sweep per bank tracks the registers
+# holding constants and records
+#
+#   ld a,0x05           ; the bank switches, constant or not
+#   ld (0x2000),a
+#   call 0x4a21         ; far calls: 05:4A21
+#
+#   ld a,0x05           ; and calls through far call trampolines, ROM0
+#   ld hl,0x4a21        ; routines switching to the bank in one register
+#   call FarCall        ; and jumping to the address in a register pair
+#   rst 0x08            ; (or reached through an rst vector)
+#
+# no Binary Ninja needed, the index is built by GameBoyRomView once and kept
+# in the view's metadata (index_record()).
+
+import struct
+from collections import namedtuple
+
+from lr35902dis.lr35902 import OP, OPER_TYPE, REG
+
+from .GameBoyROM import BANK_SIZE, ROM1_OFFSET, CART_TYPE_OFFSET, CARTRIDGE_TYPES, bank_base
+from .LR35902Decoder import OPCODE_COUNT, OPCODE_LEN, OPCODE_OP, OPCODE_OPERANDS, OPCODE_BRANCH
+from .LR35902Decoder import INSTR_LEN, branch_target, opcode_index
+from .LR35902Decoder import BRANCH_JUMP, BRANCH_INDIRECT, BRANCH_CALL, BRANCH_RETURN
+
+# writes anywhere in here select the ROM bank at 0x4000-0x7FFF, see
+# is_bank_register() and select_bank(). MBC2 decodes address bit 8 instead:
+# any write below BANK_REGISTER_END with it set
+BANK_REGISTER_START = 0x2000
+BANK_REGISTER_END = 0x4000
+MBC2_BANK_REGISTER_BIT = 0x100
+# a bank register address on every MBC, for values not written anywhere known
+BANK_REGISTER_ANY = BANK_REGISTER_START | MBC2_BANK_REGISTER_BIT
+# 0x3000-0x3FFF is the 9th bank bit on MBC5
+BANK_REGISTER_LOW_END = 0x3000
+
+# how the ROM bank register of a cartridge's MBC works, by the
+# CARTRIDGE_TYPES name up to the first '+'; HuC1 selects banks like MBC1
+MBC_TYPES = {'MBC1': 'MBC1', 'HuC1': 'MBC1', 'MBC2': 'MBC2', 'MBC3': 'MBC3', 'MBC5': 'MBC5'}
+
+# how far into a routine a trampoline's jump is looked for
+MAX_TRAMPOLINE_INSTRUCTIONS = 32
+
+#------------------------------------------------------------------------------
+# REGISTER EFFECTS
+#------------------------------------------------------------------------------
+
+# tracked 8-bit registers
+REG_A, REG_B, REG_C, REG_D, REG_E, REG_H, REG_L = range(7)
+REG_NAMES = 'ABCDEHL'
+
+_REG8 = {REG.A: REG_A, REG.B: REG_B, REG.C: REG_C, REG.D: REG_D, REG.E: REG_E, REG.H: REG_H, REG.L: REG_L}
+# (high, low) of the pairs, af only ever matters for a
+_REG16 = {REG.BC: (REG_B, REG_C), REG.DE: (REG_D, REG_E), REG.HL: (REG_H, REG_L), REG.AF: (REG_A,)}
+PAIR_NAMES = {(REG_B, REG_C): 'BC', (REG_D, REG_E): 'DE', (REG_H, REG_L): 'HL'}
+
+# what an instruction does to the tracked registers
+EFFECT_CLOBBER = 1      # (kind, regs)
+EFFECT_COPY = 2         # (kind, dst, src)
+EFFECT_IMM8 = 3         # (kind, dst)
+EFFECT_IMM16 = 4        # (kind, high, low)
+EFFECT_ZERO = 5         # (kind, dst)
+EFFECT_STORE = 6        # (kind, address pair or None for (nn), value reg or None for n, clobbered regs)
+EFFECT_CALL = 7         # (kind,) call nn, call cc,nn and rst n
+EFFECT_JUMP = 8         # (kind,) jp nn, jr e
+EFFECT_END = 9          # (kind,) ret, reti, jp hl
+
+def _regs(reg):
+    if reg in _REG8:
+        return (_REG8[reg],)
+    return _REG16.get(reg, ())
+
+def _written(op, layout):
+    """ tracked registers an instruction writes (not counting stores) """
+    if op in (OP.CPL, OP.DAA, OP.RLCA, OP.RLA, OP.RRCA, OP.RRA):
+        return (REG_A,)
+    if op in (OP.AND, OP.OR, OP.XOR, OP.SUB, OP.ADC, OP.SBC) and len(layout) == 1:
+        # implied a,
+        return (REG_A,)
+    if op in (OP.SET, OP.RES):
+        return _regs(layout[1][2]) if layout[1][0] == OPER_TYPE.REG else ()
+    if op in (OP.BIT, OP.CP, OP.PUSH, OP.JP, OP.JR, OP.CALL, OP.RET, OP.RST):
+        return ()
+    regs = ()
+    if layout and layout[0][0] == OPER_TYPE.REG:
+        regs = _regs(layout[0][2])
+    if any(oper_type in (OPER_TYPE.REG_DEREF_INC, OPER_TYPE.REG_DEREF_DEC) for oper_type, _, _ in layout):
+        regs += (REG_H, REG_L)
+    return regs
+
+def _effect(opcode):
+    op = OPCODE_OP[opcode]
+    layout = OPCODE_OPERANDS[opcode]
+    if op is None:
+        return None
+
+    branch = OPCODE_BRANCH[opcode]
+    if branch == BRANCH_CALL:
+        return (EFFECT_CALL,)
+    if branch == BRANCH_JUMP:
+        return (EFFECT_JUMP,)
+    if branch in (BRANCH_INDIRECT, BRANCH_RETURN):
+        return (EFFECT_END,)
+
+    if op in (OP.XOR, OP.SUB) and layout == ((OPER_TYPE.REG, 0, REG.A),):
+        return (EFFECT_ZERO, REG_A)
+
+    if op in (OP.LD, OP.LDI, OP.LDD):
+        (dst_type, _, dst), (src_type, _, src) = layout
+        if dst_type == OPER_TYPE.REG and dst in _REG8 and src_type == OPER_TYPE.REG and src in _REG8:
+            return (EFFECT_COPY, _REG8[dst], _REG8[src])
+        if dst_type == OPER_TYPE.REG and dst in _REG8 and src_type == OPER_TYPE.IMM:
+            return (EFFECT_IMM8, _REG8[dst])
+        if dst_type == OPER_TYPE.REG and dst in (REG.BC, REG.DE, REG.HL) and src_type == OPER_TYPE.IMM:
+            return (EFFECT_IMM16,) + _REG16[dst]
+        if dst_type == OPER_TYPE.ADDR_DEREF and src_type == OPER_TYPE.REG and src == REG.A:
+            return (EFFECT_STORE, None, REG_A, ())
+        if dst_type in (OPER_TYPE.REG_DEREF, OPER_TYPE.REG_DEREF_INC, OPER_TYPE.REG_DEREF_DEC):
+            value = _REG8.get(src) if src_type == OPER_TYPE.REG else None
+            return (EFFECT_STORE, _REG16[dst], value, _written(op, layout))
+
+    written = _written(op, layout)
+    return (EFFECT_CLOBBER, written) if written else None
+
+# indexed by opcode_index()
+OPCODE_EFFECT = [_effect(opcode) for opcode in range(OPCODE_COUNT)]
+
+def _step(effect, chunk, regs):
+    """ applies an effect but calls and jumps to regs, returns the
+        (address, value) of a store, either None when unknown """
+    kind = effect[0]
+    if kind == EFFECT_IMM8:
+        regs[effect[1]] = chunk[1]
+    elif kind == EFFECT_COPY:
+        regs[effect[1]] = regs[effect[2]]
+    elif kind == EFFECT_CLOBBER:
+        for reg in effect[1]:
+            regs[reg] = None
+    elif kind == EFFECT_IMM16:
+        regs[effect[1]] = chunk[2]
+        regs[effect[2]] = chunk[1]
+    elif kind == EFFECT_ZERO:
+        regs[effect[1]] = 0
+    elif kind == EFFECT_STORE:
+        pair, value, clobbered = effect[1:]
+        if pair is None:
+            address = chunk[1] | (chunk[2] << 8)
+        else:
+            high, low = regs[pair[0]], regs[pair[1]]
+            address = (high << 8) | low if isinstance(high, int) and isinstance(low, int) else None
+        value = chunk[1] if value is None else regs[value]
+        for reg in clobbered:
+            regs[reg] = None
+        return address, value
+    return None
+
+def is_bank_register(address, mbc=None):
+    """ whether a write to address selects the ROM bank, mbc being a
+        mbc_type() """
+    if address is None:
+        return False
+    if mbc == 'MBC2':
+        return address < BANK_REGISTER_END and bool(address & MBC2_BANK_REGISTER_BIT)
+    return BANK_REGISTER_START <= address < BANK_REGISTER_END
+
+def mbc_type(rom):
+    """ MBC_TYPES value of the cartridge type in rom's header, None if its
+        ROM bank register isn't modelled (no MBC, MMM01 ...) """
+    if len(rom) <= CART_TYPE_OFFSET:
+        return None
+    name = CARTRIDGE_TYPES.get(rom[CART_TYPE_OFFSET], ('',))[0]
+    return MBC_TYPES.get(name.split('+')[0])
+
+def select_bank(mbc, bank, address, value):
+    """ the ROM bank at 0x4000-0x7FFF after value is written to the bank
+        register at address, bank being the one before and mbc a
+        mbc_type(). Either may be None if unknown, so may the result: an
+        unknown 9th bit of an MBC5 bank is taken to be clear """
+    if mbc is None or not is_bank_register(address, mbc):
+        return bank
+    if value is None:
+        return None
+    # writing 0 selects bank 1, but on MBC5
+    if mbc == 'MBC1':
+        return value & 0x1F or 1
+    if mbc == 'MBC2':
+        return value & 0x0F or 1
+    if mbc == 'MBC3':
+        return value & 0x7F or 1
+    if address < BANK_REGISTER_LOW_END:
+        return (bank or 0) & 0x100 | value
+    return None if bank is None else bank & 0xFF | (value & 1) << 8
+
+#------------------------------------------------------------------------------
+# TRAMPOLINES
+#------------------------------------------------------------------------------
+
+def find_trampoline(rom0, addr, mbc=None):
+    """ (bank register, target pair) names, e.g. ('A', 'HL'), of a far call
+        trampoline at addr in ROM0: it writes the register's value, as it
+        was on entry, to the bank register of mbc (a mbc_type()) and jumps to
+        the pair's value. None if it isn't one """
+    # every register starts out holding itself
+    regs = list(REG_NAMES)
+    bank = None
+    for _ in range(MAX_TRAMPOLINE_INSTRUCTIONS):
+        chunk = rom0[addr:addr+4]
+        if not chunk or len(chunk) < INSTR_LEN[chunk[0]]:
+            return None
+        opcode = opcode_index(chunk)
+        effect = OPCODE_EFFECT[opcode]
+
+        jumps_to_hl = opcode == 0xE9
+        if effect is not None and effect[0] == EFFECT_CALL:
+            # only a call to a jp hl stub
+            target = branch_target(opcode, chunk, addr)
+            jumps_to_hl = rom0[target:target+1] == b'\xE9'
+            if not jumps_to_hl:
+                return None
+
+        if jumps_to_hl:
+            pair = (regs[REG_H], regs[REG_L])
+            if bank is None or not all(isinstance(reg, str) for reg in pair):
+                return None
+            target = PAIR_NAMES.get((REG_NAMES.index(pair[0]), REG_NAMES.index(pair[1])))
+            if target is None or bank in target:
+                return None
+            return bank, target
+
+        if effect is None:
+            pass
+        elif effect[0] == EFFECT_JUMP:
+            addr = branch_target(opcode, chunk, addr)
+            if not 0 <= addr < len(rom0):
+                return None
+            continue
+        elif effect[0] == EFFECT_END:
+            return None
+        else:
+            store = _step(effect, chunk, regs)
+            if store is not None and is_bank_register(store[0], mbc):
+                if not isinstance(store[1], str):
+                    return None
+                bank = store[1]
+        addr += OPCODE_LEN[opcode]
+    return None
+
+class Trampolines(object):
+    """ find_trampoline() memoized over a ROM0 """
+
+    def __init__(self, rom0):
+        self.rom0 = rom0
+        self.mbc = mbc_type(rom0)
+        self.found = {}
+
+    def get(self, addr):
+        if addr >= len(self.rom0):
+            return None
+        if addr not in self.found:
+            self.found[addr] = find_trampoline(self.rom0, addr, self.mbc)
+        return self.found[addr]
+
+    def items(self):
+        return sorted((addr, found) for addr, found in self.found.items() if found is not None)
+
+#------------------------------------------------------------------------------
+# SWEEP
+#------------------------------------------------------------------------------
+
+def _value(regs, names):
+    """ value of a register (pair) by name, None if unknown """
+    value = 0
+    for name in names:
+        reg = regs[REG_NAMES.index(name)]
+        if reg is None:
+            return None
+        value = (value << 8) | reg
+    return value
+
+def sweep_bank_switches(rom, bank, trampolines, mbc):
+    """ one linear sweep of a bank, trampolines being the ROM's Trampolines
+        and mbc its mbc_type()
+
+        returns (switches, far_calls): the (addr, value or None) of every
+        write to the bank register and the (addr, target bank, target) of
+        every call resolved to another bank """
+    start = bank * BANK_SIZE
+    data = rom[start:start + BANK_SIZE]
+    base = bank_base(bank)
+
+    switches = []
+    far_calls = []
+    unknown = [None] * 7
+    regs = list(unknown)
+    # bank selected since the start of the run, from bank 0 only
+    selected = None
+
+    offset = 0
+    end = len(data)
+    while offset < end:
+        # opcode_index() inlined, most instructions don't need their bytes
+        opcode = data[offset]
+        if opcode == 0xCB:
+            if offset + 1 >= end:
+                break
+            opcode = 0x100 | data[offset+1]
+        length = OPCODE_LEN[opcode]
+        effect = OPCODE_EFFECT[opcode]
+        if effect is None:
+            offset += length or 1
+            continue
+        if offset + length > end:
+            break
+        chunk = data[offset:offset+length]
+
+        kind = effect[0]
+        if kind == EFFECT_CALL or kind == EFFECT_JUMP:
+            if selected is None and regs == unknown:
+                # nothing to resolve it with (the 0xFF padding: rst 0x38)
+                offset += length
+                continue
+
+            addr = base + offset
+            target = branch_target(opcode, chunk, addr) & 0xFFFF
+            trampoline = trampolines.get(target) if target < ROM1_OFFSET else None
+            if trampoline is not None:
+                far_bank, far_target = _value(regs, trampoline[0]), _value(regs, trampoline[1])
+                if far_bank is not None and far_target is not None:
+                    far_bank = 0 if far_target < ROM1_OFFSET else select_bank(mbc, None, BANK_REGISTER_ANY, far_bank)
+                    if far_bank is not None:
+                        far_calls.append((addr, far_bank, far_target))
+            elif bank == 0 and selected is not None and ROM1_OFFSET <= target < ROM1_OFFSET + BANK_SIZE:
+                far_calls.append((addr, selected, target))
+
+            # the callee may change anything, a jump ends the run
+            regs = list(unknown)
+            selected = None
+        elif kind == EFFECT_END:
+            regs = list(unknown)
+            selected = None
+        else:
+            store = _step(effect, chunk, regs)
+            if store is not None and is_bank_register(store[0], mbc):
+                switches.append((base + offset, store[1]))
+                selected = select_bank(mbc, selected, store[0], store[1])
+        offset += length
+
+    return switches, far_calls
+
+#------------------------------------------------------------------------------
+# INDEX
+#------------------------------------------------------------------------------
+
+# switches      [(bank, addr, value or None)] of the writes to the bank register
+# trampolines   [(addr, bank register, target pair)] of the ROM0 far call routines
+# far_calls     {(bank, addr): (target bank, target)} of the resolved calls
+BankSwitchIndex = namedtuple('BankSwitchIndex', ['switches', 'trampolines', 'far_calls'])
+
+def bank_switch_index(rom, banks):
+    """ BankSwitchIndex of the first banks banks of rom (any buffer) """
+    trampolines = Trampolines(rom[:BANK_SIZE])
+    mbc = mbc_type(rom)
+    switches = []
+    far_calls = {}
+    for bank in range(banks):
+        bank_switches, bank_far_calls = sweep_bank_switches(rom, bank, trampolines, mbc)
+        switches.extend((bank, addr, value) for addr, value in bank_switches)
+        for addr, target_bank, target in bank_far_calls:
+            far_calls[(bank, addr)] = (target_bank, target)
+    return BankSwitchIndex(
+        switches,
+        [(addr, bank, target) for addr, (bank, target) in trampolines.items()],
+        far_calls,
+    )
+
+def reindex_bank(index, rom, bank, banks):
+    """ index with the bank swept again after a patch. A patch of ROM0
+        changing one of the trampolines changes the far calls of every
+        bank, the whole ROM is swept again then """
+    trampolines = Trampolines(rom[:BANK_SIZE])
+    if bank == 0 and any(trampolines.get(addr) != (reg, pair) for addr, reg, pair in index.trampolines):
+        return bank_switch_index(rom, banks)
+
+    bank_switches, bank_far_calls = sweep_bank_switches(rom, bank, trampolines, mbc_type(rom))
+    switches = [switch for switch in index.switches if switch[0] != bank]
+    switches.extend((bank, addr, value) for addr, value in bank_switches)
+    far_calls = {site: target for site, target in index.far_calls.items() if site[0] != bank}
+    for addr, target_bank, target in bank_far_calls:
+        far_calls[(bank, addr)] = (target_bank, target)
+
+    found = dict((addr, (reg, pair)) for addr, reg, pair in index.trampolines)
+    found.update(trampolines.items())
+    return BankSwitchIndex(
+        sorted(switches),
+        [(addr, reg, pair) for addr, (reg, pair) in sorted(found.items())],
+        far_calls,
+    )
+
+# compact index record kept in the view's metadata: the three counts, then
+# the switches (value 0xFFFF if unknown), the trampolines (register names
+# packed in 2+2 bytes) and the far calls
+_COUNTS = struct.Struct('>III')
+_SWITCH = struct.Struct('>HHH')
+_TRAMPOLINE = struct.Struct('>H2s2s')
+_FAR_CALL = struct.Struct('>HHHH')
+
+def index_record(index):
+    record = [_COUNTS.pack(len(index.switches), len(index.trampolines), len(index.far_calls))]
+    for bank, addr, value in index.switches:
+        record.append(_SWITCH.pack(bank, addr, 0xFFFF if value is None else value))
+    for addr, bank, target in index.trampolines:
+        record.append(_TRAMPOLINE.pack(addr, bank.encode(), target.encode()))
+    for (bank, addr), (target_bank, target) in sorted(index.far_calls.items()):
+        record.append(_FAR_CALL.pack(bank, addr, target_bank, target))
+    return b''.join(record)
+
+def parse_index_record(record):
+    counts = _COUNTS.unpack_from(record)
+    offset = _COUNTS.size
+
+    switches = []
+    for _ in range(counts[0]):
+        bank, addr, value = _SWITCH.unpack_from(record, offset)
+        switches.append((bank, addr, None if value == 0xFFFF else value))
+        offset += _SWITCH.size
+
+    trampolines = []
+    for _ in range(counts[1]):
+        addr, bank, target = _TRAMPOLINE.unpack_from(record, offset)
+        trampolines.append((addr, bank.rstrip(b'\0').decode(), target.decode()))
+        offset += _TRAMPOLINE.size
+
+    far_calls = {}
+    for _ in range(counts[2]):
+        bank, addr, target_bank, target = _FAR_CALL.unpack_from(record, offset)
+        far_calls[(bank, addr)] = (target_bank, target)
+        offset += _FAR_CALL.size
+
+    return BankSwitchIndex(switches, trampolines, far_calls)
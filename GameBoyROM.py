@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# GameBoy ROM layout and header facts shared by GameBoyRomView and the
+# headless tools, no Binary Ninja needed
+#
+# mostly straight up stolen from https://github.com/ZetaTwo/binja-gameboy
+
+import os
+import struct
+import functools
+from collections import namedtuple
+
+# optional and slow to import (~100ms), so only imported by the first
+# global_checksum(); that falls back to summing in C through a memoryview
+# without it
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+ROM_SIG_OFFSET = 0x104
+ROM_SIG_LEN = 0x30
+ROM_SIG = b"\xCE\xED\x66\x66\xCC\x0D\x00\x0B\x03\x73\x00\x83\x00\x0C\x00\x0D\x00\x08\x11\x1F\x88\x89\x00\x0E\xDC\xCC\x6E\xE6\xDD\xDD\xD9\x99\xBB\xBB\x67\x63\x6E\x0E\xEC\xCC\xDD\xDC\x99\x9F\xBB\xB9\x33\x3E"
+HDR_OFFSET = 0x134
+HDR_SIZE = 0x1C
+# header byte of the cartridge type, CARTRIDGE_TYPES
+CART_TYPE_OFFSET = 0x147
+START_ADDR = 0x100
+ROM0_SIZE = 0x4000
+ROM0_OFFSET = 0
+ROM1_SIZE = 0x4000
+ROM1_OFFSET = 0x4000
+BANK_SIZE = 0x4000
+
+# header ROM size code -> number of 16 KB banks
+ROM_SIZE_BANKS = {
+    0x00: 2, 0x01: 4, 0x02: 8, 0x03: 16, 0x04: 32,
+    0x05: 64, 0x06: 128, 0x07: 256, 0x08: 512,
+    0x52: 72, 0x53: 80, 0x54: 96,
+}
+
+# (name, address, length)
+RAM_SEGMENTS = [
+    ('VRAM', 0x8000, 0x2000),
+    ('RAM1', 0xA000, 0x2000),
+    ('RAM0', 0xC000, 0x2000),
+    ('ECHO', 0xE000, 0x1E00),
+    ('OAM',  0xFE00, 0xA0),
+    # Unusuable RAM
+    ('VOID', 0xFEA0, 0x60),
+    ('IO',   0xFF00, 0x80),
+    ('HRAM', 0xFF80, 0x80),
+]
+
+INTERRUPT_HANDLERS = [
+    ('isr_usr0', 0x00),
+    ('isr_usr1', 0x08),
+    ('isr_usr2', 0x10),
+    ('isr_usr3', 0x18),
+    ('isr_usr4', 0x20),
+    ('isr_usr5', 0x28),
+    ('isr_usr6', 0x30),
+    ('isr_usr7', 0x38),
+    ('isr_vblank', 0x40),
+    ('isr_lcd', 0x48),
+    ('isr_timer', 0x50),
+    ('isr_serial', 0x58),
+    ('isr_joypad', 0x60),
+]
+
+# TODO: fill out attributes of bankers
+CARTRIDGE_TYPES = {
+    0x00: ("ROM ONLY", ),
+    0x01: ("MBC1", ),
+    0x02: ("MBC1+RAM", ),
+    0x03: ("MBC1+RAM+BATTERY", ),
+    0x05: ("MBC2", ),
+    0x06: ("MBC2+BATTERY", ),
+    0x08: ("ROM+RAM", ),
+    0x09: ("ROM+RAM+BATTERY", ),
+    0x0B: ("MMM01", ),
+    0x0C: ("MMM01+RAM", ),
+    0x0D: ("MMM01+RAM+BATTERY", ),
+    0x0F: ("MBC3+TIMER+BATTERY", ),
+    0x10: ("MBC3+TIMER+RAM+BATTERY", ),
+    0x11: ("MBC3", ),
+    0x12: ("MBC3+RAM", ),
+    0x13: ("MBC3+RAM+BATTERY", ),
+    0x15: ("MBC4", ),
+    0x16: ("MBC4+RAM", ),
+    0x17: ("MBC4+RAM+BATTERY", ),
+    0x19: ("MBC5", ),
+    0x1A: ("MBC5+RAM", ),
+    0x1B: ("MBC5+RAM+BATTERY", ),
+    0x1C: ("MBC5+RUMBLE", ),
+    0x1D: ("MBC5+RUMBLE+RAM", ),
+    0x1E: ("MBC5+RUMBLE+RAM+BATTERY", ),
+    0xFC: ("POCKET CAMERA", ),
+    0xFD: ("BANDAI TAMA5", ),
+    0xFE: ("HuC3", ),
+    0xFF: ("HuC1+RAM+BATTERY", ),
+}
+
+def bank_count(length, size_code):
+    """ banks declared by the header ROM size code, capped to the length of
+        the ROM file """
+    in_file = (length + BANK_SIZE - 1) // BANK_SIZE
+    if size_code not in ROM_SIZE_BANKS:
+        return in_file
+    return min(ROM_SIZE_BANKS[size_code], in_file)
+
+def bank_base(bank):
+    """ address a bank is mapped at, ROM0 at 0x0000 and the switchable
+        banks at 0x4000 """
+    return ROM0_OFFSET if bank == 0 else ROM1_OFFSET
+
+#------------------------------------------------------------------------------
+# HEADER
+#------------------------------------------------------------------------------
+
+HEADER_CHECKSUM_OFFSET = 0x14D
+GLOBAL_CHECKSUM_OFFSET = 0x14E
+
+Header = namedtuple('Header', [
+    'rom_title', 'color', 'licensee_code', 'gb_type', 'cart_type',
+    'rom_banks', 'ram_banks', 'destination_code', 'old_licensee_code',
+    'mask_rom_version', 'complement_check', 'checksum',
+])
+
+def parse_header(hdr):
+    """ HDR_SIZE bytes at HDR_OFFSET -> Header """
+    return Header(
+        rom_title=hdr[0:15],
+        color=hdr[15],
+        licensee_code=struct.unpack("<H", hdr[16:18])[0],
+        gb_type=hdr[18],
+        cart_type=hdr[19],
+        rom_banks=hdr[20],
+        ram_banks=hdr[21],
+        destination_code=hdr[22],
+        old_licensee_code=hdr[23],
+        mask_rom_version=hdr[24],
+        complement_check=hdr[25],
+        # the only big endian value on the cartridge
+        checksum=struct.unpack(">H", hdr[26:28])[0],
+    )
+
+def header_checksum(rom):
+    """ complement check over 0x134-0x14C, verified by the boot ROM """
+    x = 0
+    for b in rom[HDR_OFFSET:HEADER_CHECKSUM_OFFSET]:
+        x = (x - b - 1) & 0xFF
+    return x
+
+def global_checksum(rom):
+    """ 16-bit sum of every byte of the ROM but the checksum itself, rom is
+        any buffer (bytes, mmap ...) """
+    numpy = load_numpy()
+    if numpy is not None:
+        total = int(numpy.frombuffer(rom, dtype=numpy.uint8).sum(dtype=numpy.uint64))
+    else:
+        total = sum(memoryview(rom))
+    total -= rom[GLOBAL_CHECKSUM_OFFSET] + rom[GLOBAL_CHECKSUM_OFFSET + 1]
+    return total & 0xFFFF
+
+# compact header record kept in the view's metadata: the raw header followed
+# by the computed complement check and global checksum
+HEADER_RECORD = struct.Struct('>%dsBH' % HDR_SIZE)
+
+def header_record(rom):
+    return HEADER_RECORD.pack(
+        bytes(rom[HDR_OFFSET:HDR_OFFSET+HDR_SIZE]),
+        header_checksum(rom),
+        global_checksum(rom),
+    )
+
+def parse_header_record(record):
+    """ returns (Header, header checksum ok, global checksum ok) """
+    (hdr, complement, checksum) = HEADER_RECORD.unpack(record)
+    header = parse_header(hdr)
+    return header, header.complement_check == complement, header.checksum == checksum
+
+#------------------------------------------------------------------------------
+# FILES
+#------------------------------------------------------------------------------
+
+ROM_EXTENSIONS = ('.gb', '.gbc', '.sgb')
+
+def find_files(paths, extensions=ROM_EXTENSIONS, keep_given=False):
+    """ the files among paths and under the directories among them named
+        with one of extensions, keep_given keeping the files given whatever
+        their name """
+    for path in paths:
+        if not os.path.isdir(path):
+            if keep_given or path.lower().endswith(extensions):
+                yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    yield os.path.join(root, name)
@@ -1,13 +1,19 @@
-import struct
+import os
+import json
 import traceback
+import contextlib
 
+from . import GameBoyROM
+from . import GameBoyMBC
 from .LR35902Arch import LR35902
 
 from binaryninja import Type
 from binaryninja.architecture import Architecture
-from binaryninja.binaryview import BinaryView
+from binaryninja.binaryview import BinaryView, BinaryViewType
 from binaryninja.enums import SegmentFlag, SectionSemantics, SymbolType
-from binaryninja.log import log_error, log_info
+from binaryninja.interaction import get_int_input, get_open_filename_input, get_save_filename_input
+from binaryninja.log import log_error, log_warn, log_info
+from binaryninja.plugin import PluginCommand
 from binaryninja.types import Symbol
 
 # straight up stolen from https://github.com/ZetaTwo/binja-gameboy
@@ -15,78 +21,31 @@ class GameBoyRomView(BinaryView):
     name = 'Gameboy'
     long_name = 'Gameboy ROM'
 
-    ROM_SIG_OFFSET = 0x104
-    ROM_SIG_LEN = 0x30
-    ROM_SIG = b"\xCE\xED\x66\x66\xCC\x0D\x00\x0B\x03\x73\x00\x83\x00\x0C\x00\x0D\x00\x08\x11\x1F\x88\x89\x00\x0E\xDC\xCC\x6E\xE6\xDD\xDD\xD9\x99\xBB\xBB\x67\x63\x6E\x0E\xEC\xCC\xDD\xDC\x99\x9F\xBB\xB9\x33\x3E"
-    HDR_OFFSET = 0x134
-    HDR_SIZE = 0x1C
-    START_ADDR = 0x100
-    ROM0_SIZE = 0x4000
-    ROM0_OFFSET = 0
-    ROM1_SIZE = 0x4000
-    ROM1_OFFSET = 0x4000
-
-    # (name, address, length)
-    RAM_SEGMENTS = [
-        ('VRAM', 0x8000, 0x2000),
-        ('RAM1', 0xA000, 0x2000),
-        ('RAM0', 0xC000, 0x2000),
-        ('ECHO', 0xE000, 0x1E00),
-        ('OAM',  0xFE00, 0xA0),
-        # Unusuable RAM
-        ('VOID', 0xFEA0, 0x60),
-        ('IO',   0xFF00, 0x80),
-        ('HRAM', 0xFF80, 0x80),
-    ]
-
-    INTERRUPT_HANDLERS = [
-        ('isr_usr0', 0x00),
-        ('isr_usr1', 0x08),
-        ('isr_usr2', 0x10),
-        ('isr_usr3', 0x18),
-        ('isr_usr4', 0x20),
-        ('isr_usr5', 0x28),
-        ('isr_usr6', 0x30),
-        ('isr_usr7', 0x38),
-        ('isr_vblank', 0x40),
-        ('isr_lcd', 0x48),
-        ('isr_timer', 0x50),
-        ('isr_serial', 0x58),
-        ('isr_joypad', 0x60),
-    ]
-
-    # TODO: fill out attributes of bankers
-    CARTRIDGE_TYPES = {
-        0x00: ("ROM ONLY", ),
-        0x01: ("MBC1", ),
-        0x02: ("MBC1+RAM", ),
-        0x03: ("MBC1+RAM+BATTERY", ),
-        0x05: ("MBC2", ),
-        0x06: ("MBC2+BATTERY", ),
-        0x08: ("ROM+RAM", ),
-        0x09: ("ROM+RAM+BATTERY", ),
-        0x0B: ("MMM01", ),
-        0x0C: ("MMM01+RAM", ),
-        0x0D: ("MMM01+RAM+BATTERY", ),
-        0x0F: ("MBC3+TIMER+BATTERY", ),
-        0x10: ("MBC3+TIMER+RAM+BATTERY", ),
-        0x11: ("MBC3", ),
-        0x12: ("MBC3+RAM", ),
-        0x13: ("MBC3+RAM+BATTERY", ),
-        0x15: ("MBC4", ),
-        0x16: ("MBC4+RAM", ),
-        0x17: ("MBC4+RAM+BATTERY", ),
-        0x19: ("MBC5", ),
-        0x1A: ("MBC5+RAM", ),
-        0x1B: ("MBC5+RAM+BATTERY", ),
-        0x1C: ("MBC5+RUMBLE", ),
-        0x1D: ("MBC5+RUMBLE+RAM", ),
-        0x1E: ("MBC5+RUMBLE+RAM+BATTERY", ),
-        0xFC: ("POCKET CAMERA", ),
-        0xFD: ("BANDAI TAMA5", ),
-        0xFE: ("HuC3", ),
-        0xFF: ("HuC1+RAM+BATTERY", ),
-    }
+    ROM_SIG_OFFSET = GameBoyROM.ROM_SIG_OFFSET
+    ROM_SIG_LEN = GameBoyROM.ROM_SIG_LEN
+    ROM_SIG = GameBoyROM.ROM_SIG
+    HDR_OFFSET = GameBoyROM.HDR_OFFSET
+    HDR_SIZE = GameBoyROM.HDR_SIZE
+    START_ADDR = GameBoyROM.START_ADDR
+    ROM0_SIZE = GameBoyROM.ROM0_SIZE
+    ROM0_OFFSET = GameBoyROM.ROM0_OFFSET
+    ROM1_SIZE = GameBoyROM.ROM1_SIZE
+    ROM1_OFFSET = GameBoyROM.ROM1_OFFSET
+    BANK_SIZE = GameBoyROM.BANK_SIZE
+
+    # load setting for the bank mapped at ROM1_OFFSET
+    ROM_BANK_SETTING = 'loader.gameboy.romBank'
+    # GameBoyROM.header_record()
+    HEADER_METADATA = 'gameboy.header'
+    # GameBoyMBC.index_record(), .2 since the per-MBC rules of select_bank()
+    BANK_SWITCH_METADATA = 'gameboy.bank_switches.2'
+    # stash_bank() of a bank while it isn't mapped, by bank number
+    BANK_STASH_METADATA = 'gameboy.bank_stash.%x'
+
+    ROM_SIZE_BANKS = GameBoyROM.ROM_SIZE_BANKS
+    RAM_SEGMENTS = GameBoyROM.RAM_SEGMENTS
+    INTERRUPT_HANDLERS = GameBoyROM.INTERRUPT_HANDLERS
+    CARTRIDGE_TYPES = GameBoyROM.CARTRIDGE_TYPES
 
     def __init__(self, data):
         BinaryView.__init__(self, parent_view=data, file_metadata=data.file)
@@ -105,44 +64,83 @@ class GameBoyRomView(BinaryView):
 
         return True
 
+    @classmethod
+    def get_load_settings_for_data(cls, data):
+        load_settings = BinaryViewType[cls.name].get_default_load_settings_for_data(data)
+        load_settings.register_setting(cls.ROM_BANK_SETTING, json.dumps({
+            'title': 'Switchable ROM Bank',
+            'type': 'number',
+            'default': 1,
+            'minValue': 1,
+            'maxValue': max(cls.bank_count_for_data(data) - 1, 1),
+            'description': 'ROM bank mapped at 0x4000-0x7FFF',
+        }))
+        return load_settings
+
+    @classmethod
+    def bank_count_for_data(cls, data):
+        """ banks declared by the header, capped to what the file holds """
+        size_code = data.read(cls.HDR_OFFSET + 20, 1)
+        return GameBoyROM.bank_count(data.length, size_code[0] if size_code else None)
+
     def init(self):
         try:
-            hdr = self.parent_view.read(self.HDR_OFFSET, self.HDR_SIZE)
-            self.rom_title = hdr[0:15]
-            self.color = hdr[15]
-            self.licensee_code = struct.unpack("H", hdr[16:18])[0]
-            self.gb_type = hdr[18]
-            self.cart_type = hdr[19]
-            self.rom_banks = hdr[20]
-            self.ram_banks = hdr[21]
-            self.destination_code = hdr[22]
-            self.old_licensee_code = hdr[23]
-            self.mask_rom_version = hdr[24]
-            self.complement_check = hdr[25]
-            self.checksum = struct.unpack("H", hdr[26:])[0]
+            # the header and the checksums over the whole ROM are only
+            # computed once, a reopened database has them in its metadata
+            try:
+                record = self.query_metadata(self.HEADER_METADATA)
+            except KeyError:
+                with self.rom_buffer() as rom:
+                    record = GameBoyROM.header_record(rom)
+                self.store_metadata(self.HEADER_METADATA, record)
+
+            hdr, self.header_checksum_ok, self.global_checksum_ok = GameBoyROM.parse_header_record(record)
+            self.rom_title = hdr.rom_title
+            self.color = hdr.color
+            self.licensee_code = hdr.licensee_code
+            self.gb_type = hdr.gb_type
+            self.cart_type = hdr.cart_type
+            self.rom_banks = hdr.rom_banks
+            self.ram_banks = hdr.ram_banks
+            self.destination_code = hdr.destination_code
+            self.old_licensee_code = hdr.old_licensee_code
+            self.mask_rom_version = hdr.mask_rom_version
+            self.complement_check = hdr.complement_check
+            self.checksum = hdr.checksum
         except:
             log_error(traceback.format_exc())
             return False
 
+        if not self.header_checksum_ok:
+            log_warn('header checksum mismatch, real hardware would refuse to boot this ROM')
+        if not self.global_checksum_ok:
+            log_warn('global checksum mismatch')
+
         # Add ROM mappings
         # ROM0
         self.add_auto_segment(self.ROM0_OFFSET, self.ROM0_SIZE, self.ROM0_OFFSET,
                               self.ROM0_SIZE, SegmentFlag.SegmentReadable | SegmentFlag.SegmentExecutable)
         self.add_auto_section("ROM0", self.ROM0_OFFSET, self.ROM0_SIZE,
                               SectionSemantics.ReadOnlyCodeSectionSemantics)
-        # ROM1
-        self.add_auto_segment(self.ROM1_OFFSET, self.ROM1_SIZE, self.ROM1_OFFSET,
-                              self.ROM1_SIZE, SegmentFlag.SegmentReadable | SegmentFlag.SegmentExecutable)
-        self.add_auto_section("ROM1", self.ROM1_OFFSET, self.ROM1_SIZE,
-                              SectionSemantics.ReadWriteDataSectionSemantics)
+        # ROM1, whichever switchable bank was asked for
+        self.bank_count = self.bank_count_for_data(self.parent_view)
+        self.load_bank_switches()
+        self.rom_bank = None
+        bank = 1
+        load_settings = self.get_load_settings(self.name)
+        if load_settings is not None and load_settings.contains(self.ROM_BANK_SETTING):
+            bank = load_settings.get_integer(self.ROM_BANK_SETTING, self)
+        if self.bank_count > 1:
+            self.map_bank(min(max(bank, 1), self.bank_count - 1))
 
         # Add RAM mappings
         for _, address, length in self.RAM_SEGMENTS:
             self.add_auto_segment(address, length, 0, 0, SegmentFlag.SegmentReadable |
                                   SegmentFlag.SegmentWritable | SegmentFlag.SegmentExecutable)
 
-        # Add IO registers
-        for address, (name, long_name, description) in LR35902.IO_REGISTERS.items():
+        # Add IO registers, the documentation is only loaded once a view needs it
+        from .hardware_documentation import IO_REGISTERS
+        for address, (name, long_name, description) in IO_REGISTERS.items():
             self.define_auto_symbol_and_var_or_function(
                 Symbol(SymbolType.DataSymbol, address, name), Type.int(1))
             self.set_comment_at(address, long_name)
@@ -158,8 +156,160 @@ class GameBoyRomView(BinaryView):
                 Symbol(SymbolType.FunctionSymbol, address, name))
             #self.define_auto_symbol_and_var_or_function(Symbol(SymbolType.FunctionSymbol, address, name), Type.function(Type.void(), []))
 
+        self.annotate_far_calls(0)
+
+        # byte patches only invalidate what they touch
+        from .GameBoyInvalidation import PatchInvalidator
+        self.patch_invalidator = PatchInvalidator()
+        self.register_notification(self.patch_invalidator)
         return True
 
+    @contextlib.contextmanager
+    def rom_buffer(self):
+        """ the whole ROM as opened, for the first open's checksums and
+            index: its file mapped into memory if there is one as long as the
+            raw view, read from the raw view otherwise (a database moved
+            away from its ROM ...) """
+        import mmap
+        length = self.parent_view.length
+        try:
+            fp = open(self.file.original_filename, 'rb')
+        except (OSError, TypeError):
+            fp = None
+        if fp is not None:
+            with fp:
+                if length and os.fstat(fp.fileno()).st_size == length:
+                    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as rom:
+                        yield rom
+                    return
+        yield self.parent_view.read(0, length)
+
+    def load_bank_switches(self):
+        """ the GameBoyMBC.BankSwitchIndex of the whole ROM, built by one
+            sweep per bank the first time and kept in the metadata """
+        try:
+            record = self.query_metadata(self.BANK_SWITCH_METADATA)
+        except KeyError:
+            with self.rom_buffer() as rom:
+                index = GameBoyMBC.bank_switch_index(rom, self.bank_count)
+            record = GameBoyMBC.index_record(index)
+            self.store_metadata(self.BANK_SWITCH_METADATA, record)
+        self.bank_switches = GameBoyMBC.parse_index_record(record)
+
+    def reindex_bank_switches(self, bank):
+        """ sweeps a patched bank again, GameBoyMBC.reindex_bank() """
+        mapped = [b for b in (0, self.rom_bank) if b is not None]
+        for b in mapped:
+            self.annotate_far_calls(b, remove=True)
+        rom = self.parent_view.read(0, self.parent_view.length)
+        self.bank_switches = GameBoyMBC.reindex_bank(self.bank_switches, rom, bank, self.bank_count)
+        self.store_metadata(self.BANK_SWITCH_METADATA, GameBoyMBC.index_record(self.bank_switches))
+        for b in mapped:
+            self.annotate_far_calls(b)
+
+    def map_bank(self, bank):
+        """ maps ROM bank `bank` at ROM1_OFFSET straight from its file offset,
+            replacing the bank mapped there before """
+        if not 1 <= bank < self.bank_count:
+            raise ValueError('no ROM bank 0x%x, the ROM has 0x%x' % (bank, self.bank_count))
+        if bank == self.rom_bank:
+            return
+
+        if self.rom_bank is not None:
+            self.annotate_far_calls(self.rom_bank, remove=True)
+            self.stash_bank()
+            self.remove_auto_section(self.bank_section_name(self.rom_bank))
+            self.remove_auto_segment(self.ROM1_OFFSET, self.ROM1_SIZE)
+
+        offset = bank * self.BANK_SIZE
+        length = min(self.BANK_SIZE, self.parent_view.length - offset)
+        self.add_auto_segment(self.ROM1_OFFSET, self.ROM1_SIZE, offset,
+                              length, SegmentFlag.SegmentReadable | SegmentFlag.SegmentExecutable)
+        self.add_auto_section(self.bank_section_name(bank), self.ROM1_OFFSET, self.ROM1_SIZE,
+                              SectionSemantics.ReadWriteDataSectionSemantics)
+        self.rom_bank = bank
+        self.unstash_bank()
+        self.annotate_far_calls(bank)
+
+    def stash_bank(self):
+        """ moves the functions, symbols and comments at ROM1_OFFSET out of
+            the view into the metadata of the mapped bank, they'd end up on
+            the next bank's bytes otherwise """
+        start, end = self.ROM1_OFFSET, self.ROM1_OFFSET + self.ROM1_SIZE
+        funcs = [func for func in self.functions if start <= func.start < end]
+        symbols = [sym for sym in self.get_symbols(start, self.ROM1_SIZE)
+                   if sym.type in (SymbolType.FunctionSymbol, SymbolType.DataSymbol)]
+        comments = sorted((addr, comment) for addr, comment in self.address_comments.items() if start <= addr < end)
+        self.store_metadata(self.BANK_STASH_METADATA % self.rom_bank, json.dumps({
+            'functions': [[func.start, bool(func.auto)] for func in funcs],
+            'symbols': [[sym.address, sym.type.name, sym.name, bool(sym.auto)] for sym in symbols],
+            'comments': comments,
+        }))
+
+        for sym in symbols:
+            if sym.auto:
+                self.undefine_auto_symbol(sym)
+            else:
+                self.undefine_user_symbol(sym)
+        for func in funcs:
+            if func.auto:
+                self.remove_function(func)
+            else:
+                self.remove_user_function(func)
+        for addr, _ in comments:
+            self.set_comment_at(addr, '')
+
+    def unstash_bank(self):
+        """ puts back what stash_bank() took out of the view when the bank
+            now mapped was mapped before """
+        key = self.BANK_STASH_METADATA % self.rom_bank
+        try:
+            record = json.loads(self.query_metadata(key))
+        except KeyError:
+            return
+        self.remove_metadata(key)
+
+        for start, auto in record['functions']:
+            if auto:
+                self.add_function(start)
+            else:
+                self.create_user_function(start)
+        for addr, type_name, name, auto in record['symbols']:
+            sym = Symbol(SymbolType[type_name], addr, name)
+            if auto:
+                self.define_auto_symbol(sym)
+            else:
+                self.define_user_symbol(sym)
+        for addr, comment in record['comments']:
+            self.set_comment_at(addr, comment)
+
+    def far_call_target(self, addr):
+        """ (bank, address) the far call at addr resolves to, None if it
+            isn't one """
+        bank = 0 if addr < self.ROM1_OFFSET else self.rom_bank
+        return self.bank_switches.far_calls.get((bank, addr))
+
+    def annotate_far_calls(self, bank, remove=False):
+        """ comments the far calls of a bank with their targets, and makes
+            functions of the targets that are mapped """
+        for (site_bank, addr), (target_bank, target) in self.bank_switches.far_calls.items():
+            if site_bank != bank:
+                continue
+            if remove:
+                self.set_comment_at(addr, '')
+                continue
+            self.set_comment_at(addr, 'far call to %s' % self.far_address_text(target_bank, target))
+            if target < self.ROM1_OFFSET or target_bank == self.rom_bank:
+                self.add_function(target)
+
+    @staticmethod
+    def far_address_text(bank, addr):
+        return '%02X:%04X' % (bank, addr)
+
+    @staticmethod
+    def bank_section_name(bank):
+        return 'ROM%X' % bank
+
     def perform_is_valid_offset(self, addr):
         # valid ROM addresses are the upper-half of the address space
         if addr >= 0 and addr < 0x8000:
@@ -179,22 +329,178 @@ class GameBoyRomView(BinaryView):
         return self.START_ADDR
 
 
-#NUM_BANKS = 0x200
-NUM_BANKS = 1
+#------------------------------------------------------------------------------
+# FUNCTION SIGNATURES
+#------------------------------------------------------------------------------
+
+# GameBoySignatures (and the headless CFG recovery it builds on) is only
+# imported by the first signature command
+
+def function_signature(view, func):
+    """ GameBoySignatures.function_signature() of a function of view """
+    from . import GameBoySignatures
+    blocks = sorted(func.basic_blocks, key=lambda block: block.start)
+    return GameBoySignatures.function_signature([view.read(block.start, block.end - block.start) for block in blocks])
+
+def function_declaration(func):
+    """ C declaration of a function with a user type, None without """
+    if not func.has_user_type:
+        return None
+    return '%s %s%s' % (func.type.get_string_before_name(), func.name, func.type.get_string_after_name())
+
+def view_signatures(view):
+    """ SignatureDB of the functions the user named in view """
+    from . import GameBoySignatures
+    db = GameBoySignatures.SignatureDB()
+    for func in view.functions:
+        if not func.symbol.auto:
+            db.add(function_signature(view, func), func.name, function_declaration(func))
+    return db
+
+def database_signatures(path):
+    """ view_signatures() of a labelled Binary Ninja database """
+    import binaryninja
+    with binaryninja.load(path) as view:
+        return view_signatures(view)
+
+def apply_signatures(view, db):
+    """ names (and types) every function of view still under its default
+        name that matches db, in one batch; returns how many matched """
+    matches = []
+    for func in view.functions:
+        if not func.symbol.auto or func.name != 'sub_%x' % func.start:
+            continue
+        sig = db.lookup(function_signature(view, func))
+        if sig is not None:
+            matches.append((func, sig))
+
+    with view.bulk_modify_symbols():
+        for func, sig in matches:
+            view.define_auto_symbol(Symbol(SymbolType.FunctionSymbol, func.start, sig.name))
+    for func, sig in matches:
+        if sig.type is None:
+            continue
+        try:
+            func_type, _ = view.parse_type_string(sig.type)
+        except SyntaxError as e:
+            log_warn('signature %s: bad type %r (%s)' % (sig.name, sig.type, e))
+            continue
+        func.set_auto_type(func_type)
+    return len(matches)
+
+def apply_signatures_command(view):
+    from . import GameBoySignatures
+    path = get_open_filename_input('Signature database', '*.sig')
+    if not path:
+        return
+    try:
+        db = GameBoySignatures.SignatureDB.load(path)
+    except (OSError, ValueError) as e:
+        log_error(str(e))
+        return
+    log_info('%s: %d of %d signatures matched' % (path, apply_signatures(view, db), len(db)))
+
+def export_signatures_command(view):
+    from . import GameBoySignatures
+    path = get_save_filename_input('Signature database', 'sig')
+    if not path:
+        return
+    db = view_signatures(view)
+    try:
+        # exports of several labelled views add up
+        existing = GameBoySignatures.SignatureDB.load(path)
+        existing.merge(db)
+        db = existing
+    except OSError:
+        pass
+    except ValueError as e:
+        log_error(str(e))
+        return
+    db.save(path)
+    log_info('%s: %d signatures' % (path, len(db)))
+
+#------------------------------------------------------------------------------
+# TRACING
+#------------------------------------------------------------------------------
+
+# GameBoyEmulator is only imported by the first trace command, the last
+# trace's Emulator is kept in the view's session data for the console
+
+TRACE_SESSION_KEY = 'gameboy_trace'
+
+def apply_trace(view, emulator):
+    """ adds the jp hl targets emulator saw to the user indirect branches of
+        the functions holding the jump, those with the site and target in
+        ROM0 or the bank mapped in view; returns how many sites """
+    targets = {}
+    for bank, site, target in emulator.indirect_branches():
+        banked = [addr for addr in (site, target) if view.ROM1_OFFSET <= addr < view.ROM1_OFFSET + view.ROM1_SIZE]
+        if banked and bank != view.rom_bank:
+            continue
+        targets.setdefault(site, set()).add(target)
+
+    for site, found in targets.items():
+        for func in view.get_functions_containing(site):
+            known = set(branch.dest_addr for branch in func.get_indirect_branches_at(site) if not branch.auto_defined)
+            func.set_user_indirect_branches(site, [(func.arch, target) for target in sorted(known | found)])
+    view.session_data[TRACE_SESSION_KEY] = emulator
+    return len(targets)
+
+def trace(view, start=None):
+    """ runs the ROM of view from the boot ROM's hand-off, or from a call to
+        start, for as many cycles as asked for and applies the trace """
+    from . import GameBoyEmulator
+    cycles = get_int_input('Cycles to run (%d a second)' % GameBoyEmulator.CPU_HZ, 'Trace')
+    if cycles is None:
+        return
+    rom = view.parent_view.read(0, view.parent_view.length)
+    emulator = GameBoyEmulator.Emulator(rom, bank=view.rom_bank or 1)
+    if start is not None:
+        emulator.call(start)
+    try:
+        emulator.run(cycles)
+        stopped = 'ran %d cycles' % emulator.cycles
+    except GameBoyEmulator.TraceStop as e:
+        stopped = str(e)
+    sites = apply_trace(view, emulator)
+    log_info('trace from 0x%04x: %d instructions, %d addresses executed, %d indirect branch sites, %s' % (
+        view.START_ADDR if start is None else start, emulator.instructions, len(emulator.visited_addresses()), sites, stopped))
 
-banks = []
+#------------------------------------------------------------------------------
+# COMMANDS
+#------------------------------------------------------------------------------
 
+def map_bank_command(view):
+    bank = get_int_input('ROM bank to map at 0x4000 (1-0x%x)' % (view.bank_count - 1), 'Map ROM bank')
+    if bank is None:
+        return
+    try:
+        view.map_bank(bank)
+    except ValueError as e:
+        log_error(str(e))
 
-def register_views():
-    for bank_number in range(NUM_BANKS):
+def follow_far_call_command(view, addr):
+    bank, target = view.far_call_target(addr)
+    if target >= view.ROM1_OFFSET:
+        view.map_bank(bank)
+    view.navigate(view.view, target)
 
-        class GameboyRomViewBank(GameboyRomView):
-            bank = bank_number
-            name = f"Gameboy Bank {bank_number:X}"
-            long_name = f"Gameboy ROM (bank {bank_number:X})"
+def trace_command(view):
+    trace(view)
 
-            def __init__(self, data):
-                GameboyRomView.__init__(self, data)
+def trace_function_command(view, func):
+    trace(view, func.start)
 
-        banks.append(GameboyRomViewBank)
-        GameboyRomViewBank.register()
+def register_commands():
+    PluginCommand.register('GameBoy\\Map ROM bank...', 'Map another switchable ROM bank at 0x4000',
+        map_bank_command, lambda view: isinstance(view, GameBoyRomView) and view.bank_count > 2)
+    PluginCommand.register_for_address('GameBoy\\Follow far call', 'Map the bank a far call goes to and navigate to its target',
+        follow_far_call_command, lambda view, addr: isinstance(view, GameBoyRomView) and view.far_call_target(addr) is not None)
+    PluginCommand.register('GameBoy\\Apply function signatures...', 'Name the functions matching a signature database',
+        apply_signatures_command, lambda view: isinstance(view, GameBoyRomView))
+    PluginCommand.register('GameBoy\\Export function signatures...', 'Add the functions named in this view to a signature database',
+        export_signatures_command, lambda view: isinstance(view, GameBoyRomView))
+    PluginCommand.register('GameBoy\\Trace from _start...', 'Emulate the ROM from the entry point, record the indirect branches taken',
+        trace_command, lambda view: isinstance(view, GameBoyRomView))
+    PluginCommand.register_for_function('GameBoy\\Trace function...', 'Emulate a call to this function, record the indirect branches taken',
+        trace_function_command, lambda view, func: isinstance(view, GameBoyRomView))
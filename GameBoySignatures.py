@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+#
+# function signatures of common runtime routines (GBDK, RGBDS libraries ...),
+# main exports:
+# function_signature()
+# SignatureDB
+#
+# a signature is a 64-bit hash of a function's bytes, its basic blocks in
+# address order, with the 16-bit immediates (absolute addresses, pointers)
+# zeroed using the operand layouts of the decoder tables. The same routine
+# linked at another address has the same signature, 8-bit immediates (loop
+# counts, IO register offsets) and relative jumps are kept as they are part
+# of what the routine does.
+#
+# databases are built from ROMs with RGBDS/BGB .sym files next to them, or
+# from labelled Binary Ninja databases (.bndb, needs Binary Ninja):
+#
+#   python -m LR35902.GameBoySignatures build labelled/ -o gbdk.sig
+#   python -m LR35902.GameBoySignatures match gbdk.sig game.gb
+#
+# and applied to a view by GameBoy > Apply function signatures.
+
+import os
+import sys
+import struct
+import hashlib
+import argparse
+from collections import namedtuple
+
+from .GameBoyROM import BANK_SIZE, ROM_EXTENSIONS, bank_base, find_files
+from .GameBoyCFG import recover_cfg
+from .LR35902Decoder import INSTR_LEN, OPCODE_LEN, OPCODE_OPERANDS, SRC_IMM16, opcode_index
+
+# shorter functions (ret, jp hl stubs ...) match too much to be named
+MIN_SIGNATURE_BYTES = 8
+
+SYM_EXTENSIONS = ('.sym',)
+DATABASE_EXTENSIONS = ('.bndb',)
+
+#------------------------------------------------------------------------------
+# SIGNATURES
+#------------------------------------------------------------------------------
+
+def _masked_operands(layout):
+    """ (start, end) of the operand bytes an instruction's signature leaves
+        out, from its OPCODE_OPERANDS layout """
+    if layout is None or not any(src == SRC_IMM16 for _, src, _ in layout):
+        return None
+    return (1, 3)
+
+# indexed by opcode_index()
+OPCODE_MASK = [_masked_operands(layout) for layout in OPCODE_OPERANDS]
+
+def masked_bytes(data):
+    """ data (whole instructions) with the operand bytes in OPCODE_MASK
+        zeroed, undecodable bytes are kept """
+    out = bytearray(data)
+    offset = 0
+    end = len(data)
+    while offset < end:
+        if offset + INSTR_LEN[data[offset]] > end:
+            break
+        opcode = opcode_index(data[offset:offset+2])
+        mask = OPCODE_MASK[opcode]
+        if mask is not None:
+            out[offset+mask[0]:offset+mask[1]] = b'\0' * (mask[1] - mask[0])
+        offset += OPCODE_LEN[opcode] or 1
+    return bytes(out)
+
+def function_signature(blocks):
+    """ (hash, length) of a function from the bytes of its basic blocks in
+        address order, None if it's too short to tell apart """
+    masked = b''.join(masked_bytes(data) for data in blocks)
+    if len(masked) < MIN_SIGNATURE_BYTES:
+        return None
+    key = int.from_bytes(hashlib.blake2b(masked, digest_size=8).digest(), 'big')
+    return key, len(masked)
+
+#------------------------------------------------------------------------------
+# DATABASE
+#------------------------------------------------------------------------------
+
+# type is a C declaration for the function, e.g. 'void memcpy(void* dst,
+# void const* src, uint16_t n)', or None
+Signature = namedtuple('Signature', ['name', 'type', 'length'])
+
+# file: header, entries sorted by hash, string table of NUL terminated UTF-8
+# names and types (offset 0 being the empty string, no type). The hashes
+# dropped as ambiguous are entries with the name _AMBIGUOUS (version 2,
+# version 1 files have none)
+_MAGIC = b'GBSG'
+_VERSION = 2
+_VERSIONS = (1, 2)
+_AMBIGUOUS = 0xFFFFFFFF
+_HEADER = struct.Struct('>4sHI')
+_ENTRY = struct.Struct('>QHII')
+
+class SignatureDB(object):
+    """ {hash: Signature}, hashes seen with different names are dropped """
+
+    def __init__(self):
+        self.entries = {}
+        self.ambiguous = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, signature, name, type=None):
+        """ signature being a function_signature() """
+        if signature is None:
+            return
+        key, length = signature
+        if key in self.ambiguous:
+            return
+        known = self.entries.get(key)
+        if known is None:
+            self.entries[key] = Signature(name, type, length)
+        elif known.name != name:
+            # the same code under two names (or a collision), can't tell which
+            del self.entries[key]
+            self.ambiguous.add(key)
+        elif known.type is None and type is not None:
+            self.entries[key] = known._replace(type=type)
+
+    def merge(self, other):
+        for key, sig in other.entries.items():
+            self.add((key, sig.length), sig.name, sig.type)
+        for key in other.ambiguous:
+            self.entries.pop(key, None)
+            self.ambiguous.add(key)
+
+    def lookup(self, signature):
+        if signature is None:
+            return None
+        sig = self.entries.get(signature[0])
+        if sig is None or sig.length != signature[1]:
+            return None
+        return sig
+
+    def save(self, path):
+        strings = bytearray(b'\0')
+        offsets = {'': 0}
+        def string_offset(s):
+            if s is None:
+                s = ''
+            if s not in offsets:
+                offsets[s] = len(strings)
+                strings.extend(s.encode('utf-8') + b'\0')
+            return offsets[s]
+
+        entries = dict(
+            (key, _ENTRY.pack(key, sig.length, string_offset(sig.name), string_offset(sig.type)))
+            for key, sig in self.entries.items()
+        )
+        for key in self.ambiguous:
+            entries[key] = _ENTRY.pack(key, 0, _AMBIGUOUS, 0)
+        entries = [entry for _, entry in sorted(entries.items())]
+        with open(path, 'wb') as fp:
+            fp.write(_HEADER.pack(_MAGIC, _VERSION, len(entries)))
+            fp.write(b''.join(entries))
+            fp.write(strings)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        if len(data) < _HEADER.size:
+            raise ValueError('%s is not a signature database' % path)
+        magic, version, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version not in _VERSIONS:
+            raise ValueError('%s is not a signature database' % path)
+        table = _HEADER.size + count * _ENTRY.size
+        if len(data) < table:
+            raise ValueError('%s is truncated' % path)
+
+        def string_at(offset):
+            start = table + offset
+            end = data.find(b'\0', start)
+            if end < 0:
+                raise ValueError('%s is truncated' % path)
+            return data[start:end].decode('utf-8')
+
+        db = cls()
+        for key, length, name, type in _ENTRY.iter_unpack(data[_HEADER.size:table]):
+            if name == _AMBIGUOUS:
+                db.ambiguous.add(key)
+            else:
+                db.entries[key] = Signature(string_at(name), string_at(type) or None, length)
+        return db
+
+#------------------------------------------------------------------------------
+# BUILDING FROM .SYM FILES
+#------------------------------------------------------------------------------
+
+def parse_sym(path):
+    """ {(bank, addr): name} of the global labels of an RGBDS/BGB .sym file """
+    labels = {}
+    with open(path, encoding='utf-8', errors='replace') as fp:
+        for line in fp:
+            line = line.split(';', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                location, name = line.split(None, 1)
+                bank, addr = (int(part, 16) for part in location.split(':'))
+            except ValueError:
+                continue
+            # local labels (Function.loop) aren't function starts
+            if '.' in name or addr >= 0x8000:
+                continue
+            labels.setdefault((bank, addr), name.strip())
+    return labels
+
+def rom_signatures(rom_path, labels, jobs=None):
+    """ SignatureDB of the labelled functions GameBoyCFG recovers from the
+        ROM at rom_path, labels being parse_sym(). Labels aren't seeded,
+        most of them are data """
+    functions, _ = recover_cfg(rom_path, jobs)
+    with open(rom_path, 'rb') as fp:
+        rom = fp.read()
+
+    db = SignatureDB()
+    for (bank, addr), func in functions.items():
+        name = labels.get((bank, addr))
+        if name is None or func['speculative'] or not func['valid']:
+            continue
+        offset = bank * BANK_SIZE - bank_base(bank)
+        blocks = [rom[offset+start:offset+end] for start, end in sorted(func['blocks'])]
+        db.add(function_signature(blocks), name)
+    return db
+
+def build(paths, jobs=None):
+    """ SignatureDB of every labelled ROM (a .sym next to it) and, with
+        Binary Ninja, every labelled database under paths """
+    db = SignatureDB()
+    for sym in find_files(paths, SYM_EXTENSIONS):
+        stem = os.path.splitext(sym)[0]
+        rom = next((stem + ext for ext in ROM_EXTENSIONS if os.path.exists(stem + ext)), None)
+        if rom is None:
+            sys.stderr.write('%s: no ROM next to it, skipped\n' % sym)
+            continue
+        db.merge(rom_signatures(rom, parse_sym(sym), jobs))
+
+    databases = list(find_files(paths, DATABASE_EXTENSIONS))
+    if databases:
+        from .GameBoyROMView import database_signatures
+        for path in databases:
+            db.merge(database_signatures(path))
+    return db
+
+#------------------------------------------------------------------------------
+# MAIN
+#------------------------------------------------------------------------------
+
+def match(db, rom_path, jobs=None):
+    """ yields (bank, addr, Signature) of the functions of a ROM matching db """
+    functions, _ = recover_cfg(rom_path, jobs)
+    with open(rom_path, 'rb') as fp:
+        rom = fp.read()
+    for (bank, addr), func in sorted(functions.items()):
+        # far call targets guessed into every bank, like rom_signatures()
+        if func['speculative'] or not func['valid']:
+            continue
+        offset = bank * BANK_SIZE - bank_base(bank)
+        sig = db.lookup(function_signature([rom[offset+start:offset+end] for start, end in sorted(func['blocks'])]))
+        if sig is not None:
+            yield bank, addr, sig
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='GameBoySignatures', description='build and match function signatures')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='build a database from labelled ROMs/databases')
+    build_parser.add_argument('paths', nargs='+', metavar='PATH', help='.sym (next to its ROM), .bndb or directory')
+    build_parser.add_argument('-o', '--output', required=True, help='signature database to write')
+    build_parser.add_argument('--merge', action='store_true', help='add to the output database instead of replacing it')
+    match_parser = commands.add_parser('match', help='list the functions of ROMs matching a database')
+    match_parser.add_argument('database')
+    match_parser.add_argument('roms', nargs='+', metavar='ROM')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        db = build(args.paths, args.jobs)
+        if args.merge and os.path.exists(args.output):
+            existing = SignatureDB.load(args.output)
+            existing.merge(db)
+            db = existing
+        db.save(args.output)
+        sys.stderr.write('%s: %d signatures (%d ambiguous dropped)\n' % (args.output, len(db), len(db.ambiguous)))
+    else:
+        db = SignatureDB.load(args.database)
+        for rom in args.roms:
+            for bank, addr, sig in match(db, rom, args.jobs):
+                print('%s %02X:%04X %s' % (rom, bank, addr, sig.name))
+
+if __name__ == '__main__':
+    sys.exit(main())
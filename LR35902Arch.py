@@ -1,22 +1,34 @@
 #!/usr/bin/env python
 
-import re
-
-from binaryninja.log import log_info
-from binaryninja.architecture import Architecture
+from binaryninja.architecture import Architecture, IntrinsicInfo
 from binaryninja.function import RegisterInfo, InstructionInfo, InstructionTextToken
 from binaryninja.enums import InstructionTextTokenType, BranchType, FlagRole, LowLevelILFlagCondition
 
-from . import LR35902IL
+from . import LR35902Text
+from .LR35902Decoder import DECODE_CACHE, OPCODE_COUNT, opcode_index
+from .LR35902Decoder import INSTR_LEN, OPCODE_LEN, OPCODE_BRANCH, branch_target
+from .LR35902Decoder import FLAG_WRITE_TYPES
+from .LR35902Decoder import BRANCH_NONE, BRANCH_JUMP, BRANCH_JUMP_COND, BRANCH_INDIRECT, BRANCH_CALL, BRANCH_RETURN
+from .LR35902Text import instruction_template
+from .LR35902Flow import walk_blocks, view_rst_conventions, view_jump_tables, view_walked_functions
+
+from lr35902dis.lr35902 import DECODE_STATUS
 
-from .hardware_documentation import IO_REGISTERS as IO_REGS
+# the lifter and its per-opcode tables aren't needed until the first function
+# is lifted, keep them out of Binja's startup
+_lifter = None
 
-from lr35902dis.lr35902 import *
+def lifter():
+    global _lifter
+    if _lifter is None:
+        from . import LR35902IL
+        _lifter = LR35902IL
+    return _lifter
 
-CC_TO_STR = {
-    CC.ALWAYS:'1', CC.NOT_Z:'nz', CC.Z:'z',
-    CC.NOT_C:'nc', CC.C:'c'
-}
+def make_token(tok):
+    """ LR35902Text (kind, text, value) tuple -> InstructionTextToken """
+    (kind, text, value) = tok
+    return InstructionTextToken(InstructionTextTokenType[kind], text, value)
 
 class LR35902(Architecture):
     name = 'LR35902'
@@ -57,7 +69,13 @@ class LR35902(Architecture):
 
     stack_pointer = "SP"
 
-    IO_REGISTERS = IO_REGS
+    # ei, di, halt, stop, see LR35902IL.CONTROL_INTRINSICS
+    intrinsics = {
+        'enable_interrupts': IntrinsicInfo([], []),
+        'disable_interrupts': IntrinsicInfo([], []),
+        'halt': IntrinsicInfo([], []),
+        'stop': IntrinsicInfo([], []),
+    }
 
 #------------------------------------------------------------------------------
 # FLAG fun
@@ -69,14 +87,8 @@ class LR35902(Architecture):
     semantic_flag_classes = ['class_bitstuff']
 
     # flag write types and their mappings
-    flag_write_types = ['dummy', '*', 'c', 'z', 'not_c']
-    flags_written_by_flag_write_type = {
-        'dummy': [],
-        '*': ['z', 'h', 'n', 'c'],
-        'c': ['c'],
-        'z': ['z'],
-        'not_c': ['z', 'h', 'n'] # eg: LR35902's DEC
-    }
+    flag_write_types = list(FLAG_WRITE_TYPES)
+    flags_written_by_flag_write_type = dict(FLAG_WRITE_TYPES)
     semantic_class_for_flag_write_type = {
         # by default, everything is type None (integer)
 #        '*': 'class_integer',
@@ -86,16 +98,19 @@ class LR35902(Architecture):
 #        'not_c': 'class_integer'
     }
 
-    # groups and their mappings
-    semantic_flag_groups = ['group_e', 'group_ne', 'group_lt']
+    # groups and their mappings, see LR35902IL.jcc_to_flag_cond()
+    semantic_flag_groups = ['group_e', 'group_ne', 'group_ult', 'group_uge']
     flags_required_for_semantic_flag_group = {
-        'group_lt': ['c'],
         'group_e': ['z'],
-        'group_ne': ['z']
+        'group_ne': ['z'],
+        'group_ult': ['c'],
+        'group_uge': ['c']
     }
     flag_conditions_for_semantic_flag_group = {
-        #'group_e': {None: LowLevelILFlagCondition.LLFC_E},
-        #'group_ne': {None: LowLevelILFlagCondition.LLFC_NE}
+        'group_e': {None: LowLevelILFlagCondition.LLFC_E},
+        'group_ne': {None: LowLevelILFlagCondition.LLFC_NE},
+        'group_ult': {None: LowLevelILFlagCondition.LLFC_ULT},
+        'group_uge': {None: LowLevelILFlagCondition.LLFC_UGE}
     }
 
     # roles
@@ -106,122 +121,202 @@ class LR35902(Architecture):
         'c': FlagRole.CarryFlagRole
     }
 
-    # MAP (condition x class) -> flags
-    def get_flags_required_for_flag_condition(self, cond, sem_class):
-        #LogDebug('incoming cond: %s, incoming sem_class: %s' % (str(cond), str(sem_class)))
-
-        if sem_class == None:
-            lookup = {
-                # Z, zero flag for == and !=
-                LowLevelILFlagCondition.LLFC_E: ['z'],
-                LowLevelILFlagCondition.LLFC_NE: ['z'],
-                # Z, zero flag for == and !=
-                LowLevelILFlagCondition.LLFC_E: ['z'],
-                LowLevelILFlagCondition.LLFC_NE: ['z'],
-                # H, half carry for ???
-                # P, parity for ???
-                # s> s>= s< s<= done by sub and overflow test
-                #if cond == LowLevelILFlagCondition.LLFC_SGT:
-                #if cond == LowLevelILFlagCondition.LLFC_SGE:
-                #if cond == LowLevelILFlagCondition.LLFC_SLT:
-                #if cond == LowLevelILFlagCondition.LLFC_SLE:
-
-                # C, for these
-                LowLevelILFlagCondition.LLFC_UGE: ['c'],
-                LowLevelILFlagCondition.LLFC_ULT: ['c']
-            }
-
-            if cond in lookup:
-                return lookup[cond]
+    # MAP (condition x class) -> flags, only the integer class (None)
+    # H, half carry and N aren't tested by any condition
+    # s> s>= s< s<= would need an overflow flag
+    flags_required_for_flag_condition = {
+        # Z, zero flag for == and !=
+        LowLevelILFlagCondition.LLFC_E: ['z'],
+        LowLevelILFlagCondition.LLFC_NE: ['z'],
+        # C, for these
+        LowLevelILFlagCondition.LLFC_UGE: ['c'],
+        LowLevelILFlagCondition.LLFC_ULT: ['c']
+    }
 
+    def get_flags_required_for_flag_condition(self, cond, sem_class):
+        if sem_class is None:
+            return self.flags_required_for_flag_condition.get(cond, [])
         return []
 
 #------------------------------------------------------------------------------
 # CFG building
 #------------------------------------------------------------------------------
 
-    def get_instruction_info(self, data, addr):
-        decoded = decode(data, addr)
+    # InstructionInfo of non-branching instructions by length; shared, Binja
+    # only reads them
+    _non_branch_info = {}
+
+    def non_branch_info(self, length):
+        info = self._non_branch_info.get(length)
+        if info is None:
+            info = InstructionInfo()
+            info.length = length
+            self._non_branch_info[length] = info
+        return info
 
-        # on error, return nothing
-        if decoded.status == DECODE_STATUS.ERROR or decoded.len == 0:
+    def get_instruction_info(self, data, addr):
+        if not data:
             return None
 
-        # on non-branching, return length
+        # truncated, whatever lr35902dis makes of it can't be a branch
+        if len(data) < INSTR_LEN[data[0]]:
+            decoded = DECODE_CACHE.decode(data, addr)
+            if decoded.status == DECODE_STATUS.ERROR or decoded.len == 0:
+                return None
+            return self.non_branch_info(decoded.len)
+
+        # length and branch kind come straight from the opcode tables, only
+        # branches need an InstructionInfo of their own
+        opcode = opcode_index(data)
+        length = OPCODE_LEN[opcode]
+        kind = OPCODE_BRANCH[opcode]
+        if kind == BRANCH_NONE:
+            return self.non_branch_info(length)
+
         result = InstructionInfo()
-        result.length = decoded.len
-        if decoded.typ != INSTRTYPE.JUMP_CALL_RETURN:
-            return result
-
-        # jp has several variations
-        if decoded.op == OP.JP:
-            (oper_type, oper_val) = decoded.operands[0]
-
-            # jp pe,0xDEAD
-            if oper_type == OPER_TYPE.COND:
-                assert decoded.operands[1][0] == OPER_TYPE.ADDR
-                result.add_branch(BranchType.TrueBranch, decoded.operands[1][1])
-                result.add_branch(BranchType.FalseBranch, addr + decoded.len)
-            # jp hl
-            elif oper_type in [OPER_TYPE.REG]:
-                result.add_branch(BranchType.IndirectBranch)
-            # jp 0xDEAD
-            elif oper_type == OPER_TYPE.ADDR:
-                result.add_branch(BranchType.UnconditionalBranch, oper_val)
-            else:
-                print(f"Missed JP handling type: {decoded}")
-                raise Exception('handling JP')
-
-        # jr can be conditional
-        elif decoded.op == OP.JR:
-            (oper_type, oper_val) = decoded.operands[0]
-
-            # jr c,0xdf07
-            if oper_type == OPER_TYPE.COND:
-                assert decoded.operands[1][0] == OPER_TYPE.ADDR
-                result.add_branch(BranchType.TrueBranch, decoded.operands[1][1])
-                result.add_branch(BranchType.FalseBranch, addr + decoded.len)
-            # jr 0xdf07
-            elif oper_type == OPER_TYPE.ADDR:
-                result.add_branch(BranchType.UnconditionalBranch, oper_val)
-            else:
-                raise Exception('handling JR')
-
-        # call can be conditional
-        elif decoded.op == OP.CALL:
-            (oper_type, oper_val) = decoded.operands[0]
-            # call c,0xdf07
-            if oper_type == OPER_TYPE.COND:
-                assert decoded.operands[1][0] == OPER_TYPE.ADDR
-                result.add_branch(BranchType.CallDestination, decoded.operands[1][1])
-            # call 0xdf07
-            elif oper_type == OPER_TYPE.ADDR:
-                result.add_branch(BranchType.CallDestination, oper_val)
-            else:
-                raise Exception('handling CALL')
-
-        # ret can be conditional
-        elif decoded.op == OP.RET:
-            if decoded.operands and decoded.operands[0][0] == OPER_TYPE.COND:
-                # conditional returns dont' end block
-                pass
-            else:
-                result.add_branch(BranchType.FunctionReturn)
-
-        # ret from interrupts
-        elif decoded.op == OP.RETI:
+        result.length = length
+
+        # jp 0xDEAD, jr 0xdf07
+        if kind == BRANCH_JUMP:
+            result.add_branch(BranchType.UnconditionalBranch, branch_target(opcode, data, addr))
+        # jp pe,0xDEAD, jr c,0xdf07
+        elif kind == BRANCH_JUMP_COND:
+            result.add_branch(BranchType.TrueBranch, branch_target(opcode, data, addr))
+            result.add_branch(BranchType.FalseBranch, addr + length)
+        # jp hl
+        elif kind == BRANCH_INDIRECT:
+            result.add_branch(BranchType.IndirectBranch)
+        # call 0xdf07, call c,0xdf07, rst 0x38
+        elif kind == BRANCH_CALL:
+            result.add_branch(BranchType.CallDestination, branch_target(opcode, data, addr))
+        # ret, reti
+        elif kind == BRANCH_RETURN:
             result.add_branch(BranchType.FunctionReturn)
+        # conditional returns don't end the block
 
         return result
 
+    # basic block analysis of a whole function in one call: walk_blocks() goes
+    # over the bytes of the segment it lives in with the same tables as
+    # get_instruction_info(), instead of the core calling back into Python
+    # (and allocating an InstructionInfo) for every instruction. Only guided
+    # analysis, builds without create_basic_block, invalid code and functions
+    # over the size limit are left to Binja's own analysis, which doesn't
+    # know the rst conventions: LifterContext lifts their rst's as plain calls.
+    def analyze_basic_blocks(self, func, context):
+        walk = self.walk_function(func, context)
+        walked = view_walked_functions(func.view)
+        if walk is None:
+            walked.discard(func.start)
+            return Architecture.analyze_basic_blocks(self, func, context)
+        walked.add(func.start)
+
+        view = func.view
+        for start, end, edges in walk['blocks']:
+            block = context.create_basic_block(self, start)
+            block.add_instruction_data(view.read(start, end - start))
+            block.end = end
+            for kind, target, fallthrough in edges:
+                block.add_pending_outgoing_edge(BranchType[kind], target or 0, self, fallthrough)
+            context.add_basic_block(block)
+
+        # have the function reanalyzed if a callee turns out not to return
+        for callee in walk['callees']:
+            context.add_temp_outgoing_reference(callee)
+
+        context.finalize()
+
+    def walk_function(self, func, context):
+        """ walk_blocks() of func, None if it needs Binja's analysis """
+        if not hasattr(context, 'create_basic_block') or getattr(context, 'guided_analysis_mode', False):
+            return None
+
+        view = func.view
+        segment = view.get_segment_at(func.start)
+        if segment is None:
+            return None
+        data = view.read(segment.start, segment.end - segment.start)
+        rst = view_rst_conventions(view)
+        translate_tail_calls = getattr(context, 'translate_tail_calls', False)
+
+        # walked again until the callees that don't return, the jumps that
+        # are tail calls and the jp hl with targets known to the function
+        # (dataflow, user) are all taken into account
+        noreturn = set()
+        tail_calls = set()
+        indirect_targets = {}
+        while True:
+            walk = walk_blocks(data, segment.start, func.start, rst, noreturn, tail_calls, indirect_targets)
+            callees = {}
+            for _, target in walk['calls']:
+                callee = view.get_function_at(target)
+                if callee is not None:
+                    callees[target] = callee
+            found_noreturn = set(target for target, callee in callees.items() if not callee.can_return) - noreturn
+            found_tail_calls = set()
+            if translate_tail_calls:
+                for _, _, edges in walk['blocks']:
+                    for kind, target, fallthrough in edges:
+                        if kind == 'UnconditionalBranch' and not fallthrough and target != func.start and \
+                                view.get_function_at(target) is not None:
+                            found_tail_calls.add(target)
+            found_targets = {}
+            for addr in walk['indirect']:
+                targets = sorted(set(branch.dest_addr for branch in func.get_indirect_branches_at(addr)))
+                if targets:
+                    found_targets[addr] = targets
+            if not found_noreturn and not found_tail_calls and not found_targets:
+                break
+            noreturn |= found_noreturn
+            tail_calls |= found_tail_calls
+            indirect_targets.update(found_targets)
+
+        self.set_jump_table_branches(func, walk['jump_tables'])
+        # a patch of a table has to reanalyze the function, see GameBoyInvalidation
+        if walk['tables']:
+            view_jump_tables(view)[func.start] = sorted(walk['tables'].values())
+        else:
+            view_jump_tables(view).pop(func.start, None)
+
+        if not walk['valid']:
+            return None
+        max_size = getattr(context, 'max_function_size', 0)
+        if max_size and sum(end - start for start, end, _ in walk['blocks']) > max_size:
+            return None
+
+        # code outside of the segment (bank switching ...) and jp hl without
+        # known targets are unresolved branches of the function
+        blocks = []
+        for start, end, edges in walk['blocks']:
+            edges = tuple(
+                ('UnresolvedBranch', None, False)
+                if (kind == 'IndirectBranch' and target is None) or
+                   (target is not None and not segment.start <= target < segment.end)
+                else (kind, target, fallthrough)
+                for kind, target, fallthrough in edges)
+            blocks.append((start, end, edges))
+        walk['blocks'] = blocks
+        walk['callees'] = list(callees.values()) + [func for func in map(view.get_function_at, tail_calls) if func is not None]
+        return walk
+
+    def set_jump_table_branches(self, func, jump_tables):
+        """ the jump tables walk_blocks() read become the auto indirect
+            branches of their jp hl/rst, LLIL's jump turns into a jump_to """
+        for addr, targets in jump_tables.items():
+            known = set(branch.dest_addr for branch in func.get_indirect_branches_at(addr))
+            if known != set(targets):
+                func.set_auto_indirect_branches(addr, [(self, target) for target in targets], self)
+
 #------------------------------------------------------------------------------
 # STRING building, disassembly
 #------------------------------------------------------------------------------
 
     def reg2str(self, reg):
-        reg_name = reg.name if isinstance(reg, REG) else reg
-        # enum AF_ should be returned as AF'
-        return reg_name if reg_name[-1] != '_' else reg_name[:-1]+"'"
+        return LR35902Text.reg2str(reg)
+
+    # opcode index -> instruction_template() with the fixed tokens already
+    # turned into InstructionTextTokens, filled in on first use
+    _text_templates = [None] * OPCODE_COUNT
 
 # from api/python/function.py:
 #
@@ -234,119 +329,28 @@ class LR35902(Architecture):
 #        BeginMemoryOperandToken    The start of memory operand
 #        EndMemoryOperandToken      The end of a memory operand
 #        FloatingPointToken         Floating point number
+#        DataSymbolToken            IO registers, named by LR35902Text.io_register_name()
     def get_instruction_text(self, data, addr):
-        decoded = decode(data, addr)
+        decoded = DECODE_CACHE.decode(data, addr)
         if decoded.status != DECODE_STATUS.OK or decoded.len == 0:
             return None
 
-        result = []
+        opcode = opcode_index(data)
+        template = self._text_templates[opcode]
+        if template is None:
+            template = tuple(
+                ([make_token(tok) for tok in fixed], slot)
+                for fixed, slot in instruction_template(opcode)
+            )
+            self._text_templates[opcode] = template
 
-        # opcode
-        result.append(InstructionTextToken( \
-            InstructionTextTokenType.InstructionToken, decoded.op.name))
-
-        # space for operand
-        if decoded.operands:
-            result.append(InstructionTextToken(InstructionTextTokenType.TextToken, ' '))
-
-        # operands
-        for i, operand in enumerate(decoded.operands):
-            (oper_type, oper_val) = operand
-
-            if oper_type == OPER_TYPE.REG:
-                result.append(InstructionTextToken( \
-                    InstructionTextTokenType.RegisterToken, self.reg2str(oper_val)))
-
-            elif oper_type == OPER_TYPE.REG_DEREF:
-                toks = [
-                    (InstructionTextTokenType.BeginMemoryOperandToken, '('),
-                    (InstructionTextTokenType.RegisterToken, self.reg2str(oper_val)),
-                    (InstructionTextTokenType.EndMemoryOperandToken, ')'),
-                ]
-                result.extend([InstructionTextToken(*ts) for ts in toks])
-
-            elif oper_type in {OPER_TYPE.REG_DEREF_DEC, OPER_TYPE.REG_DEREF_INC}:
-                update = '-' if oper_type == OPER_TYPE.REG_DEREF_DEC else '+'
-
-                toks = [
-                    (InstructionTextTokenType.BeginMemoryOperandToken, '('),
-                    (InstructionTextTokenType.RegisterToken, self.reg2str(oper_val)),
-                    (InstructionTextTokenType.TextToken, update),
-                    (InstructionTextTokenType.EndMemoryOperandToken, ')'),
-                ]
-                result.extend([InstructionTextToken(*ts) for ts in toks])
-
-            elif oper_type in {OPER_TYPE.REG_DEREF_FF00}:
-                toks = [
-                    (InstructionTextTokenType.BeginMemoryOperandToken, '('),
-                    (InstructionTextTokenType.PossibleAddressToken, '0xFF00', 0xFF00),
-                    (InstructionTextTokenType.TextToken, '+'),
-                    (InstructionTextTokenType.RegisterToken, self.reg2str(oper_val)),
-                    (InstructionTextTokenType.EndMemoryOperandToken, ')'),
-                ]
-                result.extend([InstructionTextToken(*ts) for ts in toks])
-
-            elif oper_type == OPER_TYPE.ADDR:
-                oper_val = oper_val & 0xFFFF
-                txt = '0x%04x' % oper_val
-                result.append(InstructionTextToken( \
-                    InstructionTextTokenType.PossibleAddressToken, txt, oper_val))
-
-            elif oper_type == OPER_TYPE.ADDR_DEREF:
-                txt = '0x%04x' % oper_val
-                toks = [
-                    (InstructionTextTokenType.BeginMemoryOperandToken, '('),
-                    (InstructionTextTokenType.PossibleAddressToken, txt, oper_val),
-                    (InstructionTextTokenType.EndMemoryOperandToken, ')'),
-                ]
-                result.extend([InstructionTextToken(*ts) for ts in toks])
-
-            elif oper_type == OPER_TYPE.ADDR_DEREF_FF00:
-                val = 0xFF00 + (oper_val & 0xff)
-                txt = '0x{:04x}'.format(val)
-                toks = [
-                    (InstructionTextTokenType.BeginMemoryOperandToken, '('),
-                    (InstructionTextTokenType.PossibleAddressToken, txt, val),
-                    (InstructionTextTokenType.EndMemoryOperandToken, ')'),
-                ]
-                result.extend([InstructionTextToken(*ts) for ts in toks])
-
-            elif oper_type == OPER_TYPE.IMM:
-                if oper_val == 0:
-                    txt = '0'
-                elif oper_val >= 16:
-                    txt = '0x%x' % oper_val
-                else:
-                    txt = '%d' % oper_val
-
-                result.append(InstructionTextToken( \
-                    InstructionTextTokenType.IntegerToken, txt, oper_val))
-
-            elif oper_type == OPER_TYPE.COND:
-                txt = CC_TO_STR[oper_val]
-                result.append(InstructionTextToken( \
-                    InstructionTextTokenType.TextToken, txt))
-
-            elif oper_type == OPER_TYPE.SP_OFFSET:
-                offset = '{:+02x}'.format(oper_val)
-                sign, offset = offset[0], offset[1:]
-
-                toks = [
-                    (InstructionTextTokenType.BeginMemoryOperandToken, '('),
-                    (InstructionTextTokenType.RegisterToken, 'SP'),
-                    (InstructionTextTokenType.TextToken, sign),
-                    (InstructionTextTokenType.IntegerToken, offset, abs(oper_val)),
-                    (InstructionTextTokenType.EndMemoryOperandToken, ')'),
-                ]
-                result.extend([InstructionTextToken(*ts) for ts in toks])
-
-            else:
-                raise Exception('unknown operand type: ' + str(oper_type))
-
-            # if this isn't the last operand, add comma
-            if i < len(decoded.operands)-1:
-                result.append(InstructionTextToken( \
-                    InstructionTextTokenType.OperandSeparatorToken, ','))
+        result = []
+        for fixed, slot in template:
+            result.extend(fixed)
+            # immediates and addresses
+            if slot:
+                (i, fmt) = slot
+                result.extend([make_token(tok) for tok in fmt(decoded.operands[i][1])])
 
         return result, decoded.len
 
@@ -355,18 +359,18 @@ class LR35902(Architecture):
 #------------------------------------------------------------------------------
 
     def get_flag_write_low_level_il(self, op, size, write_type, flag, operands, il):
-        flag_il = LR35902IL.gen_flag_il(op, size, write_type, flag, operands, il)
+        flag_il = lifter().gen_flag_il(op, size, write_type, flag, operands, il)
         if flag_il:
             return flag_il
 
         return Architecture.get_flag_write_low_level_il(self, op, size, write_type, flag, operands, il)
 
     def get_instruction_low_level_il(self, data, addr, il):
-        decoded = decode(data, addr)
+        decoded = DECODE_CACHE.decode(data, addr)
         if decoded.status != DECODE_STATUS.OK or decoded.len == 0:
             return None
 
-        LR35902IL.gen_instr_il(addr, decoded, il)
+        lifter().gen_instr_il(addr, decoded, il, opcode_index(data))
 
         return decoded.len
 
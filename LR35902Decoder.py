@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# decoding shared by the Architecture callbacks, main exports:
+# DECODE_CACHE.decode()
+# decode_fast()
+#
+# get_instruction_info(), get_instruction_text() and
+# get_instruction_low_level_il() are all handed the same bytes for the same
+# address, so the lr35902dis result is memoized here instead of decoding every
+# instruction three (or more, on re-analysis) times.
+
+import threading
+from collections import OrderedDict
+
+from lr35902dis.lr35902 import decode as lr35902_decode, Decoded, DECODE_STATUS, OP, OPER_TYPE, int8
+
+#------------------------------------------------------------------------------
+# OPCODE INDEXING
+#------------------------------------------------------------------------------
+
+# per-opcode tables have 512 entries: 0x00-0xFF for the base opcodes and
+# 0x100-0x1FF for the CB-prefixed ones
+OPCODE_COUNT = 0x200
+
+def opcode_index(data):
+    """ index of the (at least 2 bytes for 0xCB) instruction in data into
+        the per-opcode tables """
+    if data[0] == 0xCB:
+        return 0x100 | data[1]
+    return data[0]
+
+def opcode_bytes(opcode):
+    """ zero-operand encoding of a per-opcode table index, long enough to
+        decode any instruction """
+    if opcode & 0x100:
+        return bytes([0xCB, opcode & 0xFF, 0, 0])
+    return bytes([opcode, 0, 0, 0])
+
+#------------------------------------------------------------------------------
+# LOOKUP TABLES
+#------------------------------------------------------------------------------
+
+# an 8 MB MBC5 ROM is 512 banks of 16 KB; most of its instructions are
+# repeated encodings (ld a,(hl+), ret, jp 0x1234 to a common helper ...), the
+# distinct ones being mostly 16-bit immediates and per-address jr's. 128k
+# entries holds the working set of the whole ROM at roughly 50 MB worst case.
+DECODE_CACHE_SIZE = 0x20000
+
+#------------------------------------------------------------------------------
+# TABLE DECODER
+#------------------------------------------------------------------------------
+
+# branch kinds, all get_instruction_info() needs to know about control flow
+BRANCH_NONE = 0
+BRANCH_JUMP = 1         # jp nn, jr e
+BRANCH_JUMP_COND = 2    # jp cc,nn, jr cc,e
+BRANCH_INDIRECT = 3     # jp hl
+BRANCH_CALL = 4         # call nn, call cc,nn, rst n
+BRANCH_RETURN = 5       # ret, reti
+BRANCH_RETURN_COND = 6  # ret cc (doesn't end the block)
+
+# where an operand's value comes from
+SRC_FIXED = 0           # implied by the opcode
+SRC_IMM8 = 1            # data[1]
+SRC_SIMM8 = 2           # data[1], signed
+SRC_REL8 = 3            # addr + 2 + data[1] signed (jr)
+SRC_IMM16 = 4           # data[1:3], little endian
+
+def operand_value(src, data, addr):
+    if src == SRC_IMM8:
+        return data[1]
+    if src == SRC_SIMM8:
+        return int8(data[1])
+    if src == SRC_REL8:
+        return addr + 2 + int8(data[1])
+    return data[1] | (data[2] << 8)
+
+# two probes with operand bytes and addresses chosen so that every SRC_*
+# yields a different value
+_PROBES = ((b'\x81\x42\x00', 0x1000), (b'\x05\x07\x00', 0x2000))
+
+def _operand_src(vals):
+    if vals[0] == vals[1]:
+        return SRC_FIXED
+    for src in (SRC_IMM8, SRC_SIMM8, SRC_REL8, SRC_IMM16):
+        if all(operand_value(src, b'\x00' + data, addr) == val
+               for (data, addr), val in zip(_PROBES, vals)):
+            return src
+    raise Exception('no operand source matches: %s' % str(vals))
+
+def _branch_kind(decoded):
+    if decoded.op in (OP.JP, OP.JR):
+        if decoded.operands[0][0] == OPER_TYPE.COND:
+            return BRANCH_JUMP_COND
+        if decoded.operands[0][0] == OPER_TYPE.REG:
+            return BRANCH_INDIRECT
+        return BRANCH_JUMP
+    if decoded.op in (OP.CALL, OP.RST):
+        return BRANCH_CALL
+    if decoded.op == OP.RET:
+        return BRANCH_RETURN_COND if decoded.operands else BRANCH_RETURN
+    if decoded.op == OP.RETI:
+        return BRANCH_RETURN
+    return BRANCH_NONE
+
+def _build_tables():
+    lengths, ops, types, branches, targets, layouts = [], [], [], [], [], []
+    for opcode in range(OPCODE_COUNT):
+        encoding = opcode_bytes(opcode)[:2 if opcode & 0x100 else 1]
+        probes = [lr35902_decode(encoding + data, addr) for data, addr in _PROBES]
+        decoded = probes[0]
+
+        lengths.append(decoded.len)
+        if decoded.status != DECODE_STATUS.OK or opcode == 0xCB:
+            # invalid opcodes are left to lr35902dis, 0xCB itself is the
+            # prefix of the upper half of the table
+            ops.append(None)
+            types.append(None)
+            branches.append(BRANCH_NONE)
+            targets.append(None)
+            layouts.append(None)
+            continue
+
+        layout = []
+        for i, (oper_type, oper_val) in enumerate(decoded.operands):
+            src = _operand_src([p.operands[i][1] for p in probes])
+            layout.append((oper_type, src, oper_val if src == SRC_FIXED else None))
+
+        ops.append(decoded.op)
+        types.append(decoded.typ)
+        branches.append(_branch_kind(decoded))
+        targets.append(layout[-1][1] if branches[-1] in (BRANCH_JUMP, BRANCH_JUMP_COND, BRANCH_CALL) else None)
+        layouts.append(tuple(layout))
+
+    return lengths, ops, types, branches, targets, layouts
+
+# all indexed by opcode_index(), derived from lr35902dis once at import:
+# OPCODE_LEN        instruction length
+# OPCODE_OP         OP, None for invalid opcodes
+# OPCODE_TYPE       INSTRTYPE
+# OPCODE_BRANCH     BRANCH_*
+# OPCODE_TARGET     SRC_* of the branch target, for direct jumps and calls
+# OPCODE_OPERANDS   tuple of (OPER_TYPE, SRC_*, value if SRC_FIXED)
+(OPCODE_LEN, OPCODE_OP, OPCODE_TYPE, OPCODE_BRANCH, OPCODE_TARGET,
+    OPCODE_OPERANDS) = _build_tables()
+
+# instruction length by first byte, the operand bytes never change the length
+# (0xCB is always followed by exactly one more opcode byte)
+INSTR_LEN = OPCODE_LEN[:256]
+
+# opcodes whose decoded operands depend on the address (jr's target is
+# computed by lr35902dis), these are cached per address
+PC_RELATIVE = frozenset(opc for opc in range(256) if OPCODE_OP[opc] == OP.JR)
+
+# call target of rst n by opcode, the eight restart vectors 0x00-0x38
+RESTART_VECTORS = [
+    layout[0][2] if op == OP.RST else None
+    for op, layout in zip(OPCODE_OP, OPCODE_OPERANDS)
+]
+
+# flags written by each flag write type of the lifter's expressions, for
+# LR35902Arch and the headless IL interpreter (OfflineILInterpreter)
+FLAG_WRITE_TYPES = OrderedDict([
+    ('dummy', []),
+    ('*', ['z', 'h', 'n', 'c']),
+    ('c', ['c']),
+    ('z', ['z']),
+    ('not_c', ['z', 'h', 'n']), # eg: LR35902's DEC
+    ('not_z', ['h', 'n', 'c']), # eg: LR35902's ADD HL,rr
+])
+
+def branch_target(opcode, data, addr):
+    """ target of a BRANCH_JUMP, BRANCH_JUMP_COND or BRANCH_CALL """
+    src = OPCODE_TARGET[opcode]
+    if src == SRC_FIXED:
+        return RESTART_VECTORS[opcode]
+    return operand_value(src, data, addr)
+
+def decode_fast(data, addr):
+    """ lr35902dis decode() equivalent driven by the opcode tables, only
+        truncated and invalid encodings go to lr35902dis """
+    if not data or len(data) < INSTR_LEN[data[0]]:
+        return lr35902_decode(data, addr)
+
+    opcode = opcode_index(data)
+    layout = OPCODE_OPERANDS[opcode]
+    if layout is None:
+        return lr35902_decode(data, addr)
+
+    result = Decoded(addr)
+    result.status = DECODE_STATUS.OK
+    result.len = OPCODE_LEN[opcode]
+    result.typ = OPCODE_TYPE[opcode]
+    result.op = OPCODE_OP[opcode]
+    result.operands = [
+        (oper_type, val if src == SRC_FIXED else operand_value(src, data, addr))
+        for (oper_type, src, val) in layout
+    ]
+    return result
+
+#------------------------------------------------------------------------------
+# DECODE CACHE
+#------------------------------------------------------------------------------
+
+class DecodeCache(object):
+    """ bounded, thread-safe LRU of lr35902dis decode() results
+
+        the cached Decoded objects are shared between callers and must be
+        treated as read-only """
+
+    def __init__(self, maxsize=DECODE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def decode(self, data, addr):
+        if not data:
+            return lr35902_decode(data, addr)
+
+        length = INSTR_LEN[data[0]]
+        if len(data) < length:
+            # truncated, let lr35902dis produce the error result uncached
+            return lr35902_decode(data, addr)
+
+        instr = bytes(data[:length])
+        key = (instr, addr) if data[0] in PC_RELATIVE else instr
+
+        with self._lock:
+            decoded = self._entries.get(key)
+            if decoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return decoded
+            self.misses += 1
+
+        # decode outside the lock, analysis threads shouldn't serialize on it
+        decoded = decode_fast(instr, addr)
+
+        with self._lock:
+            self._entries[key] = decoded
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return decoded
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+# one cache for all three callbacks
+DECODE_CACHE = DecodeCache()
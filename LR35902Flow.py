@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+#
+# control flow recovery without Binary Ninja, main exports:
+# walk_blocks()
+# resolve_jp_hl()
+# rst_conventions()
+#
+# jp hl is how GameBoy game engines dispatch through tables of 16-bit code
+# pointers. The common idioms are recognized by their bytes and the tables
+# read straight from the ROM, so jp hl gets its targets during the initial
+# analysis instead of after rounds of dataflow:
+#
+#   ld hl,table         ; or ld de,table / add hl,de, ld bc,table / add hl,bc
+#   add hl,de           ; or add a,l / ld l,a / jr nc,@+3 / inc h
+#   ld a,(hl+)          ; or ld e,(hl) / inc hl / ld d,(hl) / ld h,d / ld l,e
+#   ld h,(hl)
+#   ld l,a
+#   jp hl
+#
+# and rst helpers doing the same with the table right after the rst, the
+# index in a:
+#
+#   rst 0x00            ; 0x0000: add a,a
+#   dw case_0           ;         pop hl
+#   dw case_1           ;         ld e,a / ld d,0 / add hl,de
+#   ...                 ;         ld a,(hl+) / ld h,(hl) / ld l,a
+#                       ;         jp hl
+#
+# rst helpers taking inline arguments are recognized too, the code continues
+# after their arguments:
+#
+#   rst 0x10            ; 0x0010: pop hl
+#   db 0x05             ;         ld a,(hl+)
+#   dw far_function     ;         ld e,(hl+) ...
+#   ...                 ;         push hl
+#
+# in Binja both rst conventions only hold in the functions whose blocks
+# walk_blocks() built (view_walked_functions()), the ones Binja's own block
+# analysis is left with see every rst as a plain call
+
+import re
+from collections import namedtuple
+
+from lr35902dis.lr35902 import OP, OPER_TYPE, REG
+
+from .LR35902Decoder import INSTR_LEN, OPCODE_LEN, OPCODE_OP, OPCODE_BRANCH, OPCODE_OPERANDS, branch_target, opcode_index
+from .LR35902Decoder import RESTART_VECTORS
+from .LR35902Decoder import BRANCH_NONE, BRANCH_JUMP, BRANCH_JUMP_COND, BRANCH_INDIRECT, BRANCH_CALL, BRANCH_RETURN_COND
+
+#------------------------------------------------------------------------------
+# JUMP TABLES
+#------------------------------------------------------------------------------
+
+# cases of a dispatch on a (doubled) 8-bit index
+MAX_TABLE_ENTRIES = 128
+
+# how far before a jp hl its idiom can start
+MAX_IDIOM_LENGTH = 16
+
+RST_VECTORS = tuple(range(0x00, 0x40, 0x08))
+
+# how far into an inline argument helper its arguments are looked for
+MAX_HELPER_INSTRUCTIONS = 32
+
+# BinaryView.session_data key of view_rst_conventions()
+RST_SESSION_KEY = 'lr35902.rst_conventions'
+# BinaryView.session_data key of view_jump_tables()
+TABLES_SESSION_KEY = 'lr35902.jump_tables'
+# BinaryView.session_data key of view_walked_functions()
+WALKED_SESSION_KEY = 'lr35902.walked_functions'
+
+# hl = table + index
+_TABLE_INDEX = (
+    rb'\x21(..)[\x19\x09]',                 # ld hl,table / add hl,de|bc
+    rb'\x11(..)\x19',                       # ld de,table / add hl,de
+    rb'\x01(..)\x09',                       # ld bc,table / add hl,bc
+    rb'\x21(..)\x85\x6F\x30\x01\x24',       # ld hl,table / add a,l / ld l,a / jr nc,@+3 / inc h
+    rb'\x21(..)\x85\x6F\x7C\xCE\x00\x67',   # ld hl,table / add a,l / ld l,a / ld a,h / adc a,0 / ld h,a
+)
+
+# hl = (hl)
+_LOAD_POINTER = (
+    rb'\x2A\x66\x6F'                        # ld a,(hl+) / ld h,(hl) / ld l,a
+    rb'|\x5E\x23\x56\x62\x6B'               # ld e,(hl) / inc hl / ld d,(hl) / ld h,d / ld l,e
+)
+
+_JP_HL_DISPATCH = [
+    re.compile(index + rb'(?:' + _LOAD_POINTER + rb')\xE9\Z', re.S)
+    for index in _TABLE_INDEX
+]
+
+# hl = return address (the table) + index
+_DOUBLE = rb'(\x87|\xCB\x27|\x07)?'         # add a,a / sla a / rlca
+_POP_INDEX = (
+    rb'(?:\x5F\x16\x00\x19'                 # ld e,a / ld d,0 / add hl,de
+    rb'|\x4F\x06\x00\x09'                   # ld c,a / ld b,0 / add hl,bc
+    rb'|\x85\x6F\x30\x01\x24'               # add a,l / ld l,a / jr nc,@+3 / inc h
+    rb'|\x85\x6F\x7C\xCE\x00\x67)'          # add a,l / ld l,a / ld a,h / adc a,0 / ld h,a
+)
+
+_RST_HELPER = re.compile(
+    _DOUBLE + rb'\xE1' + _DOUBLE + _POP_INDEX + rb'(?:' + _LOAD_POINTER + rb')\xE9', re.S)
+
+def _is_code(data, base, target):
+    """ whether a table entry could be a code pointer """
+    if target == 0 or target >= 0x8000:
+        return False
+    # another bank, can't tell
+    if not base <= target < base + len(data):
+        return True
+    chunk = data[target-base:target-base+4]
+    return len(chunk) >= INSTR_LEN[chunk[0]] and OPCODE_OP[opcode_index(chunk)] is not None
+
+def read_jump_table(data, base, table):
+    """ the code pointers of the table at table, up to the first entry that
+        isn't one or the code following the table """
+    targets = []
+    end = base + len(data)
+    addr = table
+    while len(targets) < MAX_TABLE_ENTRIES and base <= addr and addr + 2 <= end:
+        target = data[addr-base] | (data[addr-base+1] << 8)
+        if table <= target < addr + 2 or not _is_code(data, base, target):
+            break
+        targets.append(target)
+        # the first case right after the table ends it
+        if table < target < end:
+            end = min(end, target)
+        addr += 2
+    return targets
+
+def resolve_jp_hl(data, base, addr):
+    """ (table, targets) of the dispatch ending in the jp hl at addr, None if
+        it isn't one of the idioms """
+    offset = addr - base
+    window = data[max(0, offset - MAX_IDIOM_LENGTH):offset + 1]
+    for pattern in _JP_HL_DISPATCH:
+        match = pattern.search(window)
+        if match:
+            table = match.group(1)[0] | (match.group(1)[1] << 8)
+            targets = read_jump_table(data, base, table)
+            if targets:
+                return table, targets
+    return None
+
+def _rst_helper(data, base, vector):
+    """ address of the code an rst vector runs, following a jp there """
+    code = data[vector-base:vector-base+3]
+    if len(code) == 3 and code[0] == 0xC3:
+        return code[1] | (code[2] << 8)
+    return vector
+
+def jump_table_helpers(data, base=0):
+    """ {vector: scale} of the rst vectors holding (or jumping to) a jump
+        table helper; the helper multiplies a by scale for the table index.
+        data has to hold ROM0 """
+    helpers = {}
+    for vector in RST_VECTORS:
+        addr = _rst_helper(data, base, vector)
+        if not base <= addr < base + len(data):
+            continue
+        match = _RST_HELPER.match(data, addr - base)
+        if match:
+            helpers[vector] = 2 if match.group(1) or match.group(2) else 1
+    return helpers
+
+# how instructions move hl through a helper's inline arguments
+_HL_STEP = {
+    0x22: 1, 0x2A: 1,       # ld (hl+),a / ld a,(hl+)
+    0x32: -1, 0x3A: -1,     # ld (hl-),a / ld a,(hl-)
+    0x23: 1, 0x2B: -1,      # inc hl / dec hl
+}
+
+def _writes_hl(opcode):
+    layout = OPCODE_OPERANDS[opcode]
+    return (bool(layout) and layout[0][0] == OPER_TYPE.REG and layout[0][2] in (REG.H, REG.L, REG.HL)
+            and OPCODE_OP[opcode] not in (OP.PUSH, OP.JP, OP.BIT))
+
+def inline_arguments(data, base, addr):
+    """ bytes of inline arguments the helper at addr takes: it pops its
+        return address into hl, steps hl over them and returns through
+        push hl (or jp hl). None if it doesn't look like one """
+    offset = None
+    for _ in range(MAX_HELPER_INSTRUCTIONS):
+        chunk = data[addr-base:addr-base+4]
+        if not chunk or len(chunk) < INSTR_LEN[chunk[0]]:
+            return None
+        opcode = opcode_index(chunk)
+        op = OPCODE_OP[opcode]
+        if op is None:
+            return None
+
+        if opcode == 0xE1:
+            # pop hl, the return address
+            if offset is not None:
+                return None
+            offset = 0
+        elif op in (OP.PUSH, OP.POP) and offset is None:
+            # the pop wouldn't get the return address
+            return None
+        elif opcode == 0xE5 or opcode == 0xE9:
+            # push hl / jp hl, back to the caller past the arguments
+            return offset or None
+        elif offset is not None and opcode in _HL_STEP:
+            offset += _HL_STEP[opcode]
+        elif OPCODE_BRANCH[opcode] != BRANCH_NONE:
+            return None
+        elif offset is not None and _writes_hl(opcode):
+            return None
+        addr += OPCODE_LEN[opcode]
+    return None
+
+def inline_argument_helpers(data, base=0):
+    """ {vector: argument bytes} of the rst vectors holding (or jumping to)
+        a helper taking inline arguments. data has to hold ROM0 """
+    helpers = {}
+    for vector in RST_VECTORS:
+        addr = _rst_helper(data, base, vector)
+        if base <= addr < base + len(data):
+            count = inline_arguments(data, base, addr)
+            if count:
+                helpers[vector] = count
+    return helpers
+
+# how a ROM uses its rst vectors:
+# jump_tables   {vector: scale} of jump_table_helpers()
+# inline_args   {vector: argument bytes} of inline_argument_helpers()
+RstConventions = namedtuple('RstConventions', ['jump_tables', 'inline_args'])
+
+NO_RST_CONVENTIONS = RstConventions({}, {})
+
+def rst_conventions(data, base=0):
+    """ RstConventions of a ROM, data has to hold ROM0 """
+    return RstConventions(jump_table_helpers(data, base), inline_argument_helpers(data, base))
+
+def view_rst_conventions(view):
+    """ rst_conventions() of a BinaryView, found once per view """
+    rst = view.session_data.get(RST_SESSION_KEY)
+    if rst is None:
+        rst = rst_conventions(view.read(0, 0x4000))
+        view.session_data[RST_SESSION_KEY] = rst
+    return rst
+
+def view_jump_tables(view):
+    """ {function start: [(start, end)]} of the jump table bytes each
+        function's analysis read, outside of its basic blocks """
+    tables = view.session_data.get(TABLES_SESSION_KEY)
+    if tables is None:
+        tables = {}
+        view.session_data[TABLES_SESSION_KEY] = tables
+    return tables
+
+def view_walked_functions(view):
+    """ starts of the functions whose basic blocks came from walk_blocks()
+        (LR35902.analyze_basic_blocks), the only ones skipping the bytes
+        after an rst: Binja's own analysis takes every rst for a call
+        returning right after it """
+    walked = view.session_data.get(WALKED_SESSION_KEY)
+    if walked is None:
+        walked = set()
+        view.session_data[WALKED_SESSION_KEY] = walked
+    return walked
+
+#------------------------------------------------------------------------------
+# BLOCK WALKER
+#------------------------------------------------------------------------------
+
+# outgoing edges are (kind, target, fallthrough), kind being the name of the
+# BranchType member it becomes in Binja; target is None for unresolved jp hl
+# and returns
+def _block_edges(kind, opcode, chunk, addr, length):
+    if kind == BRANCH_JUMP:
+        return (('UnconditionalBranch', branch_target(opcode, chunk, addr) & 0xFFFF, False),)
+    if kind == BRANCH_JUMP_COND:
+        return (('TrueBranch', branch_target(opcode, chunk, addr) & 0xFFFF, False),
+                ('FalseBranch', addr + length, False))
+    if kind == BRANCH_INDIRECT:
+        return (('IndirectBranch', None, False),)
+    return (('FunctionReturn', None, False),)
+
+def _table_edges(targets):
+    return tuple(('IndirectBranch', target, False) for target in targets)
+
+def walk_blocks(data, base, start, rst=NO_RST_CONVENTIONS, noreturn=(), tail_calls=(), indirect_targets=None):
+    """ recursive descent of the function at start over data (mapped at
+        base) in one go, following the same control flow as
+        get_instruction_info() plus the jump tables of jp hl, and rst's
+        according to the RstConventions rst. Unconditional calls to the
+        addresses in noreturn and jumps to those in tail_calls end their block without
+        a successor, jp hl's missing from the tables go to their targets in
+        indirect_targets ({addr: targets}) if they're there
+
+        returns a dict of
+          blocks        sorted (start, end, edges) of its basic blocks
+          calls         (addr, target) of its calls
+          exits         addresses outside of data that it flows into
+          indirect      addresses of its unresolved jp hl's (not in
+                        indirect_targets)
+          jump_tables   {addr: targets} of its resolved jp hl's and rst's
+          tables        {addr: (start, end)} of the bytes of those tables
+          valid         whether all of its code decoded """
+    end = base + len(data)
+    insns = {}
+    edges = {}
+    leaders = {start}
+    calls = []
+    exits = []
+    indirect = []
+    jump_tables = {}
+    tables = {}
+    valid = True
+    indirect_targets = indirect_targets or {}
+
+    worklist = [start]
+    while worklist:
+        addr = worklist.pop()
+        while True:
+            if addr in insns:
+                # joined code walked before, the block ends here
+                leaders.add(addr)
+                break
+            if not base <= addr < end:
+                exits.append(addr & 0xFFFF)
+                break
+
+            chunk = data[addr-base:addr-base+4]
+            if len(chunk) < INSTR_LEN[chunk[0]]:
+                valid = False
+                break
+            opcode = opcode_index(chunk)
+            if OPCODE_OP[opcode] is None:
+                valid = False
+                break
+
+            length = OPCODE_LEN[opcode]
+            insns[addr] = length
+            kind = OPCODE_BRANCH[opcode]
+
+            vector = RESTART_VECTORS[opcode]
+            if vector in rst.jump_tables:
+                targets = read_jump_table(data, base, addr + length)
+                if targets:
+                    jump_tables[addr] = targets
+                    tables[addr] = (addr + length, addr + length + 2 * len(targets))
+                    edges[addr] = _table_edges(targets)
+            elif vector in rst.inline_args:
+                # a call, returning past its arguments
+                calls.append((addr, vector))
+                edges[addr] = () if vector in noreturn else \
+                    (('UnconditionalBranch', addr + length + rst.inline_args[vector], False),)
+            elif kind == BRANCH_NONE or kind == BRANCH_RETURN_COND:
+                addr += length
+                continue
+            elif kind == BRANCH_CALL:
+                target = branch_target(opcode, chunk, addr) & 0xFFFF
+                calls.append((addr, target))
+                # call cc,nn to a function not returning still falls through
+                if target in noreturn and (opcode == 0xCD or vector is not None):
+                    edges[addr] = ()
+                else:
+                    addr += length
+                    continue
+            elif kind == BRANCH_INDIRECT:
+                resolved = resolve_jp_hl(data, base, addr)
+                if resolved:
+                    jump_tables[addr] = resolved[1]
+                    tables[addr] = (resolved[0], resolved[0] + 2 * len(resolved[1]))
+                    edges[addr] = _table_edges(resolved[1])
+                elif addr in indirect_targets:
+                    edges[addr] = _table_edges(indirect_targets[addr])
+                else:
+                    indirect.append(addr)
+                    edges[addr] = _block_edges(kind, opcode, chunk, addr, length)
+            elif kind == BRANCH_JUMP and branch_target(opcode, chunk, addr) & 0xFFFF in tail_calls:
+                edges[addr] = ()
+            else:
+                edges[addr] = _block_edges(kind, opcode, chunk, addr, length)
+
+            if addr not in edges:
+                # rst to a helper without a readable table, a plain call
+                calls.append((addr, vector))
+                if vector not in noreturn:
+                    addr += length
+                    continue
+                edges[addr] = ()
+            for _, target, _ in edges[addr]:
+                if target is not None:
+                    leaders.add(target)
+                    worklist.append(target)
+            break
+
+    blocks = []
+    for block_start in sorted(leaders):
+        addr = block_start
+        while addr in insns:
+            following = addr + insns[addr]
+            if addr in edges:
+                blocks.append((block_start, following, edges[addr]))
+                break
+            if following in leaders:
+                blocks.append((block_start, following, (('UnconditionalBranch', following, True),)))
+                break
+            if following not in insns:
+                # ran off the end of data or into an invalid instruction
+                tail = () if base <= following < end else (('UnconditionalBranch', following & 0xFFFF, True),)
+                blocks.append((block_start, following, tail))
+                break
+            addr = following
+
+    return {
+        'blocks': blocks,
+        'calls': calls,
+        'exits': exits,
+        'indirect': indirect,
+        'jump_tables': jump_tables,
+        'tables': tables,
+        'valid': valid,
+    }
@@ -4,16 +4,22 @@
 # gen_flag_il()
 # gen_instr_il()
 
-# Binja includes
-from tempfile import tempdir
-from binaryninja.log import log_info
-from binaryninja.architecture import Architecture
-from binaryninja.enums import LowLevelILOperation, LowLevelILFlagCondition
-from binaryninja.function import RegisterInfo, InstructionInfo, InstructionTextToken
-from binaryninja.lowlevelil import LowLevelILLabel, ILRegister, ILFlag, LLIL_TEMP, LLIL_GET_TEMP_REG_INDEX
+import threading
+
+# Binja includes, or the OfflineIL stand-ins when lifting outside of Binja
+try:
+    from binaryninja.architecture import Architecture
+    from binaryninja.enums import LowLevelILOperation
+    from binaryninja.lowlevelil import LowLevelILLabel, ILRegister, ILFlag, LLIL_TEMP
+except ImportError:
+    from .OfflineIL import Architecture, LowLevelILOperation
+    from .OfflineIL import LowLevelILLabel, ILRegister, ILFlag, LLIL_TEMP
 
 # decode/disassemble
-from lr35902dis.lr35902 import *
+from lr35902dis.lr35902 import decode, reg2str, OP, OPER_TYPE, REG, CC
+
+from .LR35902Decoder import OPCODE_COUNT, opcode_bytes
+from .LR35902Flow import NO_RST_CONVENTIONS, view_rst_conventions, view_walked_functions
 
 #------------------------------------------------------------------------------
 # LOOKUP TABLES
@@ -41,27 +47,82 @@ CC_UN_NOT = {
 # HELPERS
 #------------------------------------------------------------------------------
 
+#------------------------------------------------------------------------------
+# LIFTER CONTEXT
+#------------------------------------------------------------------------------
+
+class LifterContext(object):
+    """ state of the lifting of one instruction, the architecture handle
+        being kept from one to the next """
+    __slots__ = ('il', 'arch', 'labels')
+
+    def __init__(self):
+        self.il = None
+        self.arch = Architecture['LR35902']
+        # addr -> LowLevelILLabel, only labels that exist are remembered: one
+        # may still be added for an address that had none
+        self.labels = {}
+
+    def reset(self, il):
+        self.il = il
+        self.labels.clear()
+
+    @property
+    def rst(self):
+        """ how the view's rst vectors are used (LR35902Flow.RstConventions),
+            none if Binja's own analysis built the function's blocks: that
+            has every rst return right after it, see view_walked_functions() """
+        source = getattr(self.il, 'source_function', None)
+        if source is None or source.start not in view_walked_functions(source.view):
+            return NO_RST_CONVENTIONS
+        return view_rst_conventions(source.view)
+
+    def label(self, addr):
+        """ il.get_label_for_address(), memoized """
+        label = self.labels.get(addr)
+        if label is None:
+            label = self.il.get_label_for_address(self.arch, addr)
+            if label is not None:
+                self.labels[addr] = label
+        return label
+
+# Binja lifts functions on several threads, each gets its own context. Nothing
+# from il is kept past the callback: the handle of a freed LowLevelILFunction
+# can come back for another one, its labels would be those of a dead function.
+_local = threading.local()
+
+def lifter_context(il):
+    """ the thread's LifterContext, reset for lifting into il """
+    ctx = getattr(_local, 'context', None)
+    if ctx is None:
+        ctx = LifterContext()
+        _local.context = ctx
+    ctx.reset(il)
+    return ctx
+
 def jcc_to_flag_cond(cond, il):
     if cond == CC.ALWAYS:
         return il.const(1,1)
 
+    # semantic flag groups, so a cp/sub right before the branch can be
+    # turned into a comparison of its operands
     # {'z', 'nz'} == {'zero', 'not zero'}
     if cond == CC.Z:
-        return il.flag_condition(LowLevelILFlagCondition.LLFC_E)
+        return il.flag_group('group_e')
     if cond == CC.NOT_Z:
-        return il.flag_condition(LowLevelILFlagCondition.LLFC_NE)
+        return il.flag_group('group_ne')
 
-    # {'c', 'nc'} == {'carry', 'not carry'}
+    # {'c', 'nc'} == {'carry', 'not carry'}, carry is the borrow of a sub
     if cond == CC.C:
-        return il.flag('c')
+        return il.flag_group('group_ult')
     if cond == CC.NOT_C:
-        return il.not_expr(0, il.flag('c'))
+        return il.flag_group('group_uge')
 
     raise Exception('unknown cond: ' + str(cond))
 
-def goto_or_jump(target_type, target_val, il):
+def goto_or_jump(target_type, target_val, il, ctx):
     if target_type == OPER_TYPE.ADDR:
-        tmp = il.get_label_for_address(Architecture['LR35902'], target_val)
+        tmp = ctx.label(target_val)
         if tmp:
             return il.goto(tmp)
         else:
@@ -86,16 +147,16 @@ def append_conditional_instr(cond, instr, il):
         il.append(instr)
         il.mark_label(f)
 
-def append_conditional_jump(cond, target_type, target_val, addr_fallthru, il):
+def append_conditional_jump(cond, target_type, target_val, addr_fallthru, il, ctx):
     # case: condition always
     if cond == CC.ALWAYS:
-        il.append(goto_or_jump(target_type, target_val, il))
+        il.append(goto_or_jump(target_type, target_val, il, ctx))
         return
 
     # case: condition and label available
     if target_type == OPER_TYPE.ADDR:
-        t = il.get_label_for_address(Architecture['LR35902'], target_val)
-        f = il.get_label_for_address(Architecture['LR35902'], addr_fallthru)
+        t = ctx.label(target_val)
+        f = ctx.label(addr_fallthru)
         if t and f:
             #if cond in CC_UN_NOT:
             #    ant = jcc_to_flag_cond(CC_UN_NOT[cond], il)
@@ -106,7 +167,7 @@ def append_conditional_jump(cond, target_type, target_val, addr_fallthru, il):
             return
 
     # case: conditional and address available
-    tmp = goto_or_jump(target_type, target_val, il)
+    tmp = goto_or_jump(target_type, target_val, il, ctx)
     append_conditional_instr(cond, tmp, il)
 
 def operand_to_il(oper_type, oper_val, il, size_hint=0, peel_load=False):
@@ -146,8 +207,7 @@ def operand_to_il(oper_type, oper_val, il, size_hint=0, peel_load=False):
         return tmp if peel_load else il.load(1, tmp)
 
     elif oper_type == OPER_TYPE.SP_OFFSET:
-        if oper_val & 0x80:
-            oper_val, = struct.unpack("<b", bytes([oper_val]))
+        # lr35902dis already sign-extends the offset
         return il.add(2, il.reg(2, 'SP'), il.const(2, oper_val))
 
     elif oper_type == OPER_TYPE.IMM:
@@ -162,9 +222,6 @@ def operand_to_il(oper_type, oper_val, il, size_hint=0, peel_load=False):
 def expressionify(size, foo, il, temps_are_conds=False):
     """ turns the "reg or constant"  operands to get_flag_write_low_level_il()
         into lifted expressions """
-    if isinstance(foo, int):
-        return foo
-
     if isinstance(foo, ILRegister):
         # LowLevelILExpr is different than ILRegister
         if temps_are_conds and LLIL_TEMP(foo.index):
@@ -191,86 +248,167 @@ def expressionify(size, foo, il, temps_are_conds=False):
 #        il.append(il.set_flag('n', il.const(0, 0)))
 #        il.append(il.set_flag('h', il.const(0, 0)))
 
-def gen_flag_il(op, size, write_type, flag, operands, il):
-    if op in {LowLevelILOperation.LLIL_ASR, LowLevelILOperation.LLIL_LSR}:
-        if flag == 'c':
-            return il.test_bit(1, expressionify(size, operands[0], il), il.const(1, 1))
-        else:
-            return None
-    if flag == 'c':
-        if op == LowLevelILOperation.LLIL_SBB:
-            lhs = expressionify(size, operands[1], il)
-            rhs = expressionify(1, operands[2], il, True)
-            cmp = expressionify(size, operands[0], il)
-            return il.compare_signed_greater_than(size,
-                il.add(size,
-                    lhs,
-                    rhs
-                ),
-                cmp
-            )
+# flag lifters take the (size, operands, il) of a flag write and return the
+# flag's value after it
 
-        if op == LowLevelILOperation.LLIL_OR:
-            return il.const(1, 0)
-        if op == LowLevelILOperation.LLIL_ASR:
-            assert False
-            return il.test_bit(1, expressionify(size, operands[0], il), il.const(1, 1))
-        if op == LowLevelILOperation.LLIL_POP:
-            return il.set_flag('c', il.test_bit(1, il.reg(1, 'F'), il.const(1, 1)))
-        if op == LowLevelILOperation.LLIL_RLC:
-            return il.test_bit(1, il.reg(size, operands[0]), il.const(1, 0x80))
-        if op == LowLevelILOperation.LLIL_ROL:
-            return il.test_bit(1, il.reg(size, operands[0]), il.const(1, 0x80))
-        if op == LowLevelILOperation.LLIL_RRC:
-            return il.test_bit(1, il.reg(size, operands[0]), il.const(1, 1))
-        if op == LowLevelILOperation.LLIL_ROR:
-            return il.test_bit(1, il.reg(size, operands[0]), il.const(1, 1))
-        if op == LowLevelILOperation.LLIL_XOR:
-            return il.const(1, 0)
-
-    if flag == 'h':
-        if op == LowLevelILOperation.LLIL_POP:
-            return il.set_flag('h', il.test_bit(1, il.reg(1, 'F'), il.const(1, 1<<4)))
-        if op == LowLevelILOperation.LLIL_XOR:
-            return il.const(1, 0)
-
-    if flag == 'z':
-        bin_mapping = {
-            LowLevelILOperation.LLIL_XOR: il.xor_expr,
-            LowLevelILOperation.LLIL_OR: il.or_expr,
-            LowLevelILOperation.LLIL_AND: il.and_expr,
-            # LowLevelILOperation.LLIL_ADD: il.add,
-            LowLevelILOperation.LLIL_SUB: il.sub,
-        }
-        if op in bin_mapping:
-            return il.compare_equal(size,
-                bin_mapping[op](size,
-                    expressionify(size, operands[0], il),
-                    expressionify(size, operands[1], il),
-                ),
-                il.const(1, 0)
-            )
+def flag_clear(size, operands, il):
+    return il.const(1, 0)
 
-    return None
+def flag_set(size, operands, il):
+    return il.const(1, 1)
 
-def append_store_result(loc_type, loc_val, size, expr, il):
-    deref_src_addr_map = {
-        OPER_TYPE.REG_DEREF: lambda: il.reg(2, loc_val.name),
-        OPER_TYPE.REG_DEREF_DEC: lambda: il.reg(2, loc_val.name),
-        OPER_TYPE.REG_DEREF_INC: lambda: il.reg(2, loc_val.name),
-        OPER_TYPE.REG_DEREF_FF00: lambda: il.add(2, il.reg(2, loc_val.name), il.const_pointer(2, 0xff00)),
-        OPER_TYPE.ADDR_DEREF: lambda: il.const_pointer(2, loc_val),
-        OPER_TYPE.ADDR_DEREF_FF00: lambda: il.const_pointer(2, 0xff00 + loc_val),
-    }
-    update_map = {
-        OPER_TYPE.REG_DEREF_INC: lambda: il.set_reg(2, 'HL', il.add(2, il.reg(2, 'HL'), il.const(2, 1))),
-        OPER_TYPE.REG_DEREF_DEC: lambda: il.set_reg(2, 'HL', il.sub(2, il.reg(2, 'HL'), il.const(2, 1))),
+def flag_zero_of(method):
+    """ z of the binary op lifted by il.<method>: its result is zero """
+    def lifter(size, operands, il):
+        return il.compare_equal(size,
+            getattr(il, method)(size,
+                expressionify(size, operands[0], il),
+                expressionify(size, operands[1], il),
+            ),
+            il.const(size, 0)
+        )
+    return lifter
+
+def flag_add_c(size, operands, il):
+    # carry out of the top bit: the sum wrapped around
+    lhs = expressionify(size, operands[0], il)
+    rhs = expressionify(size, operands[1], il)
+    return il.compare_unsigned_less_than(size, il.add(size, lhs, rhs), expressionify(size, operands[0], il))
+
+def flag_add_h(size, operands, il):
+    # carry out of bit 3 (bit 11 for add hl,rr)
+    mask = (1 << (size * 8 - 4)) - 1
+    return il.compare_unsigned_greater_than(size,
+        il.add(size,
+            il.and_expr(size, expressionify(size, operands[0], il), il.const(size, mask)),
+            il.and_expr(size, expressionify(size, operands[1], il), il.const(size, mask))
+        ),
+        il.const(size, mask)
+    )
+
+def flag_sub_c(size, operands, il):
+    # borrow into the top bit
+    return il.compare_unsigned_less_than(size,
+        expressionify(size, operands[0], il),
+        expressionify(size, operands[1], il)
+    )
+
+def flag_sub_h(size, operands, il):
+    # borrow into bit 3
+    return il.compare_unsigned_less_than(size,
+        il.and_expr(size, expressionify(size, operands[0], il), il.const(size, 0xF)),
+        il.and_expr(size, expressionify(size, operands[1], il), il.const(size, 0xF))
+    )
+
+def flag_with_carry(method, mask):
+    """ h (mask 0xF) or c (mask 0xFF) of the adc/sbc lifted by il.<method>:
+        the carry or borrow out of the masked bits with the carry flag in,
+        worked out in 2 bytes so a borrow shows above the mask """
+    def lifter(size, operands, il):
+        def masked(i):
+            return il.zero_extend(2, il.and_expr(size, expressionify(size, operands[i], il), il.const(size, mask)))
+        return il.compare_unsigned_greater_than(2,
+            getattr(il, method)(2, masked(0), masked(1), expressionify(1, operands[2], il, True)),
+            il.const(2, mask)
+        )
+    return lifter
+
+def flag_zero_with_carry(method):
+    """ z of the adc/sbc lifted by il.<method> """
+    def lifter(size, operands, il):
+        return il.compare_equal(size,
+            getattr(il, method)(size,
+                expressionify(size, operands[0], il),
+                expressionify(size, operands[1], il),
+                expressionify(1, operands[2], il, True),
+            ),
+            il.const(size, 0)
+        )
+    return lifter
+
+def flag_shifted_out(mask):
+    """ c of shifts and rotates: the bit shifted out of the operand """
+    def lifter(size, operands, il):
+        return il.test_bit(1, expressionify(size, operands[0], il), il.const(1, mask))
+    return lifter
+
+def _build_flag_lifters():
+    LLOP = LowLevelILOperation
+    lifters = {
+        (LLOP.LLIL_ADD, 'z'): flag_zero_of('add'),
+        (LLOP.LLIL_ADD, 'h'): flag_add_h,
+        (LLOP.LLIL_ADD, 'n'): flag_clear,
+        (LLOP.LLIL_ADD, 'c'): flag_add_c,
+        (LLOP.LLIL_ADC, 'z'): flag_zero_with_carry('add_carry'),
+        (LLOP.LLIL_ADC, 'h'): flag_with_carry('add_carry', 0xF),
+        (LLOP.LLIL_ADC, 'n'): flag_clear,
+        (LLOP.LLIL_ADC, 'c'): flag_with_carry('add_carry', 0xFF),
+
+        (LLOP.LLIL_SUB, 'z'): flag_zero_of('sub'),
+        (LLOP.LLIL_SUB, 'h'): flag_sub_h,
+        (LLOP.LLIL_SUB, 'n'): flag_set,
+        (LLOP.LLIL_SUB, 'c'): flag_sub_c,
+        (LLOP.LLIL_SBB, 'z'): flag_zero_with_carry('sub_borrow'),
+        (LLOP.LLIL_SBB, 'h'): flag_with_carry('sub_borrow', 0xF),
+        (LLOP.LLIL_SBB, 'n'): flag_set,
+        (LLOP.LLIL_SBB, 'c'): flag_with_carry('sub_borrow', 0xFF),
+
+        (LLOP.LLIL_AND, 'z'): flag_zero_of('and_expr'),
+        (LLOP.LLIL_AND, 'h'): flag_set,
+        (LLOP.LLIL_AND, 'n'): flag_clear,
+        (LLOP.LLIL_AND, 'c'): flag_clear,
+        (LLOP.LLIL_OR, 'z'): flag_zero_of('or_expr'),
+        (LLOP.LLIL_OR, 'h'): flag_clear,
+        (LLOP.LLIL_OR, 'n'): flag_clear,
+        (LLOP.LLIL_OR, 'c'): flag_clear,
+        (LLOP.LLIL_XOR, 'z'): flag_zero_of('xor_expr'),
+        (LLOP.LLIL_XOR, 'h'): flag_clear,
+        (LLOP.LLIL_XOR, 'n'): flag_clear,
+        (LLOP.LLIL_XOR, 'c'): flag_clear,
+
+        (LLOP.LLIL_LSL, 'c'): flag_shifted_out(0x80),
+        (LLOP.LLIL_ROL, 'c'): flag_shifted_out(0x80),
+        (LLOP.LLIL_RLC, 'c'): flag_shifted_out(0x80),
+        (LLOP.LLIL_LSR, 'c'): flag_shifted_out(1),
+        (LLOP.LLIL_ASR, 'c'): flag_shifted_out(1),
+        (LLOP.LLIL_ROR, 'c'): flag_shifted_out(1),
+        (LLOP.LLIL_RRC, 'c'): flag_shifted_out(1),
     }
-    if loc_type in deref_src_addr_map:
-        target_addr = deref_src_addr_map[loc_type]()
-        il.append(il.store(size, target_addr, expr))
-        if loc_type in update_map:
-            il.append(update_map[loc_type]())
+    return lifters
+
+# (LowLevelILOperation, flag) -> flag lifter, anything missing is left to
+# Binja's default flag IL
+FLAG_LIFTERS = _build_flag_lifters()
+
+def gen_flag_il(op, size, write_type, flag, operands, il):
+    lifter = FLAG_LIFTERS.get((op, flag))
+    if lifter is None:
+        return None
+    return lifter(size, operands, il)
+
+# where append_store_result() stores to, by operand type: (il, oper_val) -> address
+STORE_ADDRESS = {
+    OPER_TYPE.REG_DEREF: lambda il, val: il.reg(2, val.name),
+    OPER_TYPE.REG_DEREF_DEC: lambda il, val: il.reg(2, val.name),
+    OPER_TYPE.REG_DEREF_INC: lambda il, val: il.reg(2, val.name),
+    OPER_TYPE.REG_DEREF_FF00: lambda il, val: il.add(2, il.const_pointer(2, 0xff00), il.zero_extend(2, il.reg(1, val.name))),
+    OPER_TYPE.ADDR_DEREF: lambda il, val: il.const_pointer(2, val),
+    OPER_TYPE.ADDR_DEREF_FF00: lambda il, val: il.const_pointer(2, 0xff00 + val),
+}
+
+# and what follows the store (or load) of (hl+)/(hl-): il -> expression
+STORE_UPDATE = {
+    OPER_TYPE.REG_DEREF_INC: lambda il: il.set_reg(2, 'HL', il.add(2, il.reg(2, 'HL'), il.const(2, 1))),
+    OPER_TYPE.REG_DEREF_DEC: lambda il: il.set_reg(2, 'HL', il.sub(2, il.reg(2, 'HL'), il.const(2, 1))),
+}
+
+def append_store_result(loc_type, loc_val, size, expr, il):
+    store_address = STORE_ADDRESS.get(loc_type)
+    if store_address is not None:
+        il.append(il.store(size, store_address(il, loc_val), expr))
+        update = STORE_UPDATE.get(loc_type)
+        if update is not None:
+            il.append(update(il))
 
     elif loc_type == OPER_TYPE.REG:
         il.append(il.set_reg(size, loc_val.name, expr))
@@ -278,316 +416,453 @@ def append_store_result(loc_type, loc_val, size, expr, il):
     else:
         assert False, f"WHHAAAAAt are you trying to store into?? {loc_type=}, {loc_val=}, {size=}, {expr=}, {il=}"
 
+def append_flags(il, **values):
+    """ set_flag() of each flag given, in znhc order, to an expression or
+        to False/True """
+    for flag in 'znhc':
+        value = values.get(flag)
+        if value is None:
+            continue
+        if value is True or value is False:
+            value = il.const(0, int(value))
+        il.append(il.set_flag(flag, value))
+
+# bits of the flags in F, for push af/pop af
+F_BITS = (('z', 0x80), ('n', 0x40), ('h', 0x20), ('c', 0x10))
+
+def append_sp_offset(dest, offset, il):
+    """ dest = SP + offset of add sp,e and ld hl,sp+e: z and n cleared, h
+        and c from the unsigned add of the offset's low byte to SP's """
+    def carry(mask):
+        return il.compare_unsigned_greater_than(2,
+            il.add(2, il.and_expr(2, il.reg(2, 'SP'), il.const(2, mask)), il.const(2, offset & mask)),
+            il.const(2, mask)
+        )
+    append_flags(il, z=False, n=False, h=carry(0xF), c=carry(0xFF))
+    il.append(il.set_reg(2, reg2str(dest), il.add(2, il.reg(2, 'SP'), il.const(2, offset))))
+
 #------------------------------------------------------------------------------
 # INSTRUCTION LIFTING
 #------------------------------------------------------------------------------
 
-def gen_instr_il(addr, decoded, il):
-    (oper_type, oper_val) = decoded.operands[0] if decoded.operands else (None, None)
-    (operb_type, operb_val) = decoded.operands[1] if decoded.operands[1:] else (None, None)
-
-    if decoded.op in [OP.ADD, OP.ADC]:
-        assert len(decoded.operands) == 2
-        if oper_type == OPER_TYPE.REG:
-            size = REG_TO_SIZE[oper_val]
-            rhs = operand_to_il(operb_type, operb_val, il, size)
-            lhs = operand_to_il(oper_type, oper_val, il)
-            if decoded.op == OP.ADD:
-                tmp = il.add(size, lhs, rhs, flags='*')
-            else:
-                tmp = il.add_carry(size, lhs, rhs, il.flag("c"), flags='*')
-            tmp = il.set_reg(size, reg2str(oper_val), tmp)
-            il.append(tmp)
-        else:
-            il.append(il.unimplemented())
-
-    elif decoded.op == OP.AND:
-        tmp = il.reg(1, 'A')
-        tmp = il.and_expr(1, operand_to_il(oper_type, oper_val, il, 1), tmp, flags='z')
-        tmp = il.set_reg(1, 'A', tmp)
-        il.append(tmp)
-
-    elif decoded.op == OP.BIT:
-        assert oper_type == OPER_TYPE.IMM
-        assert oper_val >= 0 and oper_val <= 7
-        mask = il.const(1, 1<<oper_val)
-        operand = operand_to_il(operb_type, operb_val, il, 1)
-        il.append(il.and_expr(1, operand, mask, flags='*'))
-
-    elif decoded.op == OP.SET:
-        assert oper_type == OPER_TYPE.IMM
-        assert oper_val >= 0 and oper_val <= 7
-
-        operand = operand_to_il(operb_type, operb_val, il, 1)
-
-        mask = il.const(1, (1<<oper_val)) # mask to clear out the target bit
-        new = il.or_expr(1, operand, mask)
-
-        append_store_result(operb_type, operb_val, 1, new, il)
+# one lifter per mnemonic (or family of mnemonics sharing semantics), all with
+# the signature lifter(addr, decoded, il, ctx), ctx being the LifterContext of
+# the instruction
 
-    elif decoded.op == OP.RES:
-        assert oper_type == OPER_TYPE.IMM
-        assert oper_val >= 0 and oper_val <= 7
-
-        operand = operand_to_il(operb_type, operb_val, il, 1)
-
-        mask = il.const(1, 0xff - (1<<oper_val)) # mask to clear out the target bit
-        new = il.and_expr(1, operand, mask)
-
-        append_store_result(operb_type, operb_val, 1, new, il)
+def lift_add(addr, decoded, il, ctx):
+    assert len(decoded.operands) == 2
+    (oper_type, oper_val), (operb_type, operb_val) = decoded.operands
+    assert oper_type == OPER_TYPE.REG
+    if oper_val == REG.SP:
+        append_sp_offset(REG.SP, operb_val, il)
+        return
 
-    elif decoded.op == OP.CPL:
-        il.append(il.set_reg(1, 'A', il.not_expr(1, il.reg(1, 'A'))))
+    size = REG_TO_SIZE[oper_val]
+    rhs = operand_to_il(operb_type, operb_val, il, size)
+    lhs = operand_to_il(oper_type, oper_val, il)
+    # add hl,rr leaves z alone
+    flags = '*' if size == 1 else 'not_z'
+    if decoded.op == OP.ADD:
+        tmp = il.add(size, lhs, rhs, flags=flags)
+    else:
+        tmp = il.add_carry(size, lhs, rhs, il.flag("c"), flags=flags)
+    tmp = il.set_reg(size, reg2str(oper_val), tmp)
+    il.append(tmp)
+
+def lift_and(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    tmp = il.reg(1, 'A')
+    tmp = il.and_expr(1, operand_to_il(oper_type, oper_val, il, 1), tmp, flags='*')
+    tmp = il.set_reg(1, 'A', tmp)
+    il.append(tmp)
+
+def lift_bit(addr, decoded, il, ctx):
+    (oper_type, oper_val), (operb_type, operb_val) = decoded.operands
+    assert oper_type == OPER_TYPE.IMM
+    assert oper_val >= 0 and oper_val <= 7
+    mask = il.const(1, 1<<oper_val)
+    operand = operand_to_il(operb_type, operb_val, il, 1)
+    # z, n and h of and, c is left alone
+    il.append(il.and_expr(1, operand, mask, flags='not_c'))
+
+def lift_set(addr, decoded, il, ctx):
+    (oper_type, oper_val), (operb_type, operb_val) = decoded.operands
+    assert oper_type == OPER_TYPE.IMM
+    assert oper_val >= 0 and oper_val <= 7
+
+    operand = operand_to_il(operb_type, operb_val, il, 1)
+
+    mask = il.const(1, (1<<oper_val)) # mask to clear out the target bit
+    new = il.or_expr(1, operand, mask)
+
+    append_store_result(operb_type, operb_val, 1, new, il)
+
+def lift_res(addr, decoded, il, ctx):
+    (oper_type, oper_val), (operb_type, operb_val) = decoded.operands
+    assert oper_type == OPER_TYPE.IMM
+    assert oper_val >= 0 and oper_val <= 7
+
+    operand = operand_to_il(operb_type, operb_val, il, 1)
+
+    mask = il.const(1, 0xff - (1<<oper_val)) # mask to clear out the target bit
+    new = il.and_expr(1, operand, mask)
+
+    append_store_result(operb_type, operb_val, 1, new, il)
+
+def lift_cpl(addr, decoded, il, ctx):
+    il.append(il.set_reg(1, 'A', il.not_expr(1, il.reg(1, 'A'))))
+    append_flags(il, n=True, h=True)
+
+def lift_call(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    if oper_type == OPER_TYPE.COND:
+        condition, target = oper_val, decoded.operands[1][1]
+    else:
+        condition, target = CC.ALWAYS, oper_val
+    append_conditional_instr(condition, il.call(il.const_pointer(2, target)), il)
+
+def lift_rst(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    assert oper_type == OPER_TYPE.IMM
+
+    # jump table helper: jp [table + a * scale], the table right after the rst
+    scale = ctx.rst.jump_tables.get(oper_val)
+    if scale is not None:
+        index = il.zero_extend(2, il.reg(1, 'A'))
+        if scale != 1:
+            index = il.mult(2, index, il.const(2, scale))
+        table = il.const_pointer(2, addr + decoded.len)
+        il.append(il.jump(il.load(2, il.add(2, table, index))))
+        return
 
-    elif decoded.op == OP.CALL:
-        condition, target = (oper_val, operb_val) if oper_type == OPER_TYPE.COND else (CC.ALWAYS, oper_val)
-        append_conditional_instr(condition, il.call(il.const_pointer(2, target)), il)
+    # call to the fixed restart vector
+    il.append(il.call(il.const_pointer(2, oper_val)))
 
-    elif decoded.op == OP.RST:
-        assert oper_type == OPER_TYPE.IMM
-        il.append(il.const_pointer(2, oper_val))
+    # inline argument helper: returns past the arguments after the rst
+    count = ctx.rst.inline_args.get(oper_val)
+    if count is not None:
+        il.append(goto_or_jump(OPER_TYPE.ADDR, addr + decoded.len + count, il, ctx))
 
-    elif decoded.op == OP.SCF:
-        il.append(il.set_flag('c', il.const(0, 1)))
+def lift_scf(addr, decoded, il, ctx):
+    append_flags(il, n=False, h=False, c=True)
 
-    elif decoded.op == OP.CCF:
-        il.append(il.set_flag('c', il.not_expr(0, il.flag('c'))))
+def lift_ccf(addr, decoded, il, ctx):
+    append_flags(il, n=False, h=False, c=il.not_expr(0, il.flag('c')))
 
-    elif decoded.op == OP.CP:
-        # sub, but do not write to register
-        lhs = il.reg(1, 'A')
-        rhs = operand_to_il(oper_type, oper_val, il, 1)
-        sub = il.sub(1, lhs, rhs, flags='*')
-        il.append(sub)
+def lift_cp(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    # sub, but do not write to register
+    lhs = il.reg(1, 'A')
+    rhs = operand_to_il(oper_type, oper_val, il, 1)
+    sub = il.sub(1, lhs, rhs, flags='*')
+    il.append(sub)
 
-    elif decoded.op == OP.INC:
-        # inc reg can be 1-byte or 2-byte
-        if oper_type == OPER_TYPE.REG:
-            size = REG_TO_SIZE[oper_val]
-            tmp = il.add(size, operand_to_il(oper_type, oper_val, il), il.const(1, 1))
-            tmp = il.set_reg(size, reg2str(oper_val), tmp)
-        else:
-            tmp = il.add(1, operand_to_il(oper_type, oper_val, il), il.const(1, 1))
-            tmp = il.store(1, operand_to_il(oper_type, oper_val, il, 1, peel_load=True), tmp)
+def lift_inc(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    # inc reg can be 1-byte (z, n, h) or 2-byte (no flags)
+    if oper_type == OPER_TYPE.REG:
+        size = REG_TO_SIZE[oper_val]
+        fwt = 'not_c' if size == 1 else None
+        tmp = il.add(size, operand_to_il(oper_type, oper_val, il), il.const(size, 1), flags=fwt)
+        tmp = il.set_reg(size, reg2str(oper_val), tmp)
+    else:
+        tmp = il.add(1, operand_to_il(oper_type, oper_val, il, 1), il.const(1, 1), flags='not_c')
+        tmp = il.store(1, operand_to_il(oper_type, oper_val, il, 1, peel_load=True), tmp)
 
-        il.append(tmp)
+    il.append(tmp)
 
-    elif decoded.op in [OP.JP, OP.JR]:
-        if oper_type == OPER_TYPE.COND:
-            append_conditional_jump(oper_val, operb_type, operb_val, addr + decoded.len, il)
-        else:
-            il.append(goto_or_jump(oper_type, oper_val, il))
-
-    # elif decoded.op == OP.LD:
-    #     assert len(decoded.operands) == 2
-
-    #     if oper_type == OPER_TYPE.REG:
-    #         size = REG_TO_SIZE[oper_val]
-    #         # for two-byte nonzero loads, guess that it's an address
-    #         if size == 2 and operb_type == OPER_TYPE.IMM and operb_val != 0:
-    #             operb_type = OPER_TYPE.ADDR
-    #         rhs = operand_to_il(operb_type, operb_val, il, size)
-    #         set_reg = il.set_reg(size, reg2str(oper_val), rhs)
-    #         il.append(set_reg)
-    #     else:
-    #         assert operb_type in [OPER_TYPE.REG, OPER_TYPE.IMM]
-
-    #         if operb_type == OPER_TYPE.REG:
-    #             # 1 or 2 byte stores are possible here:
-    #             # ld (0xcdab),bc
-    #             # ld (ix-0x55),a
-    #             size = REG_TO_SIZE[operb_val]
-    #         elif operb_type == OPER_TYPE.IMM:
-    #             # only 1 byte stores are possible
-    #             # eg: ld (ix-0x55),0xcd
-    #             size = 1
-
-    #         src = operand_to_il(operb_type, operb_val, il, size)
-    #         dst = operand_to_il(oper_type, oper_val, il, size, peel_load=True)
-    #         il.append(il.store(size, dst, src))
-
-    elif decoded.op in [OP.LD, OP.LDI, OP.LDD]:
-        expr = operand_to_il(operb_type, operb_val, il, size_hint=1)
-        append_store_result(oper_type, oper_val, 1, expr, il)
-
-    elif decoded.op in {OP.NOP, OP.DI, OP.EI, OP.HALT}:
-        il.append(il.nop())
-
-    elif decoded.op in {OP.STOP}:
-        il.append(il.no_ret())
-
-    elif decoded.op == OP.OR:
-        tmp = il.reg(1, 'A')
-        tmp = il.or_expr(1, operand_to_il(oper_type, oper_val, il, 1), tmp, flags='*')
-        tmp = il.set_reg(1, 'A', tmp)
-        il.append(tmp)
+def lift_jump(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    if oper_type == OPER_TYPE.COND:
+        (operb_type, operb_val) = decoded.operands[1]
+        append_conditional_jump(oper_val, operb_type, operb_val, addr + decoded.len, il, ctx)
+    else:
+        il.append(goto_or_jump(oper_type, oper_val, il, ctx))
 
-    elif decoded.op == OP.POP:
-        # possible operands are: af bc de hl ix iy
-        flag_write_type = '*' if oper_val == REG.AF else None
+def lift_ld(addr, decoded, il, ctx):
+    (oper_type, oper_val), (operb_type, operb_val) = decoded.operands
+    if operb_type == OPER_TYPE.SP_OFFSET:
+        append_sp_offset(oper_val, operb_val, il)
+        return
 
+    # ld rr,nn, ld sp,hl and ld (nn),sp are 16-bit
+    size = 1
+    if oper_type == OPER_TYPE.REG:
         size = REG_TO_SIZE[oper_val]
-        tmp = il.pop(size)
-        tmp = il.set_reg(size, reg2str(oper_val), tmp, flag_write_type)
-        il.append(tmp)
-
-    elif decoded.op == OP.PUSH:
-        # possible operands are: af bc de hl ix iy
+    elif operb_type == OPER_TYPE.REG:
+        size = REG_TO_SIZE[operb_val]
+
+    expr = operand_to_il(operb_type, operb_val, il, size_hint=size)
+    append_store_result(oper_type, oper_val, size, expr, il)
+
+    # ld a,(hl+), ld a,(hl-)
+    update = STORE_UPDATE.get(operb_type)
+    if update is not None:
+        il.append(update(il))
+
+def lift_nop(addr, decoded, il, ctx):
+    il.append(il.nop())
+
+# cpu control, LR35902Arch.intrinsics
+CONTROL_INTRINSICS = {
+    OP.EI: 'enable_interrupts',
+    OP.DI: 'disable_interrupts',
+    OP.HALT: 'halt',
+    # speed switch on the CGB, execution goes on after it
+    OP.STOP: 'stop',
+}
 
-        # when pushing AF, actually push the flags
-        if oper_val == REG.AF:
-            # lo byte F first
-            il.append(il.push(2,
-                il.or_expr(
-                    2,
+def lift_control(addr, decoded, il, ctx):
+    il.append(il.intrinsic([], CONTROL_INTRINSICS[decoded.op], []))
+
+def lift_daa(addr, decoded, il, ctx):
+    # after an add: +0x60 (setting c) if c or A > 0x99, +0x06 if h or the
+    # low digit is > 9; after a sub: -0x60 if c, -0x06 if h
+    after_add, after_sub = LowLevelILLabel(), LowLevelILLabel()
+    check_high, add_high, low_add, check_low, add_low = (LowLevelILLabel() for _ in range(5))
+    sub_high, low_sub, sub_low, done = (LowLevelILLabel() for _ in range(4))
+
+    def adjust(method, value):
+        il.append(il.set_reg(1, 'A', getattr(il, method)(1, il.reg(1, 'A'), il.const(1, value))))
+
+    il.append(il.if_expr(il.flag('n'), after_sub, after_add))
+
+    il.mark_label(after_add)
+    il.append(il.if_expr(il.flag('c'), add_high, check_high))
+    il.mark_label(check_high)
+    il.append(il.if_expr(il.compare_unsigned_greater_than(1, il.reg(1, 'A'), il.const(1, 0x99)), add_high, low_add))
+    il.mark_label(add_high)
+    adjust('add', 0x60)
+    append_flags(il, c=True)
+    il.append(il.goto(low_add))
+    il.mark_label(low_add)
+    il.append(il.if_expr(il.flag('h'), add_low, check_low))
+    il.mark_label(check_low)
+    il.append(il.if_expr(il.compare_unsigned_greater_than(1,
+        il.and_expr(1, il.reg(1, 'A'), il.const(1, 0xF)), il.const(1, 9)), add_low, done))
+    il.mark_label(add_low)
+    adjust('add', 0x06)
+    il.append(il.goto(done))
+
+    il.mark_label(after_sub)
+    il.append(il.if_expr(il.flag('c'), sub_high, low_sub))
+    il.mark_label(sub_high)
+    adjust('sub', 0x60)
+    il.append(il.goto(low_sub))
+    il.mark_label(low_sub)
+    il.append(il.if_expr(il.flag('h'), sub_low, done))
+    il.mark_label(sub_low)
+    adjust('sub', 0x06)
+
+    il.mark_label(done)
+    append_flags(il, z=il.compare_equal(1, il.reg(1, 'A'), il.const(1, 0)), h=False)
+
+def lift_or(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    tmp = il.reg(1, 'A')
+    tmp = il.or_expr(1, operand_to_il(oper_type, oper_val, il, 1), tmp, flags='*')
+    tmp = il.set_reg(1, 'A', tmp)
+    il.append(tmp)
+
+def lift_pop(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    # possible operands are: af bc de hl
+    size = REG_TO_SIZE[oper_val]
+    tmp = il.pop(size)
+    tmp = il.set_reg(size, reg2str(oper_val), tmp)
+    il.append(tmp)
+
+    # pop af: the flags come back from F
+    if oper_val == REG.AF:
+        append_flags(il, **dict(
+            (flag, il.test_bit(1, il.reg(1, 'F'), il.const(1, mask))) for flag, mask in F_BITS
+        ))
+
+def lift_push(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    # possible operands are: af bc de hl ix iy
+
+    # when pushing AF, actually push the flags
+    if oper_val == REG.AF:
+        # lo byte F first
+        il.append(il.push(2,
+            il.or_expr(
+                2,
+                il.or_expr(1,
                     il.or_expr(1,
-                        il.or_expr(1,
-                            il.shift_left(1, il.flag('z'), il.const(1, 7)),
-                            il.shift_left(1, il.flag('n'), il.const(1, 6))
-                        ),
-                        il.or_expr(1,
-                            il.shift_left(1, il.flag('h'), il.const(1, 5)),
-                            il.shift_left(1, il.flag('c'), il.const(1, 4))
-                        )
+                        il.shift_left(1, il.flag('z'), il.const(1, 7)),
+                        il.shift_left(1, il.flag('n'), il.const(1, 6))
                     ),
-                    il.shift_left(2,
-                        il.reg(1, 'A'),
-                        il.const(1, 8)
+                    il.or_expr(1,
+                        il.shift_left(1, il.flag('h'), il.const(1, 5)),
+                        il.shift_left(1, il.flag('c'), il.const(1, 4))
                     )
+                ),
+                il.shift_left(2,
+                    il.reg(1, 'A'),
+                    il.const(1, 8)
                 )
-            ))
-        else:
-            il.append(il.push( \
-                REG_TO_SIZE[oper_val], \
-                operand_to_il(oper_type, oper_val, il)))
-
-    elif decoded.op in [OP.RL, OP.RLA]:
-        # rotate THROUGH carry: b0=c, c=b8
-        # LR35902 'RL' -> llil 'RLC'
-        if decoded.op == OP.RLA:
+            )
+        ))
+    else:
+        il.append(il.push( \
+            REG_TO_SIZE[oper_val], \
+            operand_to_il(oper_type, oper_val, il)))
+
+# rlca, rla, rrca, rra: the accumulator forms, z is cleared instead of set
+# from the result
+ACCUMULATOR_SHIFTS = (OP.RLCA, OP.RLA, OP.RRCA, OP.RRA)
+
+def lift_shift(method, through_carry=False):
+    """ lifter of the rotates/shifts lifted by il.<method>, c from the flag
+        lifters and z, n and h from the result """
+    def lifter(addr, decoded, il, ctx):
+        if decoded.op in ACCUMULATOR_SHIFTS:
             oper_type, oper_val = OPER_TYPE.REG, REG.A
-
-        src = operand_to_il(oper_type, oper_val, il)
-        rot = il.rotate_left_carry(1, src, il.const(1, 1), il.flag('c'), flags='c')
-        append_store_result(oper_type, oper_val, 1, rot, il)
-
-    elif decoded.op in [OP.SLA]:
-        # shift left: b0=c, c=b8
-        # LR35902 'SLA' -> llil 'shift_left'
-
-        src = operand_to_il(oper_type, oper_val, il)
-        rot = il.shift_left(1, src, il.const(1, 1), flags='c')
-        append_store_result(oper_type, oper_val, 1, rot, il)
-
-    elif decoded.op in [OP.RLC, OP.RLCA]:
-        # rotate and COPY to carry: b0=c, c=b8
-        # LR35902 'RL' -> llil 'ROL'
-        if decoded.op == OP.RLCA:
-            src = il.reg(1, 'A')
         else:
-            src = operand_to_il(oper_type, oper_val, il)
+            (oper_type, oper_val) = decoded.operands[0]
 
-        rot = il.rotate_left(1, src, il.const(1, 1), flags='c')
-
-        append_store_result(oper_type or OPER_TYPE.REG, oper_val or REG.A, 1, rot, il)
-
-    elif decoded.op == OP.SWAP:
-        src = operand_to_il(oper_type, oper_val, il, size_hint=1)
-
-        new_low = il.and_expr(1, il.logical_shift_right(1, src, il.const(1, 4)), il.const(1, 0xf))
-        new_high = il.and_expr(1, il.shift_left(1, src, il.const(1, 4)), il.const(1, 0xf0))
-        res = il.or_expr(1, new_low, new_high, flags='z')
-        append_store_result(oper_type, oper_val, 1, res, il)
-
-    elif decoded.op in {OP.RET, OP.RETI}:
-        tmp = il.ret(il.pop(2))
-        if decoded.operands:
-            append_conditional_instr(decoded.operands[0][1], tmp, il)
+        src = operand_to_il(oper_type, oper_val, il, 1)
+        if through_carry:
+            tmp = getattr(il, method)(1, src, il.const(1, 1), il.flag('c'), flags='c')
         else:
-            il.append(tmp)
+            tmp = getattr(il, method)(1, src, il.const(1, 1), flags='c')
+        append_store_result(oper_type, oper_val, 1, tmp, il)
 
-    elif decoded.op in [OP.RR, OP.RRA]:
-        # rotate THROUGH carry: b7=c, c=b0
-        # LR35902 'RL' -> llil 'RRC'
-        if decoded.op == OP.RRA:
-            src = il.reg(1, 'A')
+        if decoded.op in ACCUMULATOR_SHIFTS:
+            zero = False
         else:
-            src = operand_to_il(oper_type, oper_val, il, 1)
-
-        rot = il.rotate_right_carry(1, src, il.const(1, 1), il.flag('c'), flags='c')
-
-        if decoded.op == OP.RRA:
-            il.append(il.set_reg(1, 'A', rot))
-        elif oper_type == OPER_TYPE.REG:
-            il.append(il.set_reg(1, reg2str(oper_val), rot))
-        else:
-            tmp2 = operand_to_il(oper_type, oper_val, il, 1, peel_load=True)
-            il.append(il.store(1, tmp2, rot))
-
-    elif decoded.op == OP.SRA:
-        tmp = operand_to_il(oper_type, oper_val, il, 1)
-        tmp = il.arith_shift_right(1, tmp, il.const(1, 1), flags='c')
-
-        if oper_type == OPER_TYPE.REG:
-            tmp = il.set_reg(1, reg2str(oper_val), tmp)
-        else:
-            tmp = il.store(1,
-                operand_to_il(oper_type, oper_val, il, 1, peel_load=True),
-                tmp
-            )
-
+            zero = il.compare_equal(1, operand_to_il(oper_type, oper_val, il, 1), il.const(1, 0))
+        append_flags(il, z=zero, n=False, h=False)
+    return lifter
+
+# LR35902 'RLC' (copy to carry) -> llil 'ROL', 'RL' (through carry) -> 'RLC'
+lift_rlc = lift_shift('rotate_left')
+lift_rl = lift_shift('rotate_left_carry', through_carry=True)
+lift_rrc = lift_shift('rotate_right')
+lift_rr = lift_shift('rotate_right_carry', through_carry=True)
+lift_sla = lift_shift('shift_left')
+lift_sra = lift_shift('arith_shift_right')
+lift_srl = lift_shift('logical_shift_right')
+
+def lift_swap(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    src = operand_to_il(oper_type, oper_val, il, size_hint=1)
+
+    new_low = il.and_expr(1, il.logical_shift_right(1, src, il.const(1, 4)), il.const(1, 0xf))
+    new_high = il.and_expr(1, il.shift_left(1, src, il.const(1, 4)), il.const(1, 0xf0))
+    # z of or, n, h and c cleared
+    res = il.or_expr(1, new_low, new_high, flags='*')
+    append_store_result(oper_type, oper_val, 1, res, il)
+
+def lift_ret(addr, decoded, il, ctx):
+    tmp = il.ret(il.pop(2))
+    if decoded.operands:
+        append_conditional_instr(decoded.operands[0][1], tmp, il)
+    else:
+        # reti enables interrupts right away, no ei delay
+        if decoded.op == OP.RETI:
+            il.append(il.intrinsic([], CONTROL_INTRINSICS[OP.EI], []))
         il.append(tmp)
 
-    elif decoded.op == OP.SRL:
-        tmp = operand_to_il(oper_type, oper_val, il, 1)
-        tmp = il.logical_shift_right(1, tmp, il.const(1, 1), flags='c')
-
-        if oper_type == OPER_TYPE.REG:
-            tmp = il.set_reg(1, reg2str(oper_val), tmp)
-        else:
-            tmp = il.store(1,
-                operand_to_il(oper_type, oper_val, il, 1, peel_load=True),
-                tmp
-            )
+def lift_sub(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    tmp = operand_to_il(oper_type, oper_val, il, 1)
+    tmp = il.sub(1, il.reg(1, 'A'), tmp, flags='*')
+    tmp = il.set_reg(1, 'A', tmp)
+    il.append(tmp)
 
+def lift_dec(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    if oper_type == OPER_TYPE.REG:
+        size = REG_TO_SIZE[oper_val]
+        reg = operand_to_il(oper_type, oper_val, il, size)
+        fwt = 'not_c' if size == 1 else None
+        tmp = il.sub(size, reg, il.const(size, 1), flags=fwt)
+        tmp = il.set_reg(size, reg2str(oper_val), tmp)
         il.append(tmp)
-
-    elif decoded.op == OP.SUB:
-        tmp = operand_to_il(oper_type, oper_val, il, 1)
-        tmp = il.sub(1, il.reg(1, 'A'), tmp, flags='*')
-        tmp = il.set_reg(1, 'A', tmp)
+    else:
+        mem = operand_to_il(oper_type, oper_val, il, 1)
+        tmp = il.sub(1, mem, il.const(1, 1), flags='not_c')
+        tmp = il.store(1, operand_to_il(oper_type, oper_val, il, 1, peel_load=True), tmp)
         il.append(tmp)
 
-    elif decoded.op == OP.DEC:
-        if oper_type == OPER_TYPE.REG:
-            size = REG_TO_SIZE[oper_val]
-            reg = operand_to_il(oper_type, oper_val, il, size)
-            fwt = 'not_c' if size == 1 else None
-            tmp = il.sub(size, reg, il.const(1, 1), flags=fwt)
-            tmp = il.set_reg(size, reg2str(oper_val), tmp)
-            il.append(tmp)
-        else:
-            mem = operand_to_il(oper_type, oper_val, il, 1)
-            tmp = il.sub(1, mem, il.const(1, 1), flags='not_c')
-            tmp = il.store(1, mem, tmp)
-            il.append(tmp)
+def lift_sbc(addr, decoded, il, ctx):
+    (oper_type, oper_val), (operb_type, operb_val) = decoded.operands
+    size = REG_TO_SIZE[oper_val]
+    lhs = operand_to_il(oper_type, oper_val, il, size)
+    rhs = operand_to_il(operb_type, operb_val, il, size)
+    tmp = il.sub_borrow(size, lhs, rhs, il.flag('c'), flags='*')
+    tmp = il.set_reg(1, 'A', tmp)
+    il.append(tmp)
+
+def lift_xor(addr, decoded, il, ctx):
+    (oper_type, oper_val) = decoded.operands[0]
+    tmp = il.reg(1, 'A')
+    tmp = il.xor_expr(1, operand_to_il(oper_type, oper_val, il, 1), tmp, flags='*')
+    tmp = il.set_reg(1, 'A', tmp)
+    il.append(tmp)
+
+# every legal encoding has a lifter (lift_coverage), whatever still gets
+# here shows up in the profile (LR35902Profile) rather than on stdout
+def lift_unimplemented(addr, decoded, il, ctx):
+    il.append(il.unimplemented())
+    #il.append(il.nop()) # these get optimized away during lifted il -> llil
 
-    elif decoded.op == OP.SBC:
-        size = REG_TO_SIZE[oper_val]
-        lhs = operand_to_il(oper_type, oper_val, il, size)
-        rhs = operand_to_il(operb_type, operb_val, il, size)
-        tmp = il.sub_borrow(size, lhs, rhs, il.flag('c'), flags='*')
-        tmp = il.set_reg(1, 'A', tmp)
-        il.append(tmp)
+#------------------------------------------------------------------------------
+# DISPATCH
+#------------------------------------------------------------------------------
 
-    elif decoded.op == OP.XOR:
-        tmp = il.reg(1, 'A')
-        tmp = il.xor_expr(1, operand_to_il(oper_type, oper_val, il, 1), tmp, flags='*')
-        tmp = il.set_reg(1, 'A', tmp)
-        il.append(tmp)
+OP_TO_LIFTER = {
+    OP.ADD: lift_add, OP.ADC: lift_add,
+    OP.AND: lift_and,
+    OP.BIT: lift_bit,
+    OP.SET: lift_set,
+    OP.RES: lift_res,
+    OP.CPL: lift_cpl,
+    OP.DAA: lift_daa,
+    OP.CALL: lift_call,
+    OP.RST: lift_rst,
+    OP.SCF: lift_scf,
+    OP.CCF: lift_ccf,
+    OP.CP: lift_cp,
+    OP.INC: lift_inc,
+    OP.JP: lift_jump, OP.JR: lift_jump,
+    OP.LD: lift_ld, OP.LDI: lift_ld, OP.LDD: lift_ld,
+    OP.NOP: lift_nop,
+    OP.DI: lift_control, OP.EI: lift_control, OP.HALT: lift_control, OP.STOP: lift_control,
+    OP.OR: lift_or,
+    OP.POP: lift_pop,
+    OP.PUSH: lift_push,
+    OP.RL: lift_rl, OP.RLA: lift_rl,
+    OP.SLA: lift_sla,
+    OP.RLC: lift_rlc, OP.RLCA: lift_rlc,
+    OP.SWAP: lift_swap,
+    OP.RET: lift_ret, OP.RETI: lift_ret,
+    OP.RR: lift_rr, OP.RRA: lift_rr,
+    OP.RRC: lift_rrc, OP.RRCA: lift_rrc,
+    OP.SRA: lift_sra,
+    OP.SRL: lift_srl,
+    OP.SUB: lift_sub,
+    OP.DEC: lift_dec,
+    OP.SBC: lift_sbc,
+    OP.XOR: lift_xor,
+}
+
+def _build_opcode_lifters():
+    table = []
+    for opcode in range(OPCODE_COUNT):
+        decoded = decode(opcode_bytes(opcode), 0)
+        table.append(OP_TO_LIFTER.get(decoded.op, lift_unimplemented))
+    return table
+
+# indexed by opcode_index(): 0x00-0xFF base opcodes, 0x100-0x1FF CB-prefixed
+OPCODE_LIFTERS = _build_opcode_lifters()
 
+def gen_instr_il(addr, decoded, il, opcode=None):
+    if opcode is None:
+        lifter = OP_TO_LIFTER.get(decoded.op, lift_unimplemented)
     else:
-        print(f"unimplemented opcode lifter: {decoded2str(decoded)} @ {hex(addr)}")
-        il.append(il.unimplemented())
-        #il.append(il.nop()) # these get optimized away during lifted il -> llil
+        lifter = OPCODE_LIFTERS[opcode]
 
+    lifter(addr, decoded, il, lifter_context(il))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+#
+# opt-in instrumentation of the plugin's hot paths, main exports:
+# enabled()
+# instrument()
+# report()
+# Sampler
+#
+# off unless the LR35902_PROFILE environment variable (or the 'lr35902.profile'
+# setting) is set when Binary Ninja starts. Then the Architecture callbacks:
+#
+#   get_instruction_info()
+#   get_instruction_text()
+#   get_instruction_low_level_il()
+#   get_flag_write_low_level_il() and the lifter's gen_flag_il()
+#
+# are wrapped to count their calls and the time they take, per callback and
+# per opcode (per (LLIL operation, flag) for the flag lifters), in power-of-two
+# nanosecond histograms. Opcodes lifted by lift_unimplemented() are counted
+# too. Off, nothing is wrapped: the callbacks are the plain methods.
+#
+# LR35902_PROFILE_STACKS=out.folded (or 'lr35902.profileStacks') also samples
+# the Python stacks running plugin code, written on exit in the collapsed
+# format of flamegraph.pl / speedscope:
+#
+#   LR35902_PROFILE=1 LR35902_PROFILE_STACKS=/tmp/lr35902.folded binaryninja game.gb
+#   flamegraph.pl /tmp/lr35902.folded > lr35902.svg
+#
+# the report is written to stderr on exit, or from the Python console:
+#
+#   >>> from LR35902 import LR35902Profile; print(LR35902Profile.report())
+
+import os
+import sys
+
+from .LR35902Decoder import opcode_index, opcode_bytes
+
+ENV_PROFILE = 'LR35902_PROFILE'
+ENV_STACKS = 'LR35902_PROFILE_STACKS'
+SETTING_PROFILE = 'lr35902.profile'
+SETTING_STACKS = 'lr35902.profileStacks'
+
+# seconds between stack samples
+SAMPLE_INTERVAL = 0.001
+
+# histogram buckets, bucket n holds the calls taking [2**(n-1), 2**n) ns
+HISTOGRAM_BUCKETS = 40
+
+# opcodes per callback in report()
+REPORT_TOP = 10
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#------------------------------------------------------------------------------
+# SETTINGS
+#------------------------------------------------------------------------------
+
+def register_settings():
+    from binaryninja.settings import Settings
+    settings = Settings()
+    settings.register_group('lr35902', 'LR35902')
+    settings.register_setting(SETTING_PROFILE, '''{
+        "title": "Profile the architecture callbacks",
+        "type": "boolean",
+        "default": false,
+        "description": "Count the calls and time of the LR35902 callbacks per opcode, reported on exit. Takes effect on restart.",
+        "ignore": ["SettingsProjectScope", "SettingsResourceScope"]
+    }''')
+    settings.register_setting(SETTING_STACKS, '''{
+        "title": "Profiler stack file",
+        "type": "string",
+        "default": "",
+        "description": "With profiling on, sample the plugin's Python stacks into this file (collapsed stacks, for flame graphs). Takes effect on restart.",
+        "ignore": ["SettingsProjectScope", "SettingsResourceScope"]
+    }''')
+
+def enabled():
+    """ whether the environment or the settings turn profiling on """
+    if os.environ.get(ENV_PROFILE):
+        return True
+    try:
+        from binaryninja.settings import Settings
+        return Settings().get_bool(SETTING_PROFILE)
+    except Exception:
+        return False
+
+def stacks_path():
+    """ where the sampled stacks go, None to not sample """
+    path = os.environ.get(ENV_STACKS)
+    if path:
+        return path
+    try:
+        from binaryninja.settings import Settings
+        return Settings().get_string(SETTING_STACKS) or None
+    except Exception:
+        return None
+
+#------------------------------------------------------------------------------
+# STATISTICS
+#------------------------------------------------------------------------------
+
+class Stat(object):
+    """ calls and time of one callback (for one opcode) """
+    __slots__ = ('count', 'total', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        self.histogram[min(ns.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """ upper bound in ns of the bucket the fraction of calls falls in """
+        wanted = self.count * fraction
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= wanted:
+                return 1 << bucket
+        return 0
+
+# callback -> {key: Stat}, the key being the opcode index (or (operation,
+# flag) for the flag lifters), None for the callback as a whole. Updated
+# without a lock from Binja's analysis threads, concurrent calls can lose a
+# count now and then.
+STATS = {}
+
+# opcode index -> times lift_unimplemented() lifted it
+UNIMPLEMENTED = {}
+
+def stat(callback, key):
+    keys = STATS.setdefault(callback, {})
+    found = keys.get(key)
+    if found is None:
+        found = keys[key] = Stat()
+    return found
+
+def reset():
+    STATS.clear()
+    UNIMPLEMENTED.clear()
+
+#------------------------------------------------------------------------------
+# WRAPPING
+#------------------------------------------------------------------------------
+
+def _opcode_key(data):
+    if not data or (data[0] == 0xCB and len(data) < 2):
+        return None
+    return opcode_index(data)
+
+def _flag_key(op, size, write_type, flag, operands, il):
+    return (getattr(op, 'name', op), flag)
+
+def timed(callback, func, key_of):
+    """ func counted and timed under callback, per key_of(*args) """
+    from time import perf_counter_ns
+    import functools
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        start = perf_counter_ns()
+        try:
+            return func(*args)
+        finally:
+            ns = perf_counter_ns() - start
+            stat(callback, None).add(ns)
+            stat(callback, key_of(*args)).add(ns)
+    return wrapper
+
+def instrument(arch_class):
+    """ wraps the Architecture callbacks of arch_class (before it's
+        registered) and, once it's loaded, the lifter """
+    from . import LR35902Arch
+    if getattr(arch_class, '_instrumented', False):
+        return
+    arch_class._instrumented = True
+
+    for name in ('get_instruction_info', 'get_instruction_text', 'get_instruction_low_level_il'):
+        setattr(arch_class, name, timed(name, getattr(arch_class, name), lambda self, data, addr, *il: _opcode_key(data)))
+    arch_class.get_flag_write_low_level_il = timed('get_flag_write_low_level_il',
+        arch_class.get_flag_write_low_level_il, lambda self, *args: _flag_key(*args))
+
+    # the lifter stays out of startup, it's instrumented on first use
+    load_lifter = LR35902Arch.lifter
+    def lifter():
+        module = load_lifter()
+        if not getattr(module, '_instrumented', False):
+            instrument_lifter(module)
+        return module
+    LR35902Arch.lifter = lifter
+
+    path = stacks_path()
+    if path:
+        Sampler().start(path)
+
+    import atexit
+    atexit.register(lambda: sys.stderr.write(report() + '\n'))
+
+def instrument_lifter(module):
+    """ wraps module's (LR35902IL) gen_flag_il() and counts the opcodes
+        dispatched to lift_unimplemented() """
+    module.gen_flag_il = timed('gen_flag_il', module.gen_flag_il, _flag_key)
+
+    def unimplemented(opcode, fallback):
+        def lift(addr, decoded, il, ctx):
+            UNIMPLEMENTED[opcode] = UNIMPLEMENTED.get(opcode, 0) + 1
+            return fallback(addr, decoded, il, ctx)
+        return lift
+
+    for opcode, lift in enumerate(module.OPCODE_LIFTERS):
+        if lift is module.lift_unimplemented:
+            module.OPCODE_LIFTERS[opcode] = unimplemented(opcode, lift)
+    module._instrumented = True
+
+#------------------------------------------------------------------------------
+# STACK SAMPLING
+#------------------------------------------------------------------------------
+
+class Sampler(object):
+    """ samples the stacks of the threads running plugin code every
+        SAMPLE_INTERVAL, counted by collapsed stack ('a;b;c') """
+
+    # samplers don't sample each other
+    threads = set()
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self.thread = None
+        self.running = False
+
+    def start(self, path=None):
+        """ samples until stop(), or exit if path is given to write to """
+        import threading
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='lr35902-sampler', daemon=True)
+        self.thread.start()
+        if path:
+            import atexit
+            atexit.register(self.stop, path)
+
+    def stop(self, path=None):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            Sampler.threads.discard(self.thread.ident)
+            self.thread = None
+        if path:
+            self.write(path)
+
+    def run(self):
+        import time
+        Sampler.threads.add(self.thread.ident)
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident not in Sampler.threads:
+                    self.sample(frame)
+            time.sleep(self.interval)
+
+    def sample(self, frame):
+        names = []
+        in_plugin = False
+        while frame is not None:
+            code = frame.f_code
+            in_plugin = in_plugin or code.co_filename.startswith(PLUGIN_DIR)
+            names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        if in_plugin:
+            stack = ';'.join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write(self, path):
+        with open(path, 'w') as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write('%s %d\n' % (stack, count))
+
+#------------------------------------------------------------------------------
+# REPORT
+#------------------------------------------------------------------------------
+
+def opcode_text(key):
+    """ 'ld a,b' like text of a report key """
+    if isinstance(key, tuple):
+        return '%s %s' % key
+    from lr35902dis.lr35902 import decode, decoded2str
+    return decoded2str(decode(opcode_bytes(key), 0))
+
+def report(top=REPORT_TOP):
+    lines = []
+    for callback, keys in sorted(STATS.items()):
+        total = keys.get(None)
+        if total is None or not total.count:
+            continue
+        lines.append('%s: %d calls, %.3fs, mean %dns, p50 <%dns, p99 <%dns' % (
+            callback, total.count, total.total / 1e9, total.total // total.count,
+            total.percentile(0.5), total.percentile(0.99)))
+        slowest = sorted((item for item in keys.items() if item[0] is not None), key=lambda item: -item[1].total)
+        for key, found in slowest[:top]:
+            lines.append('    %-24s %10d calls %8.3fs %5.1f%%  p99 <%dns' % (
+                opcode_text(key), found.count, found.total / 1e9, 100.0 * found.total / total.total,
+                found.percentile(0.99)))
+    if UNIMPLEMENTED:
+        lines.append('unimplemented opcode lifter:')
+        for opcode, count in sorted(UNIMPLEMENTED.items(), key=lambda item: -item[1]):
+            lines.append('    %03X %-20s %10d' % (opcode, opcode_text(opcode), count))
+    return '\n'.join(lines) if lines else 'LR35902 profile: no calls recorded'
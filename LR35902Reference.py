@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+#
+# reference LR35902 model for checking the lifter, main exports:
+# State
+# random_states()
+# step()
+#
+# step() executes one instruction on a batch of CPU states at once, every
+# lane of the NumPy arrays in State being an independent CPU. It is written
+# from the hardware's semantics (Pan Docs, the opcode matrix), apart from the
+# decoder tables it shares nothing with LR35902IL, so comparing the two (see
+# lift_check) tests the lifting.
+#
+# memory is a window of MEMORY_SIZE bytes per lane, addresses wrap into it.
+# Both models see the same aliasing, which is all the comparison needs.
+
+import numpy
+
+from .LR35902Decoder import OPCODE_LEN, opcode_index
+
+MEMORY_SIZE = 0x400
+MEMORY_MASK = MEMORY_SIZE - 1
+
+REGS8 = ('A', 'F', 'B', 'C', 'D', 'E', 'H', 'L')
+PAIRS = {'AF': ('A', 'F'), 'BC': ('B', 'C'), 'DE': ('D', 'E'), 'HL': ('H', 'L')}
+FLAGS = ('z', 'n', 'h', 'c')
+
+# bits of the flags in F
+F_BITS = {'z': 0x80, 'n': 0x40, 'h': 0x20, 'c': 0x10}
+
+#------------------------------------------------------------------------------
+# STATE
+#------------------------------------------------------------------------------
+
+class State(object):
+    """ a batch of CPU states: registers and SP as int64 arrays, flags and
+        IME as bool arrays, memory as a (lanes, MEMORY_SIZE) uint8 array and
+        pc, the address execution goes on at """
+    __slots__ = ('regs', 'flags', 'ime', 'mem', 'pc')
+
+    def __init__(self, regs, flags, ime, mem, pc):
+        self.regs = regs
+        self.flags = flags
+        self.ime = ime
+        self.mem = mem
+        self.pc = pc
+
+    def __len__(self):
+        return len(self.ime)
+
+    def copy(self):
+        return State(
+            dict((name, value.copy()) for name, value in self.regs.items()),
+            dict((name, value.copy()) for name, value in self.flags.items()),
+            self.ime.copy(), self.mem.copy(), self.pc.copy())
+
+    # 8-bit registers and pairs by name, SP
+
+    def get(self, name):
+        if name in PAIRS:
+            high, low = PAIRS[name]
+            return self.regs[high] << 8 | self.regs[low]
+        return self.regs[name]
+
+    def set(self, name, value, mask=None):
+        if name in PAIRS:
+            high, low = PAIRS[name]
+            self.set(high, (value >> 8) & 0xFF, mask)
+            self.set(low, value & 0xFF, mask)
+            return
+        value = value & (0xFFFF if name == 'SP' else 0xFF)
+        if mask is None:
+            self.regs[name] = numpy.broadcast_to(value, self.regs[name].shape).astype(numpy.int64)
+        else:
+            self.regs[name] = numpy.where(mask, value, self.regs[name])
+
+    def set_flag(self, name, value, mask=None):
+        value = numpy.asarray(value).astype(bool)
+        if mask is None:
+            self.flags[name] = numpy.broadcast_to(value, self.ime.shape).copy()
+        else:
+            self.flags[name] = numpy.where(mask, value, self.flags[name])
+
+    # memory
+
+    def load(self, size, addr):
+        """ little endian value of size bytes at addr """
+        lanes = numpy.arange(len(self))
+        value = numpy.zeros(len(self), dtype=numpy.int64)
+        for i in range(size):
+            value |= self.mem[lanes, (addr + i) & MEMORY_MASK].astype(numpy.int64) << (8 * i)
+        return value
+
+    def store(self, size, addr, value, mask=None):
+        lanes = numpy.arange(len(self))
+        if mask is not None:
+            lanes, addr, value = lanes[mask], numpy.broadcast_to(addr, mask.shape)[mask], numpy.broadcast_to(value, mask.shape)[mask]
+        for i in range(size):
+            self.mem[lanes, (addr + i) & MEMORY_MASK] = (value >> (8 * i)) & 0xFF
+
+def random_states(lanes, rng):
+    regs = dict((name, rng.integers(0, 0x100, lanes, dtype=numpy.int64)) for name in REGS8)
+    regs['SP'] = rng.integers(0, 0x10000, lanes, dtype=numpy.int64)
+    flags = dict((name, rng.integers(0, 2, lanes).astype(bool)) for name in FLAGS)
+    # F holds what the flags say, as after any flag write on hardware
+    regs['F'] = sum(flags[name].astype(numpy.int64) * bit for name, bit in F_BITS.items())
+    ime = rng.integers(0, 2, lanes).astype(bool)
+    mem = rng.integers(0, 0x100, (lanes, MEMORY_SIZE), dtype=numpy.uint8)
+    return State(regs, flags, ime, mem, numpy.zeros(lanes, dtype=numpy.int64))
+
+#------------------------------------------------------------------------------
+# OPERANDS
+#------------------------------------------------------------------------------
+
+# register operands by encoding, 6 being (hl)
+R8 = ('B', 'C', 'D', 'E', 'H', 'L', '(HL)', 'A')
+RP = ('BC', 'DE', 'HL', 'SP')
+RP2 = ('BC', 'DE', 'HL', 'AF')
+
+def get_r8(state, index):
+    if R8[index] == '(HL)':
+        return state.load(1, state.get('HL'))
+    return state.get(R8[index])
+
+def set_r8(state, index, value):
+    if R8[index] == '(HL)':
+        state.store(1, state.get('HL'), value & 0xFF)
+    else:
+        state.set(R8[index], value)
+
+def get_rp(state, name):
+    return state.regs['SP'] if name == 'SP' else state.get(name)
+
+def set_rp(state, name, value):
+    state.set(name, value & 0xFFFF)
+
+def condition(state, index):
+    """ nz, z, nc, c """
+    flag = state.flags['z' if index < 2 else 'c']
+    return flag if index & 1 else ~flag
+
+def push(state, value, mask=None):
+    sp = (state.regs['SP'] - 2) & 0xFFFF
+    state.store(2, sp, value, mask)
+    state.set('SP', sp, mask)
+
+def pop(state, mask=None):
+    value = state.load(2, state.regs['SP'])
+    state.set('SP', state.regs['SP'] + 2, mask)
+    return value
+
+def set_flags(state, z=None, n=None, h=None, c=None):
+    for name, value in (('z', z), ('n', n), ('h', h), ('c', c)):
+        if value is not None:
+            state.set_flag(name, value)
+
+#------------------------------------------------------------------------------
+# ALU
+#------------------------------------------------------------------------------
+
+def alu(state, index, value):
+    """ add adc sub sbc and xor or cp of A and value """
+    a = state.get('A')
+    carry = state.flags['c'].astype(numpy.int64)
+    if index == 0 or index == 1:
+        carry = carry if index == 1 else 0
+        result = a + value + carry
+        set_flags(state, z=(result & 0xFF) == 0, n=False,
+            h=(a & 0xF) + (value & 0xF) + carry > 0xF, c=result > 0xFF)
+    elif index == 2 or index == 3 or index == 7:
+        carry = carry if index == 3 else 0
+        result = a - value - carry
+        set_flags(state, z=(result & 0xFF) == 0, n=True,
+            h=(a & 0xF) < (value & 0xF) + carry, c=a < value + carry)
+        if index == 7:
+            return
+    elif index == 4:
+        result = a & value
+        set_flags(state, z=result == 0, n=False, h=True, c=False)
+    elif index == 5:
+        result = a ^ value
+        set_flags(state, z=result == 0, n=False, h=False, c=False)
+    else:
+        result = a | value
+        set_flags(state, z=result == 0, n=False, h=False, c=False)
+    state.set('A', result & 0xFF)
+
+def rotate(state, index, value):
+    """ rlc rrc rl rr sla sra swap srl of value, the result and c """
+    carry = state.flags['c'].astype(numpy.int64)
+    if index == 0:
+        return ((value << 1) | (value >> 7)) & 0xFF, value >> 7
+    if index == 1:
+        return ((value >> 1) | (value << 7)) & 0xFF, value & 1
+    if index == 2:
+        return ((value << 1) | carry) & 0xFF, value >> 7
+    if index == 3:
+        return (value >> 1) | (carry << 7), value & 1
+    if index == 4:
+        return (value << 1) & 0xFF, value >> 7
+    if index == 5:
+        return (value >> 1) | (value & 0x80), value & 1
+    if index == 6:
+        return ((value << 4) | (value >> 4)) & 0xFF, numpy.zeros_like(value)
+    return value >> 1, value & 1
+
+def sp_offset(state, offset):
+    """ SP + offset of add sp,e and ld hl,sp+e, setting the flags """
+    sp = state.regs['SP']
+    set_flags(state, z=False, n=False,
+        h=(sp & 0xF) + (offset & 0xF) > 0xF, c=(sp & 0xFF) + (offset & 0xFF) > 0xFF)
+    return (sp + offset) & 0xFFFF
+
+def daa(state):
+    a = state.get('A')
+    n, h, c = state.flags['n'], state.flags['h'], state.flags['c']
+    high = c | (~n & (a > 0x99))
+    low = h | (~n & ((a & 0xF) > 9))
+    adjust = numpy.where(high, 0x60, 0) + numpy.where(low, 0x06, 0)
+    a = numpy.where(n, a - adjust, a + adjust) & 0xFF
+    state.set('A', a)
+    set_flags(state, z=a == 0, h=False, c=high)
+
+#------------------------------------------------------------------------------
+# STEP
+#------------------------------------------------------------------------------
+
+def step(data, addr, state):
+    """ executes the instruction in data at addr on every lane of state, in
+        place """
+    opcode = opcode_index(data)
+    length = OPCODE_LEN[opcode]
+    n8 = data[1] if length > 1 else 0
+    n16 = data[1] | data[2] << 8 if length > 2 else 0
+    e8 = n8 - 0x100 if n8 & 0x80 else n8
+    next_addr = addr + length
+    state.pc = numpy.full(len(state), next_addr, dtype=numpy.int64)
+
+    if opcode & 0x100:
+        op, y, z = (opcode >> 6) & 3, (opcode >> 3) & 7, opcode & 7
+        value = get_r8(state, z)
+        if op == 0:
+            result, carry = rotate(state, y, value)
+            set_r8(state, z, result)
+            set_flags(state, z=result == 0, n=False, h=False, c=carry)
+        elif op == 1:
+            set_flags(state, z=(value >> y) & 1 == 0, n=False, h=True)
+        elif op == 2:
+            set_r8(state, z, value & ~(1 << y))
+        else:
+            set_r8(state, z, value | (1 << y))
+        return
+
+    x, y, z = opcode >> 6, (opcode >> 3) & 7, opcode & 7
+    p, q = y >> 1, y & 1
+
+    if x == 1:
+        if opcode != 0x76:
+            set_r8(state, y, get_r8(state, z))
+        return
+    if x == 2:
+        alu(state, y, get_r8(state, z))
+        return
+
+    if x == 0:
+        if z == 0:
+            if y == 1:
+                state.store(2, n16, state.regs['SP'])
+            elif y == 3:
+                state.pc[:] = (next_addr + e8) & 0xFFFF
+            elif y >= 4:
+                state.pc = numpy.where(condition(state, y - 4), (next_addr + e8) & 0xFFFF, next_addr)
+            # nop, stop
+        elif z == 1:
+            if q == 0:
+                set_rp(state, RP[p], n16)
+            else:
+                hl, rr = state.get('HL'), get_rp(state, RP[p])
+                set_flags(state, n=False, h=(hl & 0xFFF) + (rr & 0xFFF) > 0xFFF, c=hl + rr > 0xFFFF)
+                set_rp(state, 'HL', hl + rr)
+        elif z == 2:
+            pointer = ('BC', 'DE', 'HL', 'HL')[p]
+            address = state.get(pointer)
+            if q == 0:
+                state.store(1, address, state.get('A'))
+            else:
+                state.set('A', state.load(1, address))
+            if p == 2:
+                set_rp(state, 'HL', address + 1)
+            elif p == 3:
+                set_rp(state, 'HL', address - 1)
+        elif z == 3:
+            set_rp(state, RP[p], get_rp(state, RP[p]) + (1 if q == 0 else -1))
+        elif z == 4 or z == 5:
+            value = get_r8(state, y)
+            if z == 4:
+                result = (value + 1) & 0xFF
+                set_flags(state, z=result == 0, n=False, h=(value & 0xF) == 0xF)
+            else:
+                result = (value - 1) & 0xFF
+                set_flags(state, z=result == 0, n=True, h=(value & 0xF) == 0)
+            set_r8(state, y, result)
+        elif z == 6:
+            set_r8(state, y, numpy.full(len(state), n8, dtype=numpy.int64))
+        elif y < 4:
+            # rlca rrca rla rra
+            result, carry = rotate(state, y, state.get('A'))
+            state.set('A', result)
+            set_flags(state, z=False, n=False, h=False, c=carry)
+        elif y == 4:
+            daa(state)
+        elif y == 5:
+            state.set('A', ~state.get('A') & 0xFF)
+            set_flags(state, n=True, h=True)
+        elif y == 6:
+            set_flags(state, n=False, h=False, c=True)
+        else:
+            set_flags(state, n=False, h=False, c=~state.flags['c'])
+        return
+
+    # x == 3
+    if z == 0:
+        if y < 4:
+            taken = condition(state, y)
+            target = state.load(2, state.regs['SP'])
+            state.set('SP', state.regs['SP'] + 2, taken)
+            state.pc = numpy.where(taken, target, next_addr)
+        elif y == 4:
+            state.store(1, 0xFF00 + n8, state.get('A'))
+        elif y == 5:
+            state.set('SP', sp_offset(state, e8))
+        elif y == 6:
+            state.set('A', state.load(1, 0xFF00 + n8))
+        else:
+            set_rp(state, 'HL', sp_offset(state, e8))
+    elif z == 1:
+        if q == 0:
+            value = pop(state)
+            if p == 3:
+                state.set('A', value >> 8)
+                state.set('F', value & 0xF0)
+                for name, bit in F_BITS.items():
+                    state.set_flag(name, value & bit)
+            else:
+                set_rp(state, RP2[p], value)
+        elif p == 0 or p == 1:
+            state.pc = pop(state)
+            if p == 1:
+                state.ime[:] = True
+        elif p == 2:
+            state.pc = state.get('HL')
+        else:
+            state.set('SP', state.get('HL'))
+    elif z == 2:
+        if y < 4:
+            state.pc = numpy.where(condition(state, y), n16, next_addr)
+        elif y == 4:
+            state.store(1, 0xFF00 + state.get('C'), state.get('A'))
+        elif y == 5:
+            state.store(1, n16, state.get('A'))
+        elif y == 6:
+            state.set('A', state.load(1, 0xFF00 + state.get('C')))
+        else:
+            state.set('A', state.load(1, n16))
+    elif z == 3:
+        if y == 0:
+            state.pc[:] = n16
+        elif y == 6:
+            state.ime[:] = False
+        elif y == 7:
+            state.ime[:] = True
+    elif z == 4:
+        taken = condition(state, y)
+        push(state, numpy.full(len(state), next_addr, dtype=numpy.int64), taken)
+        state.pc = numpy.where(taken, n16, next_addr)
+    elif z == 5:
+        if q == 0:
+            if p == 3:
+                flags = sum(state.flags[name].astype(numpy.int64) * bit for name, bit in F_BITS.items())
+                push(state, state.get('A') << 8 | flags)
+            else:
+                push(state, get_rp(state, RP2[p]))
+        else:
+            push(state, numpy.full(len(state), next_addr, dtype=numpy.int64))
+            state.pc[:] = n16
+    elif z == 6:
+        alu(state, y, numpy.full(len(state), n8, dtype=numpy.int64))
+    else:
+        push(state, numpy.full(len(state), next_addr, dtype=numpy.int64))
+        state.pc[:] = y * 8
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#
+# disassembly text, main exports:
+# instruction_template()
+# instruction_tokens()
+#
+# tokens are (kind, text, value) tuples where kind is the name of the
+# InstructionTextTokenType member, so this works without Binary Ninja; the
+# Architecture turns them into InstructionTextTokens.
+#
+# everything about an instruction's text that only depends on its opcode
+# (mnemonic, separators, brackets, register and condition names, the fixed
+# immediates of bit/rst) is computed once per opcode into a template, only
+# the immediates and addresses are formatted per instruction.
+
+from lr35902dis.lr35902 import decode, DECODE_STATUS, OPER_TYPE, REG, CC
+
+from .LR35902Decoder import OPCODE_COUNT, opcode_bytes
+
+INSTRUCTION = 'InstructionToken'
+TEXT = 'TextToken'
+SEPARATOR = 'OperandSeparatorToken'
+REGISTER = 'RegisterToken'
+INTEGER = 'IntegerToken'
+ADDRESS = 'PossibleAddressToken'
+BEGIN_MEM = 'BeginMemoryOperandToken'
+END_MEM = 'EndMemoryOperandToken'
+DATA_SYMBOL = 'DataSymbolToken'
+
+CC_TO_STR = {
+    CC.ALWAYS:'1', CC.NOT_Z:'nz', CC.Z:'z',
+    CC.NOT_C:'nc', CC.C:'c'
+}
+
+#------------------------------------------------------------------------------
+# OPERAND FORMATTING
+#------------------------------------------------------------------------------
+
+IO_BASE = 0xFF00
+IO_SIZE = 0x80
+
+# IO register names indexed by addr - IO_BASE, None where nothing is mapped;
+# built from hardware_documentation (and its long descriptions) the first
+# time an IO address is rendered
+_io_names = None
+
+def _build_io_names():
+    from .hardware_documentation import IO_REGISTERS
+    names = [None] * IO_SIZE
+    for addr, (name, _, _) in IO_REGISTERS.items():
+        if IO_BASE <= addr < IO_BASE + IO_SIZE:
+            names[addr - IO_BASE] = name
+    return names
+
+def io_register_name(addr):
+    """ name of the IO register at addr, None if there isn't one """
+    global _io_names
+    if IO_BASE <= addr < IO_BASE + IO_SIZE:
+        if _io_names is None:
+            _io_names = _build_io_names()
+        return _io_names[addr - IO_BASE]
+    return None
+
+def reg2str(reg):
+    reg_name = reg.name if isinstance(reg, REG) else reg
+    # enum AF_ should be returned as AF'
+    return reg_name if reg_name[-1] != '_' else reg_name[:-1]+"'"
+
+def imm2str(val):
+    if val == 0:
+        return '0'
+    elif val >= 16:
+        return '0x%x' % val
+    else:
+        return '%d' % val
+
+def reg_tokens(val):
+    return [(REGISTER, reg2str(val), 0)]
+
+def addr_tokens(val):
+    val = val & 0xFFFF
+    return [(ADDRESS, '0x%04x' % val, val)]
+
+def addr_deref_tokens(val):
+    name = io_register_name(val)
+    if name is not None:
+        return [(DATA_SYMBOL, name, val)]
+    return [(ADDRESS, '0x%04x' % val, val)]
+
+def addr_ff00_tokens(val):
+    val = 0xFF00 + (val & 0xff)
+    name = io_register_name(val)
+    if name is not None:
+        return [(DATA_SYMBOL, name, val)]
+    return [(ADDRESS, '0x{:04x}'.format(val), val)]
+
+def imm_tokens(val):
+    return [(INTEGER, imm2str(val), val)]
+
+def cond_tokens(val):
+    return [(TEXT, CC_TO_STR[val], 0)]
+
+def sp_offset_tokens(val):
+    offset = '{:+02x}'.format(val)
+    sign, offset = offset[0], offset[1:]
+    return [(TEXT, sign, 0), (INTEGER, offset, abs(val))]
+
+# oper_type -> (tokens before the value, value formatter, tokens after)
+OPERAND_LAYOUT = {
+    OPER_TYPE.REG: ((), reg_tokens, ()),
+    OPER_TYPE.REG_DEREF: (
+        ((BEGIN_MEM, '(', 0),),
+        reg_tokens,
+        ((END_MEM, ')', 0),)),
+    OPER_TYPE.REG_DEREF_DEC: (
+        ((BEGIN_MEM, '(', 0),),
+        reg_tokens,
+        ((TEXT, '-', 0), (END_MEM, ')', 0))),
+    OPER_TYPE.REG_DEREF_INC: (
+        ((BEGIN_MEM, '(', 0),),
+        reg_tokens,
+        ((TEXT, '+', 0), (END_MEM, ')', 0))),
+    OPER_TYPE.REG_DEREF_FF00: (
+        ((BEGIN_MEM, '(', 0), (ADDRESS, '0xFF00', 0xFF00), (TEXT, '+', 0)),
+        reg_tokens,
+        ((END_MEM, ')', 0),)),
+    OPER_TYPE.ADDR: ((), addr_tokens, ()),
+    OPER_TYPE.ADDR_DEREF: (
+        ((BEGIN_MEM, '(', 0),),
+        addr_deref_tokens,
+        ((END_MEM, ')', 0),)),
+    OPER_TYPE.ADDR_DEREF_FF00: (
+        ((BEGIN_MEM, '(', 0),),
+        addr_ff00_tokens,
+        ((END_MEM, ')', 0),)),
+    OPER_TYPE.IMM: ((), imm_tokens, ()),
+    OPER_TYPE.COND: ((), cond_tokens, ()),
+    OPER_TYPE.SP_OFFSET: (
+        ((BEGIN_MEM, '(', 0), (REGISTER, 'SP', 0)),
+        sp_offset_tokens,
+        ((END_MEM, ')', 0),)),
+}
+
+def operand_tokens(oper_type, oper_val):
+    if oper_type not in OPERAND_LAYOUT:
+        raise Exception('unknown operand type: ' + str(oper_type))
+    (before, fmt, after) = OPERAND_LAYOUT[oper_type]
+    return list(before) + fmt(oper_val) + list(after)
+
+#------------------------------------------------------------------------------
+# TEMPLATES
+#------------------------------------------------------------------------------
+
+# two decodes of the same opcode with different operand bytes and addresses,
+# operand values that differ between them come from the instruction bytes
+_PROBE_A = (b'\x00\x00\x00', 0x0000)
+_PROBE_B = (b'\xa5\x5a\xff', 0x4321)
+
+def build_template(opcode):
+    """ returns the template for an opcode index, a tuple of
+        (fixed tokens, slot) pairs where slot is None or the
+        (operand index, value formatter) to fill in per instruction
+
+        None for invalid opcodes """
+    encoding = opcode_bytes(opcode)[:2 if opcode & 0x100 else 1]
+    decoded = decode(encoding + _PROBE_A[0], _PROBE_A[1])
+    if decoded.status != DECODE_STATUS.OK:
+        return None
+    other = decode(encoding + _PROBE_B[0], _PROBE_B[1])
+
+    template = []
+    fixed = [(INSTRUCTION, decoded.op.name, 0)]
+    if decoded.operands:
+        fixed.append((TEXT, ' ', 0))
+
+    for i, (oper_type, oper_val) in enumerate(decoded.operands):
+        if oper_type not in OPERAND_LAYOUT:
+            raise Exception('unknown operand type: ' + str(oper_type))
+        (before, fmt, after) = OPERAND_LAYOUT[oper_type]
+
+        if other.operands[i] == (oper_type, oper_val):
+            fixed.extend(operand_tokens(oper_type, oper_val))
+        else:
+            fixed.extend(before)
+            template.append((tuple(fixed), (i, fmt)))
+            fixed = list(after)
+
+        # if this isn't the last operand, add comma
+        if i < len(decoded.operands)-1:
+            fixed.append((SEPARATOR, ',', 0))
+
+    template.append((tuple(fixed), None))
+    return tuple(template)
+
+_templates = [None] * OPCODE_COUNT
+_built = [False] * OPCODE_COUNT
+
+def instruction_template(opcode):
+    """ memoized build_template() """
+    if not _built[opcode]:
+        _templates[opcode] = build_template(opcode)
+        _built[opcode] = True
+    return _templates[opcode]
+
+def instruction_tokens(decoded, opcode):
+    """ the (kind, text, value) tokens of a successfully decoded instruction """
+    result = []
+    for fixed, slot in instruction_template(opcode):
+        result.extend(fixed)
+        if slot:
+            (i, fmt) = slot
+            result.extend(fmt(decoded.operands[i][1]))
+    return result
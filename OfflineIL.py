@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#
+# stand-in for Binary Ninja's LowLevelILFunction so the lifter (LR35902IL)
+# can run in a plain Python process, main exports:
+# OfflineILFunction
+# lift()
+# lift_range()
+#
+# OfflineILFunction has the method surface of LowLevelILFunction that
+# gen_instr_il() and gen_flag_il() use and records the emitted expression
+# trees instead of handing them to the core: expressions are indices into
+# parallel arrays of operation, size, flag write type and operands, same as
+# ExpressionIndex is for Binja.
+#
+# LR35902IL falls back to the label, enum and register classes defined here
+# when binaryninja can't be imported.
+
+from array import array
+from enum import IntEnum
+
+from lr35902dis.lr35902 import DECODE_STATUS
+
+from .LR35902Decoder import DECODE_CACHE, opcode_index
+
+#------------------------------------------------------------------------------
+# BINJA STAND-INS
+#------------------------------------------------------------------------------
+
+LowLevelILOperation = IntEnum('LowLevelILOperation', [
+    'LLIL_NOP', 'LLIL_SET_REG', 'LLIL_SET_REG_SPLIT', 'LLIL_SET_FLAG',
+    'LLIL_LOAD', 'LLIL_STORE', 'LLIL_PUSH', 'LLIL_POP',
+    'LLIL_REG', 'LLIL_CONST', 'LLIL_CONST_PTR', 'LLIL_FLAG', 'LLIL_FLAG_BIT',
+    'LLIL_ADD', 'LLIL_ADC', 'LLIL_SUB', 'LLIL_SBB',
+    'LLIL_AND', 'LLIL_OR', 'LLIL_XOR',
+    'LLIL_LSL', 'LLIL_LSR', 'LLIL_ASR', 'LLIL_ROL', 'LLIL_RLC', 'LLIL_ROR', 'LLIL_RRC',
+    'LLIL_MUL', 'LLIL_DIVU', 'LLIL_MODU',
+    'LLIL_NEG', 'LLIL_NOT', 'LLIL_SX', 'LLIL_ZX', 'LLIL_LOW_PART',
+    'LLIL_JUMP', 'LLIL_JUMP_TO', 'LLIL_CALL', 'LLIL_TAILCALL', 'LLIL_RET', 'LLIL_NORET',
+    'LLIL_IF', 'LLIL_GOTO', 'LLIL_FLAG_COND', 'LLIL_FLAG_GROUP',
+    'LLIL_CMP_E', 'LLIL_CMP_NE', 'LLIL_CMP_SLT', 'LLIL_CMP_ULT', 'LLIL_CMP_SLE', 'LLIL_CMP_ULE',
+    'LLIL_CMP_SGE', 'LLIL_CMP_UGE', 'LLIL_CMP_SGT', 'LLIL_CMP_UGT',
+    'LLIL_TEST_BIT', 'LLIL_BOOL_TO_INT',
+    'LLIL_SYSCALL', 'LLIL_INTRINSIC', 'LLIL_BP', 'LLIL_TRAP',
+    'LLIL_UNDEF', 'LLIL_UNIMPL', 'LLIL_UNIMPL_MEM',
+], start=0)
+
+LowLevelILFlagCondition = IntEnum('LowLevelILFlagCondition', [
+    'LLFC_E', 'LLFC_NE', 'LLFC_SLT', 'LLFC_ULT', 'LLFC_SLE', 'LLFC_ULE',
+    'LLFC_SGE', 'LLFC_UGE', 'LLFC_SGT', 'LLFC_UGT', 'LLFC_NEG', 'LLFC_POS',
+    'LLFC_O', 'LLFC_NO',
+], start=0)
+
+class Architecture(object):
+    """ Architecture['LR35902'] is only ever handed back to
+        get_label_for_address(), the name does """
+    def __class_getitem__(cls, name):
+        return name
+
+class LowLevelILLabel(object):
+    __slots__ = ('operand',)
+
+    def __init__(self):
+        # instruction index once marked
+        self.operand = None
+
+class ILRegister(object):
+    __slots__ = ('name', 'index')
+
+    def __init__(self, name, index=0):
+        self.name = name
+        self.index = index
+
+    def __str__(self):
+        return self.name
+
+class ILFlag(object):
+    __slots__ = ('name', 'index')
+
+    def __init__(self, name, index=0):
+        self.name = name
+        self.index = index
+
+    def __str__(self):
+        return self.name
+
+# temp registers have the top bit set, as in Binja
+def LLIL_TEMP(n):
+    return n | 0x80000000
+
+#------------------------------------------------------------------------------
+# RECORDING IL FUNCTION
+#------------------------------------------------------------------------------
+
+OP = LowLevelILOperation
+
+class OfflineILFunction(object):
+    """ records the expressions and instructions a lifter emits
+
+        ops[i], sizes[i], flags[i], operands[i]  expression i
+        instructions[j]                          root expression of
+                                                 instruction j
+        addresses[j]                             address it was lifted at
+
+        operands are expression indices, or plain values for registers
+        (names), flags (names), constants and labels """
+
+    def __init__(self, arch=None):
+        self.arch = arch
+        self.ops = array('B')
+        self.sizes = array('B')
+        self.flags = []
+        self.operands = []
+        self.instructions = array('I')
+        self.addresses = array('I')
+        self.current_address = 0
+        self.labels = {}
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def set_current_address(self, value, arch=None):
+        self.current_address = value
+
+    # expressions
+
+    def expr(self, operation, *operands, size=0, flags=None):
+        if not isinstance(operation, OP):
+            operation = OP[operation.name]
+        index = len(self.ops)
+        self.ops.append(operation)
+        self.sizes.append(size)
+        self.flags.append(flags)
+        self.operands.append(operands)
+        return index
+
+    def append(self, expr):
+        self.instructions.append(expr)
+        self.addresses.append(self.current_address)
+        return len(self.instructions) - 1
+
+    def nop(self):
+        return self.expr(OP.LLIL_NOP)
+
+    def const(self, size, value):
+        return self.expr(OP.LLIL_CONST, value, size=size)
+
+    def const_pointer(self, size, value):
+        return self.expr(OP.LLIL_CONST_PTR, value, size=size)
+
+    def reg(self, size, reg):
+        return self.expr(OP.LLIL_REG, str(reg), size=size)
+
+    def set_reg(self, size, reg, value, flags=None):
+        return self.expr(OP.LLIL_SET_REG, str(reg), value, size=size, flags=flags)
+
+    def set_reg_split(self, size, hi, lo, value, flags=None):
+        return self.expr(OP.LLIL_SET_REG_SPLIT, str(hi), str(lo), value, size=size, flags=flags)
+
+    def flag(self, flag):
+        return self.expr(OP.LLIL_FLAG, str(flag))
+
+    def flag_bit(self, size, flag, bit):
+        return self.expr(OP.LLIL_FLAG_BIT, str(flag), bit, size=size)
+
+    def set_flag(self, flag, value):
+        return self.expr(OP.LLIL_SET_FLAG, str(flag), value)
+
+    def flag_condition(self, cond, sem_class=None):
+        return self.expr(OP.LLIL_FLAG_COND, cond, sem_class)
+
+    def flag_group(self, sem_group):
+        return self.expr(OP.LLIL_FLAG_GROUP, sem_group)
+
+    def load(self, size, addr):
+        return self.expr(OP.LLIL_LOAD, addr, size=size)
+
+    def store(self, size, addr, value, flags=None):
+        return self.expr(OP.LLIL_STORE, addr, value, size=size, flags=flags)
+
+    def push(self, size, value):
+        return self.expr(OP.LLIL_PUSH, value, size=size)
+
+    def pop(self, size):
+        return self.expr(OP.LLIL_POP, size=size)
+
+    def _binary(operation):
+        def method(self, size, a, b, flags=None):
+            return self.expr(operation, a, b, size=size, flags=flags)
+        return method
+
+    def _carry(operation):
+        def method(self, size, a, b, carry, flags=None):
+            return self.expr(operation, a, b, carry, size=size, flags=flags)
+        return method
+
+    def _unary(operation):
+        def method(self, size, value, flags=None):
+            return self.expr(operation, value, size=size, flags=flags)
+        return method
+
+    def _compare(operation):
+        def method(self, size, a, b):
+            return self.expr(operation, a, b, size=size)
+        return method
+
+    add = _binary(OP.LLIL_ADD)
+    sub = _binary(OP.LLIL_SUB)
+    and_expr = _binary(OP.LLIL_AND)
+    or_expr = _binary(OP.LLIL_OR)
+    xor_expr = _binary(OP.LLIL_XOR)
+    shift_left = _binary(OP.LLIL_LSL)
+    logical_shift_right = _binary(OP.LLIL_LSR)
+    arith_shift_right = _binary(OP.LLIL_ASR)
+    rotate_left = _binary(OP.LLIL_ROL)
+    rotate_right = _binary(OP.LLIL_ROR)
+    mult = _binary(OP.LLIL_MUL)
+    div_unsigned = _binary(OP.LLIL_DIVU)
+    mod_unsigned = _binary(OP.LLIL_MODU)
+    test_bit = _compare(OP.LLIL_TEST_BIT)
+
+    add_carry = _carry(OP.LLIL_ADC)
+    sub_borrow = _carry(OP.LLIL_SBB)
+    rotate_left_carry = _carry(OP.LLIL_RLC)
+    rotate_right_carry = _carry(OP.LLIL_RRC)
+
+    neg_expr = _unary(OP.LLIL_NEG)
+    not_expr = _unary(OP.LLIL_NOT)
+    sign_extend = _unary(OP.LLIL_SX)
+    zero_extend = _unary(OP.LLIL_ZX)
+    low_part = _unary(OP.LLIL_LOW_PART)
+
+    compare_equal = _compare(OP.LLIL_CMP_E)
+    compare_not_equal = _compare(OP.LLIL_CMP_NE)
+    compare_signed_less_than = _compare(OP.LLIL_CMP_SLT)
+    compare_unsigned_less_than = _compare(OP.LLIL_CMP_ULT)
+    compare_signed_less_equal = _compare(OP.LLIL_CMP_SLE)
+    compare_unsigned_less_equal = _compare(OP.LLIL_CMP_ULE)
+    compare_signed_greater_equal = _compare(OP.LLIL_CMP_SGE)
+    compare_unsigned_greater_equal = _compare(OP.LLIL_CMP_UGE)
+    compare_signed_greater_than = _compare(OP.LLIL_CMP_SGT)
+    compare_unsigned_greater_than = _compare(OP.LLIL_CMP_UGT)
+
+    del _binary, _carry, _unary, _compare
+
+    def bool_to_int(self, size, value):
+        return self.expr(OP.LLIL_BOOL_TO_INT, value, size=size)
+
+    # control flow
+
+    def jump(self, dest):
+        return self.expr(OP.LLIL_JUMP, dest)
+
+    def call(self, dest):
+        return self.expr(OP.LLIL_CALL, dest)
+
+    def tailcall(self, dest):
+        return self.expr(OP.LLIL_TAILCALL, dest)
+
+    def ret(self, dest):
+        return self.expr(OP.LLIL_RET, dest)
+
+    def no_ret(self):
+        return self.expr(OP.LLIL_NORET)
+
+    def goto(self, label):
+        return self.expr(OP.LLIL_GOTO, label)
+
+    def if_expr(self, operand, t, f):
+        return self.expr(OP.LLIL_IF, operand, t, f)
+
+    def system_call(self):
+        return self.expr(OP.LLIL_SYSCALL)
+
+    def intrinsic(self, outputs, intrinsic, params, flags=None):
+        return self.expr(OP.LLIL_INTRINSIC, tuple(outputs), intrinsic, tuple(params), flags=flags)
+
+    def breakpoint(self):
+        return self.expr(OP.LLIL_BP)
+
+    def trap(self, value):
+        return self.expr(OP.LLIL_TRAP, value)
+
+    def undefined(self):
+        return self.expr(OP.LLIL_UNDEF)
+
+    def unimplemented(self):
+        return self.expr(OP.LLIL_UNIMPL)
+
+    def unimplemented_memory_ref(self, size, addr):
+        return self.expr(OP.LLIL_UNIMPL_MEM, addr, size=size)
+
+    # labels
+
+    def mark_label(self, label):
+        label.operand = len(self.instructions)
+
+    def add_label_for_address(self, arch, addr):
+        """ makes get_label_for_address() return a label for addr, Binja
+            does this for every known block start of the function """
+        if addr not in self.labels:
+            self.labels[addr] = LowLevelILLabel()
+        return self.labels[addr]
+
+    def get_label_for_address(self, arch, addr):
+        return self.labels.get(addr)
+
+    # inspection
+
+    def tree(self, expr):
+        """ expression as nested (operation name, size, flags, operands...)
+            tuples """
+        operands = tuple(
+            self.tree(op) if isinstance(op, int) and self._is_subexpr(self.ops[expr], i) else op
+            for i, op in enumerate(self.operands[expr])
+        )
+        return (OP(self.ops[expr]).name, self.sizes[expr], self.flags[expr]) + operands
+
+    # operand positions that are plain values rather than subexpressions
+    _VALUE_OPERANDS = {
+        OP.LLIL_CONST: (0,), OP.LLIL_CONST_PTR: (0,), OP.LLIL_REG: (0,),
+        OP.LLIL_SET_REG: (0,), OP.LLIL_SET_REG_SPLIT: (0, 1), OP.LLIL_FLAG: (0,),
+        OP.LLIL_FLAG_BIT: (0, 1), OP.LLIL_SET_FLAG: (0,), OP.LLIL_FLAG_COND: (0, 1),
+        OP.LLIL_FLAG_GROUP: (0,), OP.LLIL_GOTO: (0,), OP.LLIL_IF: (1, 2),
+        OP.LLIL_INTRINSIC: (0, 1, 2), OP.LLIL_TRAP: (0,),
+    }
+
+    def _is_subexpr(self, operation, i):
+        return i not in self._VALUE_OPERANDS.get(operation, ())
+
+    def instruction_trees(self):
+        return [self.tree(expr) for expr in self.instructions]
+
+    def expression_count(self):
+        return len(self.ops)
+
+    def unimplemented_count(self):
+        return self.ops.count(OP.LLIL_UNIMPL)
+
+#------------------------------------------------------------------------------
+# LIFTING
+#------------------------------------------------------------------------------
+
+def lift(data, addr, il):
+    """ get_instruction_low_level_il() into an OfflineILFunction, returns the
+        instruction length or None """
+    from . import LR35902IL
+
+    decoded = DECODE_CACHE.decode(data, addr)
+    if decoded.status != DECODE_STATUS.OK or decoded.len == 0:
+        return None
+
+    il.set_current_address(addr)
+    LR35902IL.gen_instr_il(addr, decoded, il, opcode_index(data))
+    return decoded.len
+
+def lift_range(data, base, il=None):
+    """ lifts a linear sweep of data mapped at base, returns the
+        OfflineILFunction and a list of (addr, length, expression count) per
+        instruction """
+    il = il if il is not None else OfflineILFunction()
+    stats = []
+    offset = 0
+    while offset < len(data):
+        before = il.expression_count()
+        length = lift(data[offset:offset+4], base + offset, il)
+        if length is None:
+            offset += 1
+            continue
+        stats.append((base + offset, length, il.expression_count() - before))
+        offset += length
+    return il, stats
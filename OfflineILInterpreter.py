@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#
+# interpreter of the LLIL the lifter emits, recorded in an OfflineILFunction,
+# main exports:
+# run()
+#
+# runs the IL of one instruction on a batch of CPU states
+# (LR35902Reference.State), every expression evaluating to a NumPy array with
+# a value per lane. Control flow inside the instruction (if/goto) is followed
+# with a mask of the lanes reaching each IL instruction; labels only ever
+# point forward within one instruction.
+#
+# flag writes are evaluated the way the core does it: for every flag of the
+# expression's flag write type (FLAG_WRITE_TYPES) gen_flag_il() is asked for
+# the flag's IL, its operands being the registers, constants and flags of
+# the expression or temp registers holding the other operands' values. A
+# flag without a lifter is an error here (FlagLifterMissing) rather than
+# Binja's guess from the flag's role.
+
+import numpy
+
+from .LR35902Decoder import FLAG_WRITE_TYPES
+from .OfflineIL import LowLevelILOperation, LowLevelILLabel, ILRegister, ILFlag, LLIL_TEMP
+from . import LR35902IL
+
+OP = LowLevelILOperation
+
+# LR35902Arch.flag_conditions_for_semantic_flag_group: (flag, negated)
+FLAG_GROUPS = {
+    'group_e': ('z', False),
+    'group_ne': ('z', True),
+    'group_ult': ('c', False),
+    'group_uge': ('c', True),
+}
+
+# intrinsic -> IME after it, LR35902IL.CONTROL_INTRINSICS
+INTRINSIC_IME = {
+    'enable_interrupts': True,
+    'disable_interrupts': False,
+}
+
+class FlagLifterMissing(Exception):
+    pass
+
+class Unimplemented(Exception):
+    pass
+
+def size_mask(size):
+    return (1 << (8 * size)) - 1 if size else 1
+
+def signed(value, size):
+    bits = 8 * size
+    return numpy.where(value & (1 << (bits - 1)), value - (1 << bits), value)
+
+def as_int(value):
+    return value.astype(numpy.int64) if value.dtype == bool else value
+
+#------------------------------------------------------------------------------
+# EXPRESSIONS
+#------------------------------------------------------------------------------
+
+class Interpreter(object):
+    """ the IL of il on state, lanes outside mask are left alone """
+
+    def __init__(self, il, state):
+        self.il = il
+        self.state = state
+        # temp register name -> value, operands of flag writes
+        self.temps = {}
+        # expression -> its value the last time it was evaluated
+        self.values = {}
+        # (expression, flag) -> flag IL expression
+        self.flag_exprs = {}
+
+    def reg(self, name):
+        if name in self.temps:
+            return self.temps[name]
+        return as_int(self.state.get(name))
+
+    def flag(self, name):
+        if name in self.temps:
+            return self.temps[name] != 0
+        return self.state.flags[name]
+
+    def eval(self, expr, mask):
+        il = self.il
+        op = il.ops[expr]
+        size = il.sizes[expr]
+        operands = il.operands[expr]
+        value = self.eval_op(expr, op, size, operands, mask)
+        self.values[expr] = value
+        if il.flags[expr] is not None:
+            self.write_flags(expr, op, size, operands, mask)
+        return value
+
+    def eval_op(self, expr, op, size, operands, mask):
+        state = self.state
+        ev = lambda i: as_int(self.eval(operands[i], mask))
+        lanes = len(state)
+
+        if op == OP.LLIL_CONST or op == OP.LLIL_CONST_PTR:
+            return numpy.full(lanes, operands[0] & size_mask(size), dtype=numpy.int64)
+        if op == OP.LLIL_REG:
+            return self.reg(str(operands[0])) & size_mask(size)
+        if op == OP.LLIL_FLAG:
+            return self.flag(str(operands[0]))
+        if op == OP.LLIL_FLAG_GROUP:
+            flag, negated = FLAG_GROUPS[operands[0]]
+            return ~self.flag(flag) if negated else self.flag(flag)
+        if op == OP.LLIL_LOAD:
+            return state.load(size, ev(0))
+        if op == OP.LLIL_POP:
+            value = state.load(size, state.regs['SP'])
+            state.set('SP', state.regs['SP'] + size, mask)
+            return value
+
+        if op in BINARY:
+            return BINARY[op](ev(0), ev(1), size) & size_mask(size)
+        if op in COMPARE:
+            a, b = ev(0), ev(1)
+            operand_size = self.il.sizes[operands[0]] or size
+            return COMPARE[op](a, b, operand_size)
+        if op == OP.LLIL_ADC:
+            return (ev(0) + ev(1) + ev(2)) & size_mask(size)
+        if op == OP.LLIL_SBB:
+            return (ev(0) - ev(1) - ev(2)) & size_mask(size)
+        if op == OP.LLIL_RLC:
+            a, count, carry = ev(0), ev(1), ev(2)
+            bits = 8 * size
+            return ((a << count) | (carry << (count - 1)) | (a >> (bits + 1 - count))) & size_mask(size)
+        if op == OP.LLIL_RRC:
+            a, count, carry = ev(0), ev(1), ev(2)
+            bits = 8 * size
+            return ((a >> count) | (carry << (bits - count)) | (a << (bits + 1 - count))) & size_mask(size)
+        if op == OP.LLIL_NOT:
+            a = self.eval(operands[0], mask)
+            return ~a if size == 0 or a.dtype == bool else ~a & size_mask(size)
+        if op == OP.LLIL_NEG:
+            return -ev(0) & size_mask(size)
+        if op == OP.LLIL_ZX or op == OP.LLIL_LOW_PART:
+            return ev(0) & size_mask(size)
+        if op == OP.LLIL_SX:
+            return signed(ev(0), self.il.sizes[operands[0]]) & size_mask(size)
+        if op == OP.LLIL_BOOL_TO_INT:
+            return ev(0)
+
+        raise Unimplemented(OP(op).name)
+
+    def write_flags(self, expr, op, size, operands, mask):
+        """ the flags written by expression expr, its operands having just
+            been evaluated """
+        il = self.il
+        args = []
+        for i, operand in enumerate(operands):
+            kind = il.ops[operand]
+            if kind == OP.LLIL_REG:
+                args.append(ILRegister(str(il.operands[operand][0])))
+            elif kind == OP.LLIL_CONST or kind == OP.LLIL_CONST_PTR:
+                args.append(il.operands[operand][0])
+            elif kind == OP.LLIL_FLAG:
+                args.append(ILFlag(str(il.operands[operand][0])))
+            else:
+                index = 4 * expr + i
+                name = 'temp%d' % index
+                self.temps[name] = as_int(self.values[operand])
+                args.append(ILRegister(name, LLIL_TEMP(index)))
+
+        values = {}
+        for flag in FLAG_WRITE_TYPES[il.flags[expr]]:
+            key = (expr, flag)
+            if key not in self.flag_exprs:
+                self.flag_exprs[key] = LR35902IL.gen_flag_il(LowLevelILOperation(op), size, il.flags[expr], flag, args, il)
+            flag_expr = self.flag_exprs[key]
+            if flag_expr is None:
+                raise FlagLifterMissing('%s %s' % (OP(op).name, flag))
+            values[flag] = self.eval(flag_expr, mask)
+        # all flags from the operands before any of them changes
+        for flag, value in values.items():
+            self.state.set_flag(flag, value, mask)
+
+    #--------------------------------------------------------------------------
+    # INSTRUCTIONS
+    #--------------------------------------------------------------------------
+
+    def run(self, next_addr):
+        """ runs every IL instruction, state.pc being where each lane went """
+        il = self.il
+        state = self.state
+        lanes = len(state)
+        count = len(il.instructions)
+        reach = [numpy.zeros(lanes, dtype=bool) for _ in range(count + 1)]
+        reach[0][:] = True
+        state.pc = numpy.full(lanes, next_addr, dtype=numpy.int64)
+
+        for i in range(count):
+            mask = reach[i]
+            if not mask.any():
+                continue
+            expr = il.instructions[i]
+            op = il.ops[expr]
+            operands = il.operands[expr]
+
+            if op == OP.LLIL_IF:
+                cond = self.eval(operands[0], mask) != 0
+                reach[self.target(operands[1])] |= mask & cond
+                reach[self.target(operands[2])] |= mask & ~cond
+                continue
+            if op == OP.LLIL_GOTO:
+                reach[self.target(operands[0])] |= mask
+                continue
+            if op in (OP.LLIL_JUMP, OP.LLIL_RET):
+                state.pc = numpy.where(mask, self.eval(operands[0], mask), state.pc)
+                continue
+            if op == OP.LLIL_CALL:
+                # the return address the hardware pushes, implicit in LLIL
+                target = self.eval(operands[0], mask)
+                sp = (state.regs['SP'] - 2) & 0xFFFF
+                state.store(2, sp, next_addr, mask)
+                state.set('SP', sp, mask)
+                state.pc = numpy.where(mask, target, state.pc)
+                continue
+            if op == OP.LLIL_NORET:
+                continue
+            self.execute(expr, op, operands, mask)
+            reach[i + 1] |= mask
+
+        return state
+
+    def target(self, label):
+        if not isinstance(label, LowLevelILLabel) or label.operand is None:
+            raise Unimplemented('branch to an unmarked label')
+        return label.operand
+
+    def execute(self, expr, op, operands, mask):
+        il = self.il
+        state = self.state
+        size = il.sizes[expr]
+        if op == OP.LLIL_SET_REG:
+            value = self.eval(operands[1], mask)
+            # flags written by the value's expression go along with it
+            if il.flags[expr] is not None:
+                raise Unimplemented('flags on set_reg')
+            state.set(str(operands[0]), as_int(value) & size_mask(size), mask)
+        elif op == OP.LLIL_SET_FLAG:
+            state.set_flag(str(operands[0]), self.eval(operands[1], mask) != 0, mask)
+        elif op == OP.LLIL_STORE:
+            addr = as_int(self.eval(operands[0], mask))
+            value = as_int(self.eval(operands[1], mask))
+            state.store(size, addr & 0xFFFF, value & size_mask(size), mask)
+        elif op == OP.LLIL_PUSH:
+            value = as_int(self.eval(operands[0], mask))
+            sp = (state.regs['SP'] - size) & 0xFFFF
+            state.store(size, sp, value & size_mask(size), mask)
+            state.set('SP', sp, mask)
+        elif op == OP.LLIL_INTRINSIC:
+            ime = INTRINSIC_IME.get(operands[1])
+            if ime is not None:
+                state.ime = numpy.where(mask, ime, state.ime)
+        elif op == OP.LLIL_NOP:
+            pass
+        elif op == OP.LLIL_UNIMPL or op == OP.LLIL_UNIMPL_MEM:
+            raise Unimplemented('unimplemented')
+        else:
+            # expression evaluated for its flags (cp, bit)
+            self.eval(expr, mask)
+
+def _rotate(left):
+    def rotate(a, count, size):
+        bits = 8 * size
+        if left:
+            return (a << count) | (a >> (bits - count))
+        return (a >> count) | (a << (bits - count))
+    return rotate
+
+BINARY = {
+    OP.LLIL_ADD: lambda a, b, size: a + b,
+    OP.LLIL_SUB: lambda a, b, size: a - b,
+    OP.LLIL_AND: lambda a, b, size: a & b,
+    OP.LLIL_OR: lambda a, b, size: a | b,
+    OP.LLIL_XOR: lambda a, b, size: a ^ b,
+    OP.LLIL_MUL: lambda a, b, size: a * b,
+    OP.LLIL_LSL: lambda a, b, size: a << b,
+    OP.LLIL_LSR: lambda a, b, size: a >> b,
+    OP.LLIL_ASR: lambda a, b, size: signed(a, size) >> b,
+    OP.LLIL_ROL: _rotate(True),
+    OP.LLIL_ROR: _rotate(False),
+}
+
+COMPARE = {
+    OP.LLIL_CMP_E: lambda a, b, size: a == b,
+    OP.LLIL_CMP_NE: lambda a, b, size: a != b,
+    OP.LLIL_CMP_ULT: lambda a, b, size: a < b,
+    OP.LLIL_CMP_ULE: lambda a, b, size: a <= b,
+    OP.LLIL_CMP_UGT: lambda a, b, size: a > b,
+    OP.LLIL_CMP_UGE: lambda a, b, size: a >= b,
+    OP.LLIL_CMP_SLT: lambda a, b, size: signed(a, size) < signed(b, size),
+    OP.LLIL_CMP_SLE: lambda a, b, size: signed(a, size) <= signed(b, size),
+    OP.LLIL_CMP_SGT: lambda a, b, size: signed(a, size) > signed(b, size),
+    OP.LLIL_CMP_SGE: lambda a, b, size: signed(a, size) >= signed(b, size),
+    OP.LLIL_TEST_BIT: lambda a, b, size: (a & b) != 0,
+}
+
+def run(il, state, next_addr):
+    """ runs il (one instruction, lifted to an OfflineILFunction) on state in
+        place, next_addr being the address after the instruction """
+    return Interpreter(il, state).run(next_addr)
@@ -1,7 +1,20 @@
-import binaryninja
+try:
+    import binaryninja
+except ImportError:
+    # imported by the headless tools (gbdis) outside of Binary Ninja, only the
+    # binja-free modules are usable then
+    binaryninja = None
 
-from .LR35902Arch import LR35902
-LR35902.register()
+if binaryninja is not None:
+    from . import LR35902Profile
+    LR35902Profile.register_settings()
 
-from .GameBoyROMView import GameBoyRomView
-GameBoyRomView.register()
+    from .LR35902Arch import LR35902
+    # wrapped only if asked for, the plain callbacks otherwise
+    if LR35902Profile.enabled():
+        LR35902Profile.instrument(LR35902)
+    LR35902.register()
+
+    from .GameBoyROMView import GameBoyRomView, register_commands
+    GameBoyRomView.register()
+    register_commands()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+# throughput of the Architecture callbacks, in instructions per second:
+#
+#   get_instruction_info()
+#   get_instruction_text()
+#   get_instruction_low_level_il()
+#
+# each over two instruction streams:
+#
+#   rom         a linear sweep of real ROMs (--rom, repeatable) or, without
+#               any, of synthetic code with a GameBoy-like opcode mix
+#   exhaustive  every 2-byte prefix followed by ABCDEF00, 65536 instructions
+#
+# record a baseline before upgrading the plugin, then check against it:
+#
+#   python bench_callbacks.py --save bench_baseline.json
+#   python bench_callbacks.py --baseline bench_baseline.json --threshold 0.1
+#
+# the latter exits non-zero if any measurement dropped by more than the
+# threshold. --check additionally compares the disassembly text with
+# lr35902dis like the old brute-force test did.
+
+import sys
+import json
+import time
+import random
+import argparse
+
+from lr35902dis.lr35902 import decode, disasm, DECODE_STATUS
+from struct import pack
+
+import binaryninja
+from binaryninja.enums import InstructionTextTokenType
+from binaryninja.lowlevelil import LowLevelILFunction
+
+ADDR = 0xDEAD
+BANK_SIZE = 0x4000
+
+# lift into a fresh function every so many instructions, so the IL being
+# appended to doesn't grow for the whole stream
+LIFT_BATCH = 256
+
+# instruction length by first byte, for building the synthetic stream
+INSTR_LEN = [decode(bytes([opc, 0, 0, 0]), 0).len for opc in range(256)]
+
+#------------------------------------------------------------------------------
+# STREAMS
+#------------------------------------------------------------------------------
+
+def linear_sweep(data, base):
+    """ (data, addr) of each instruction of a linear sweep of data """
+    result = []
+    offset = 0
+    while offset < len(data):
+        chunk = data[offset:offset+4]
+        decoded = decode(chunk, base + offset)
+        length = decoded.len if decoded.status == DECODE_STATUS.OK and decoded.len else 1
+        result.append((chunk, base + offset))
+        offset += length
+    return result
+
+# rough opcode frequencies of compiled GameBoy code: loads dominate, then
+# calls/jumps/returns, 8-bit alu and inc/dec
+SYNTHETIC_MIX = [
+    (0x3E, 8), (0x06, 3), (0x0E, 3), (0x11, 4), (0x21, 6), (0x01, 3),
+    (0x7E, 4), (0x77, 4), (0x2A, 4), (0x22, 3), (0x78, 2), (0x79, 2),
+    (0x47, 2), (0x4F, 2), (0x5F, 1), (0x57, 1), (0xEA, 4), (0xFA, 4),
+    (0xE0, 4), (0xF0, 4), (0xCD, 7), (0xC9, 4), (0xC3, 2), (0x18, 3),
+    (0x20, 4), (0x28, 3), (0x30, 1), (0x38, 1), (0xC0, 1), (0xC8, 1),
+    (0xE6, 2), (0xFE, 3), (0xA7, 2), (0xAF, 3), (0xB7, 1), (0x3C, 2),
+    (0x3D, 2), (0x05, 2), (0x0D, 2), (0x23, 3), (0x2B, 1), (0x13, 2),
+    (0x19, 1), (0x09, 1), (0xC5, 2), (0xC1, 2), (0xD5, 2), (0xD1, 2),
+    (0xE5, 2), (0xE1, 2), (0xF5, 1), (0xF1, 1), (0xE9, 1), (0xCB, 3),
+    (0x00, 1), (0xEF, 1), (0xF3, 1), (0xFB, 1), (0x76, 1),
+]
+
+def synthetic_rom(size, seed=0x4C52):
+    rng = random.Random(seed)
+    opcodes = [opc for opc, _ in SYNTHETIC_MIX]
+    weights = [weight for _, weight in SYNTHETIC_MIX]
+    out = bytearray()
+    while len(out) < size:
+        opc = rng.choices(opcodes, weights)[0]
+        out.append(opc)
+        out.extend(rng.getrandbits(8) for _ in range(INSTR_LEN[opc] - 1))
+    return bytes(out[:size])
+
+def rom_stream(paths):
+    if not paths:
+        return linear_sweep(synthetic_rom(4 * BANK_SIZE), 0)
+
+    result = []
+    for path in paths:
+        with open(path, 'rb') as fp:
+            rom = fp.read()
+        for bank in range((len(rom) + BANK_SIZE - 1) // BANK_SIZE):
+            base = 0 if bank == 0 else BANK_SIZE
+            result.extend(linear_sweep(rom[bank*BANK_SIZE:(bank+1)*BANK_SIZE], base))
+    return result
+
+def exhaustive_stream():
+    return [(pack('>H', i) + b'\xAB\xCD\xEF\x00', ADDR) for i in range(65536)]
+
+#------------------------------------------------------------------------------
+# MEASUREMENTS
+#------------------------------------------------------------------------------
+
+def run_info(arch, stream):
+    for data, addr in stream:
+        arch.get_instruction_info(data, addr)
+
+def run_text(arch, stream):
+    for data, addr in stream:
+        arch.get_instruction_text(data, addr)
+
+def run_lift(arch, stream):
+    for i in range(0, len(stream), LIFT_BATCH):
+        il = LowLevelILFunction(arch)
+        for data, addr in stream[i:i+LIFT_BATCH]:
+            il.set_current_address(addr)
+            arch.get_instruction_low_level_il(data, addr, il)
+
+CALLBACKS = [
+    ('get_instruction_info', run_info),
+    ('get_instruction_text', run_text),
+    ('get_instruction_low_level_il', run_lift),
+]
+
+def clear_caches():
+    """ each callback is measured on its own, without the decodes the
+        previous one left behind """
+    plugin = sys.modules.get(type(binaryninja.Architecture['LR35902']).__module__)
+    cache = getattr(plugin, 'DECODE_CACHE', None)
+    if cache is not None:
+        cache.clear()
+
+def measure(arch, stream, run, rounds):
+    """ best instructions per second out of rounds """
+    best = None
+    for _ in range(rounds):
+        clear_caches()
+        start = time.perf_counter()
+        run(arch, stream)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(stream) / best if best else 0
+
+def token_text(tok):
+    if tok.type == InstructionTextTokenType.DataSymbolToken:
+        return '0x%04x' % tok.value
+    return tok.text
+
+def check_text(arch, stream):
+    """ the old brute-force test: the text must match lr35902dis', with
+        IO register names put back as the addresses lr35902dis prints """
+    mismatches = 0
+    for data, addr in stream:
+        toks_and_len = arch.get_instruction_text(data, addr)
+        a = ''.join(token_text(tok) for tok in toks_and_len[0]) if toks_and_len and toks_and_len[1] else ''
+        b = disasm(data, addr)
+        if a != b:
+            print('%04X: %s -%s- -%s-' % (addr, data.hex().ljust(16), a, b))
+            mismatches += 1
+    return mismatches
+
+#------------------------------------------------------------------------------
+# MAIN
+#------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='LR35902 callback throughput')
+    parser.add_argument('--rom', action='append', default=[], help='ROM to sweep (repeatable)')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--save', metavar='JSON', help='write the results as a baseline')
+    parser.add_argument('--baseline', metavar='JSON', help='fail on regressions against this baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown as a fraction of the baseline (default 0.10)')
+    parser.add_argument('--check', action='store_true', help='also compare text with lr35902dis')
+    args = parser.parse_args()
+
+    arch = binaryninja.Architecture['LR35902']
+    streams = [
+        ('rom', rom_stream(args.rom)),
+        ('exhaustive', exhaustive_stream()),
+    ]
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    results = {}
+    regressions = []
+    for stream_name, stream in streams:
+        for callback_name, run in CALLBACKS:
+            key = '%s/%s' % (stream_name, callback_name)
+            ips = measure(arch, stream, run, args.rounds)
+            results[key] = ips
+
+            line = '%-42s %12.0f instr/s' % (key, ips)
+            if key in baseline:
+                change = (ips - baseline[key]) / baseline[key]
+                line += '  %+6.1f%% vs baseline' % (change * 100)
+                if change < -args.threshold:
+                    line += '  REGRESSION'
+                    regressions.append(key)
+            print(line)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+    failed = bool(regressions)
+    if args.check:
+        mismatches = sum(check_text(arch, stream) for _, stream in streams)
+        print('%d text mismatches against lr35902dis' % mismatches)
+        failed = failed or mismatches > 0
+
+    if regressions:
+        print('regressed beyond %.0f%%: %s' % (args.threshold * 100, ', '.join(regressions)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# instructions per second of GameBoyEmulator, on a ROM doing what boot code
+# does (clearing and copying memory, checksumming, calling helpers) or on
+# the ROMs given:
+#
+#   python -m LR35902.bench_emulator
+#   python -m LR35902.bench_emulator --cycles 50000000 game.gb
+
+import sys
+import time
+import argparse
+
+from .GameBoyEmulator import Emulator, TraceStop, CPU_HZ
+from .GameBoyROM import START_ADDR
+
+ENTRY = 0x150
+
+PROGRAM = bytes([
+    0x31, 0xFE, 0xFF,       # ld sp,0xfffe
+    # clear WRAM
+    0x21, 0x00, 0xC0,       # ld hl,0xc000
+    0x01, 0x00, 0x20,       # ld bc,0x2000
+    0xAF,                   # xor a           clear:
+    0x22,                   # ld (hl+),a
+    0x0B,                   # dec bc
+    0x78,                   # ld a,b
+    0xB1,                   # or c
+    0x20, 0xF9,             # jr nz,clear
+    # copy ROM0 to it
+    0x21, 0x00, 0x00,       # ld hl,0x0000
+    0x11, 0x00, 0xC0,       # ld de,0xc000
+    0x01, 0x00, 0x10,       # ld bc,0x1000
+    0x2A,                   # ld a,(hl+)      copy:
+    0x12,                   # ld (de),a
+    0x13,                   # inc de
+    0x0B,                   # dec bc
+    0x78,                   # ld a,b
+    0xB1,                   # or c
+    0x20, 0xF8,             # jr nz,copy
+    # checksum it through a helper
+    0x21, 0x00, 0xC0,       # ld hl,0xc000
+    0x06, 0x00,             # ld b,0
+    0xCD, 0x00, 0x02,       # call sum        sums:
+    0x05,                   # dec b
+    0x20, 0xFA,             # jr nz,sums
+    0xC3, 0x50, 0x01,       # jp ENTRY
+])
+
+SUM = 0x200
+SUM_PROGRAM = bytes([
+    0xE5,                   # push hl
+    0xAF,                   # xor a
+    0x0E, 0x10,             # ld c,16
+    0x86,                   # add a,(hl)      loop:
+    0xCE, 0x00,             # adc a,0
+    0xCB, 0x27,             # sla a
+    0x23,                   # inc hl
+    0x0D,                   # dec c
+    0x20, 0xF8,             # jr nz,loop
+    0xFE, 0x80,             # cp 0x80
+    0x30, 0x01,             # jr nc,done
+    0x3C,                   # inc a
+    0xE1,                   # pop hl          done:
+    0xC9,                   # ret
+])
+
+def bench_rom():
+    rom = bytearray(0x8000)
+    rom[START_ADDR:START_ADDR + 4] = b'\x00\xc3' + bytes([ENTRY & 0xFF, ENTRY >> 8])
+    rom[ENTRY:ENTRY + len(PROGRAM)] = PROGRAM
+    rom[SUM:SUM + len(SUM_PROGRAM)] = SUM_PROGRAM
+    return bytes(rom)
+
+def bench(rom, cycles):
+    emulator = Emulator(rom)
+    start = time.perf_counter()
+    stopped = None
+    try:
+        emulator.run(cycles)
+    except TraceStop as e:
+        stopped = str(e)
+    return emulator, time.perf_counter() - start, stopped
+
+def main():
+    parser = argparse.ArgumentParser(description='GameBoyEmulator instructions per second')
+    parser.add_argument('--cycles', type=int, default=10 * CPU_HZ)
+    parser.add_argument('roms', nargs='*')
+    args = parser.parse_args()
+
+    roms = [(path, open(path, 'rb').read()) for path in args.roms] or [('boot loops', bench_rom())]
+    for name, rom in roms:
+        emulator, elapsed, stopped = bench(rom, args.cycles)
+        print('%s: %d instructions, %.2fs of GameBoy time in %.2fs, %.2f M instructions/s%s' % (
+            name, emulator.instructions, emulator.cycles / CPU_HZ, elapsed,
+            emulator.instructions / elapsed / 1e6, ' (%s)' % stopped if stopped else ''))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# micro-benchmark of per-instruction lift latency through
+# LR35902.get_instruction_low_level_il(), over every base and CB-prefixed
+# opcode
+#
+# run it on the old tree with --save, then on the new one with --compare to
+# see the before/after per opcode:
+#
+#   python bench_lift.py --save before.json
+#   python bench_lift.py --compare before.json
+
+import sys
+import json
+import time
+import argparse
+
+from lr35902dis.lr35902 import decode, decoded2str, DECODE_STATUS
+
+import binaryninja
+from binaryninja.lowlevelil import LowLevelILFunction
+
+ADDR = 0xDEAD
+OPERAND_BYTES = b'\x34\x12\x00'
+
+def opcode_encodings():
+    for opc in range(256):
+        yield opc, bytes([opc]) + OPERAND_BYTES
+    for opc in range(256):
+        yield 0x100 | opc, bytes([0xCB, opc]) + OPERAND_BYTES
+
+def bench(arch, rounds):
+    results = {}
+    for opcode, data in opcode_encodings():
+        decoded = decode(data, ADDR)
+        if decoded.status != DECODE_STATUS.OK:
+            continue
+
+        # a fresh function every round keeps the IL from growing unboundedly
+        il = LowLevelILFunction(arch)
+        arch.get_instruction_low_level_il(data, ADDR, il)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            il = LowLevelILFunction(arch)
+            arch.get_instruction_low_level_il(data, ADDR, il)
+        elapsed = time.perf_counter() - start
+
+        # subtract the cost of creating the function object itself
+        start = time.perf_counter()
+        for _ in range(rounds):
+            il = LowLevelILFunction(arch)
+        elapsed -= time.perf_counter() - start
+
+        results['%03x' % opcode] = {
+            'text': decoded2str(decoded),
+            'usec': max(elapsed, 0) / rounds * 1e6,
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='per-opcode LLIL lift latency')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--save', metavar='JSON', help='write results to this file')
+    parser.add_argument('--compare', metavar='JSON', help='compare against saved results')
+    args = parser.parse_args()
+
+    arch = binaryninja.Architecture['LR35902']
+    results = bench(arch, args.rounds)
+
+    before = None
+    if args.compare:
+        with open(args.compare) as fp:
+            before = json.load(fp)
+
+    total_before = total_after = 0.0
+    for opcode, entry in sorted(results.items()):
+        line = '%s %-16s %8.2fus' % (opcode, entry['text'], entry['usec'])
+        if before and opcode in before:
+            old = before[opcode]['usec']
+            total_before += old
+            total_after += entry['usec']
+            line += ' (before %8.2fus, %+6.1f%%)' % (old, (entry['usec'] - old) / old * 100 if old else 0)
+        print(line)
+
+    mean = sum(e['usec'] for e in results.values()) / len(results)
+    print('mean lift latency: %.2fus over %d opcodes' % (mean, len(results)))
+    if before:
+        print('total: before %.1fus, after %.1fus (%.2fx)' % (
+            total_before, total_after, total_before / total_after if total_after else 0))
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
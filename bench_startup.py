@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# import cost of the plugin at Binary Ninja startup, each run in a fresh
+# interpreter with binaryninja already imported so only the plugin's own
+# share is measured:
+#
+#   python bench_startup.py
+#   python bench_startup.py --runs 20 --modules
+#
+# run with the python Binary Ninja uses (binaryninja has to be importable,
+# e.g. through its scripts/install_api.py). --modules adds the slowest
+# modules according to python -X importtime and lists the modules that
+# should only load later (lifter, hardware documentation, numpy) if they
+# were imported anyway.
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.basename(PLUGIN_DIR)
+
+# loaded on first use, not at startup
+DEFERRED = ('LR35902IL', 'hardware_documentation', 'numpy')
+
+CHILD = '''
+import sys, json, time
+import binaryninja
+before = set(sys.modules)
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(set(sys.modules) - before)}))
+''' % PLUGIN
+
+def run_child(importtime=False):
+    """ (result, stderr) of importing the plugin in a fresh interpreter """
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    cmd += ['-c', CHILD]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(PLUGIN_DIR), env.get('PYTHONPATH')]))
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit('importing %s failed' % PLUGIN)
+    return json.loads(proc.stdout.splitlines()[-1]), proc.stderr
+
+def slowest_modules(importtime_output, count):
+    """ (self us, module) of the slowest plugin-imported modules """
+    result = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        result.append((int(self_us), name.strip()))
+    return sorted(result, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description='plugin import cost at startup')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--modules', action='store_true', help='break the cost down by module')
+    args = parser.parse_args()
+
+    # the first run warms the bytecode caches
+    run_child()
+    results = [run_child()[0] for _ in range(args.runs)]
+    times = [r['elapsed'] * 1000 for r in results]
+    print('import %s: median %.1fms, min %.1fms, max %.1fms over %d runs' % (
+        PLUGIN, statistics.median(times), min(times), max(times), args.runs))
+
+    loaded = results[0]['modules']
+    print('%d modules loaded' % len(loaded))
+    eager = [name for name in loaded if name.split('.')[-1] in DEFERRED or name.split('.')[0] in DEFERRED]
+    if eager:
+        print('loaded at startup but meant to be deferred: %s' % ', '.join(eager))
+
+    if args.modules:
+        _, importtime = run_child(importtime=True)
+        # everything binaryninja imported is printed before the plugin
+        plugin_part = importtime[importtime.find('| binaryninja\n') + 1:]
+        for self_us, name in slowest_modules(plugin_part, 15):
+            print('%8.1fms  %s' % (self_us / 1000, name))
+
+    return 1 if eager else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
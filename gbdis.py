@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# headless GameBoy ROM disassembler, streams a linear sweep of every bank as
+# text or JSON lines using the plugin's decoder and disassembly text:
+#
+#   python -m LR35902.gbdis game.gbc > game.asm
+#   python -m LR35902.gbdis --json --bank 0 --bank 0x1f game.gbc
+#
+# (run from the Binary Ninja plugins directory, Binary Ninja itself isn't
+# needed). The ROM is memory-mapped and only ever read an instruction at a
+# time, so memory use doesn't grow with its size. The inline arguments and
+# jump tables following rst's to the ROM's helpers (LR35902Flow) come out as
+# data instead of instructions.
+
+import os
+import sys
+import json
+import mmap
+import time
+import argparse
+
+from lr35902dis.lr35902 import DECODE_STATUS
+
+from .GameBoyROM import BANK_SIZE, bank_base, bank_count
+from .LR35902Decoder import RESTART_VECTORS, decode_fast, opcode_index
+from .LR35902Flow import NO_RST_CONVENTIONS, read_jump_table, rst_conventions
+from .LR35902Text import instruction_tokens
+
+MAX_INSTR_LENGTH = 4
+
+def sweep_bank(rom, bank, rst=NO_RST_CONVENTIONS):
+    """ yields (offset, addr, data, decoded) for a linear sweep of a bank,
+        decoded is None for bytes that aren't a (complete) instruction and
+        for the data after rst's according to the RstConventions rst """
+    start = bank * BANK_SIZE
+    end = min(start + BANK_SIZE, len(rom))
+    base = bank_base(bank)
+    # the bank's bytes for read_jump_table(), only if there are tables
+    bank_data = rom[start:end] if rst.jump_tables else None
+
+    offset = start
+    while offset < end:
+        addr = base + offset - start
+        data = rom[offset:min(offset + MAX_INSTR_LENGTH, end)]
+        decoded = decode_fast(data, addr)
+        if decoded.status != DECODE_STATUS.OK or decoded.len == 0:
+            yield offset, addr, data[:1], None
+            offset += 1
+            continue
+
+        yield offset, addr, data[:decoded.len], decoded
+        offset += decoded.len
+
+        vector = RESTART_VECTORS[data[0]]
+        if vector in rst.inline_args and offset < end:
+            count = min(rst.inline_args[vector], end - offset)
+            yield offset, addr + decoded.len, rom[offset:offset + count], None
+            offset += count
+        elif vector in rst.jump_tables:
+            table = addr + decoded.len
+            for _ in read_jump_table(bank_data, base, table):
+                yield offset, base + offset - start, rom[offset:offset + 2], None
+                offset += 2
+
+def instruction_text(data, decoded):
+    if decoded is None:
+        return 'db ' + ', '.join('0x%02x' % b for b in data)
+    return ''.join(text for _, text, _ in instruction_tokens(decoded, opcode_index(data)))
+
+def format_text(bank, offset, addr, data, text):
+    return '%02X:%04X  %-8s  %s\n' % (bank, addr, data.hex(), text)
+
+def format_json(bank, offset, addr, data, text):
+    return json.dumps({
+        'bank': bank, 'offset': offset, 'addr': addr,
+        'bytes': data.hex(), 'text': text,
+    }) + '\n'
+
+def parse_int(s):
+    return int(s, 0)
+
+def disassemble(path, out, banks=None, fmt=format_text):
+    """ disassembles the ROM at path into the file-like out, returns the
+        number of instructions written """
+    count = 0
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as rom:
+            rst = rst_conventions(rom[:BANK_SIZE])
+            for bank in banks if banks is not None else range(bank_count(len(rom), None)):
+                if bank >= bank_count(len(rom), None):
+                    raise ValueError('%s has no bank 0x%x' % (path, bank))
+                for offset, addr, data, decoded in sweep_bank(rom, bank, rst):
+                    out.write(fmt(bank, offset, addr, data, instruction_text(data, decoded)))
+                    count += 1
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gbdis', description='disassemble GameBoy ROMs without Binary Ninja')
+    parser.add_argument('roms', nargs='+', metavar='ROM', help='.gb/.gbc file')
+    parser.add_argument('--json', action='store_true', help='write JSON lines instead of text')
+    parser.add_argument('--bank', type=parse_int, action='append', dest='banks',
+                        help='only disassemble this bank (repeatable)')
+    parser.add_argument('-o', '--output', help='write to this file instead of stdout')
+    parser.add_argument('-q', '--quiet', action='store_true', help='don\'t report throughput')
+    args = parser.parse_args(argv)
+
+    fmt = format_json if args.json else format_text
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for path in args.roms:
+            start = time.perf_counter()
+            count = disassemble(path, out, args.banks, fmt)
+            elapsed = time.perf_counter() - start
+            if not args.quiet:
+                sys.stderr.write('%s: %d instructions in %.2fs (%d instructions/s)\n' % (
+                    path, count, elapsed, count / elapsed if elapsed else 0))
+    except BrokenPipeError:
+        # piped into head & co., keep the interpreter from complaining on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# headless triage of GameBoy ROM collections, checks and summarizes every
+# ROM under the given files/directories in a pool of worker processes:
+#
+#   python -m LR35902.gbtriage dumps/ -o triage.jsonl
+#   python -m LR35902.gbtriage --jobs 8 dumps/ more/ -o triage.sqlite
+#
+# one record per ROM: Nintendo logo, header (cartridge type from
+# CARTRIDGE_TYPES), header and global checksums and some quick statistics
+# (entropy, padding, code reachable in bank 0). The report is JSON lines, or
+# SQLite if its name ends in .db/.sqlite; it doubles as the checkpoint, a
+# rerun with the same report skips the ROMs already in it. A ROM changed
+# since (size or mtime) is triaged again and its new record replaces the old
+# one: the SQLite row, the JSON lines record appended last (read_records()).
+
+import os
+import sys
+import json
+import math
+import mmap
+import time
+import hashlib
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from . import GameBoyROM
+from .GameBoyROM import BANK_SIZE, START_ADDR, INTERRUPT_HANDLERS, load_numpy, find_files
+from .GameBoyCFG import analyze_bank
+
+# records written between checkpoints
+CHECKPOINT_EVERY = 256
+
+# 256-byte blocks of 0x00 or 0xFF are counted as padding
+FILL_BLOCK = 0x100
+
+# report columns, in order
+FIELDS = (
+    'path', 'size', 'mtime', 'sha1', 'error',
+    'logo_ok', 'title', 'color', 'sgb', 'cart_type', 'cart_name',
+    'rom_banks', 'banks', 'ram_banks', 'header_checksum_ok', 'global_checksum_ok',
+    'entropy', 'fill_bytes', 'functions', 'code_bytes',
+)
+
+#------------------------------------------------------------------------------
+# STATISTICS
+#------------------------------------------------------------------------------
+
+def byte_histogram(rom):
+    numpy = load_numpy()
+    if numpy is not None:
+        return numpy.bincount(numpy.frombuffer(rom, dtype=numpy.uint8), minlength=256).tolist()
+    histogram = [0] * 256
+    for value in bytes(rom):
+        histogram[value] += 1
+    return histogram
+
+def entropy(histogram):
+    """ bits per byte """
+    total = sum(histogram)
+    return -sum(count / total * math.log2(count / total) for count in histogram if count)
+
+def fill_bytes(rom):
+    """ bytes in FILL_BLOCK aligned blocks of nothing but 0x00 or 0xFF """
+    blocks = len(rom) // FILL_BLOCK
+    numpy = load_numpy()
+    if numpy is not None:
+        data = numpy.frombuffer(rom, dtype=numpy.uint8, count=blocks * FILL_BLOCK).reshape(blocks, FILL_BLOCK)
+        uniform = (data == data[:, :1]).all(axis=1) & ((data[:, 0] == 0x00) | (data[:, 0] == 0xFF))
+        return int(uniform.sum()) * FILL_BLOCK
+    zeros, ones = bytes(FILL_BLOCK), b'\xFF' * FILL_BLOCK
+    return sum(FILL_BLOCK for i in range(0, blocks * FILL_BLOCK, FILL_BLOCK) if rom[i:i+FILL_BLOCK] in (zeros, ones))
+
+#------------------------------------------------------------------------------
+# TRIAGE (runs in the workers)
+#------------------------------------------------------------------------------
+
+def triage(path):
+    """ report record of the ROM at path """
+    stat = os.stat(path)
+    record = dict.fromkeys(FIELDS)
+    record.update(path=path, size=stat.st_size, mtime=stat.st_mtime_ns)
+    try:
+        with open(path, 'rb') as fp:
+            if stat.st_size < GameBoyROM.HDR_OFFSET + GameBoyROM.HDR_SIZE:
+                record['error'] = 'too short for a header'
+                return record
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as rom:
+                triage_rom(path, rom, record)
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    return record
+
+def triage_rom(path, rom, record):
+    hdr = GameBoyROM.parse_header(rom[GameBoyROM.HDR_OFFSET:GameBoyROM.HDR_OFFSET+GameBoyROM.HDR_SIZE])
+    banks = GameBoyROM.bank_count(len(rom), hdr.rom_banks)
+    cart = GameBoyROM.CARTRIDGE_TYPES.get(hdr.cart_type)
+
+    record.update(
+        sha1=hashlib.sha1(rom).hexdigest(),
+        logo_ok=rom[GameBoyROM.ROM_SIG_OFFSET:GameBoyROM.ROM_SIG_OFFSET+GameBoyROM.ROM_SIG_LEN] == GameBoyROM.ROM_SIG,
+        title=hdr.rom_title.rstrip(b'\0').decode('ascii', 'replace'),
+        color=hdr.color,
+        sgb=hdr.gb_type == 0x03,
+        cart_type=hdr.cart_type,
+        cart_name=cart[0] if cart else None,
+        rom_banks=GameBoyROM.ROM_SIZE_BANKS.get(hdr.rom_banks),
+        banks=banks,
+        ram_banks=hdr.ram_banks,
+        header_checksum_ok=GameBoyROM.header_checksum(rom) == hdr.complement_check,
+        global_checksum_ok=GameBoyROM.global_checksum(rom) == hdr.checksum,
+        entropy=round(entropy(byte_histogram(rom)), 4),
+        fill_bytes=fill_bytes(rom),
+    )
+
+    # code reachable from the entry point and the interrupt vectors
+    seeds = [(START_ADDR, False)] + [(addr, False) for _, addr in INTERRUPT_HANDLERS]
+    _, functions, _ = analyze_bank(path, 0, banks, seeds, frozenset())
+    covered = set()
+    for func in functions.values():
+        for start, end in func['blocks']:
+            covered.update(range(start, min(end, BANK_SIZE)))
+    record.update(functions=len(functions), code_bytes=len(covered))
+
+#------------------------------------------------------------------------------
+# REPORTS
+#------------------------------------------------------------------------------
+
+def record_key(record):
+    """ a ROM is done if the report has it at the same size and mtime """
+    return record['path'], record['size'], record['mtime']
+
+def read_records(path):
+    """ {path: record} of a JSON lines report, the last record of a path
+        being the one to trust, and whether there were others (older
+        records of changed ROMs, a torn last line) """
+    records = {}
+    stale = False
+    with open(path) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # torn last line of an interrupted run
+                stale = True
+                continue
+            stale |= record['path'] in records
+            records[record['path']] = record
+    return records, stale
+
+class JsonLinesReport(object):
+    def __init__(self, path):
+        records = {}
+        if os.path.exists(path):
+            records, stale = read_records(path)
+            if stale:
+                # compacted to one record per path before appending
+                with open(path + '.tmp', 'w') as fp:
+                    for record in records.values():
+                        fp.write(json.dumps(record) + '\n')
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(path + '.tmp', path)
+        self.done = set(record_key(record) for record in records.values())
+        self.fp = open(path, 'a')
+
+    def write(self, record):
+        self.fp.write(json.dumps(record) + '\n')
+
+    def checkpoint(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.fp.close()
+
+class SqliteReport(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS roms (%s, PRIMARY KEY (path))' % ', '.join(FIELDS))
+        self.done = set(self.db.execute('SELECT path, size, mtime FROM roms'))
+
+    def write(self, record):
+        self.db.execute('INSERT OR REPLACE INTO roms VALUES (%s)' % ', '.join('?' * len(FIELDS)),
+                        [record[field] for field in FIELDS])
+
+    def checkpoint(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def open_report(path):
+    if path.endswith(('.db', '.sqlite')):
+        return SqliteReport(path)
+    return JsonLinesReport(path)
+
+#------------------------------------------------------------------------------
+# MAIN
+#------------------------------------------------------------------------------
+
+def pending_roms(paths, done):
+    # the files given and the ROMs found under the directories given
+    for path in find_files(paths, keep_given=True):
+        stat = os.stat(path)
+        if (path, stat.st_size, stat.st_mtime_ns) not in done:
+            yield path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gbtriage', description='triage collections of GameBoy ROMs')
+    parser.add_argument('paths', nargs='+', metavar='PATH', help='.gb/.gbc file or directory to search')
+    parser.add_argument('-o', '--output', required=True, help='JSON lines report, SQLite if it ends in .db/.sqlite')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='don\'t report progress')
+    args = parser.parse_args(argv)
+
+    report = open_report(args.output)
+    paths = list(pending_roms(args.paths, report.done))
+    if not args.quiet and report.done:
+        sys.stderr.write('%s: resuming, %d ROMs already done\n' % (args.output, len(report.done)))
+
+    jobs = args.jobs or os.cpu_count() or 1
+    # big enough chunks to keep the pool's overhead per ROM down, small
+    # enough to spread the work evenly
+    chunksize = max(1, min(64, len(paths) // (4 * jobs)))
+
+    start = time.perf_counter()
+    count = errors = 0
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        for record in pool.map(triage, paths, chunksize=chunksize):
+            report.write(record)
+            count += 1
+            errors += record['error'] is not None
+            if count % CHECKPOINT_EVERY == 0:
+                report.checkpoint()
+                if not args.quiet:
+                    sys.stderr.write('%d/%d ROMs\n' % (count, len(paths)))
+    finally:
+        # interrupted: what was written so far is the checkpoint
+        pool.shutdown(wait=False, cancel_futures=True)
+        report.close()
+
+    elapsed = time.perf_counter() - start
+    if not args.quiet:
+        sys.stderr.write('%d ROMs (%d errors) in %.2fs (%d ROMs/min)\n' % (
+            count, errors, elapsed, count / elapsed * 60 if elapsed else 0))
+
+if __name__ == '__main__':
+    sys.exit(main())
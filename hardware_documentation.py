@@ -3,9 +3,6 @@
 # and https://gbdev.io/pandocs/About.html for other registers
 
 IO_REGISTERS = {
-        0xFF02: ("SC", "Serial I/O Control (R/W), write 1 => Bit 7 starts a transfer and a 0 can be read on completion, Bit 0 switches internal and external clocks"),
-        0xFF04: ("DIV", "This register is incremented at rate of 16384Hz (~16779Hz on SGB). Writing any value to this register resets it to 00h."),
-        0xFF05: ("TIMA", "Timer Counter R/W"),
         0xFF00: ("P1", "Joypad Input", "Joypad Input"), # Page 35
         0xFF01: ("SB", "Serial Bus (Data R/W)", "Data is read from and written to the serial bus via this register"),
         0xFF02: ("SC", "Serial I/O Control (R/W)", "Setting Bit 7 starts a transfer, reading a 0 from it means the transfer completed. Bit 0 switches between using the internal() and external clocks"),
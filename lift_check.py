@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# differential check of the lifter against a reference CPU model, every
+# encoding is lifted headless (OfflineIL), its IL run by OfflineILInterpreter
+# and compared to LR35902Reference.step() on batches of random CPU states:
+#
+#   python -m LR35902.lift_check
+#   python -m LR35902.lift_check --lanes 4096 --variants 8 --seed 1
+#   python -m LR35902.lift_check 88 8e 9e cb11
+#
+# registers, SP, the z/n/h/c flags, IME, memory and where execution goes on
+# are compared after each instruction (F itself isn't, the lifter keeps the
+# flags apart from it). Every mismatch is printed with the fields that
+# differ and one counterexample. Needs NumPy.
+#
+# exits non-zero if any encoding mismatches.
+
+import sys
+import argparse
+
+import numpy
+
+from lr35902dis.lr35902 import decode, decoded2str, DECODE_STATUS
+
+from .LR35902Decoder import OPCODE_COUNT, opcode_bytes
+from .LR35902Reference import REGS8, FLAGS, random_states, step
+from .OfflineIL import OfflineILFunction, lift
+from .OfflineILInterpreter import run, FlagLifterMissing, Unimplemented
+
+ADDR = 0x1000
+
+# random lanes per batch, immediate operands per encoding
+LANES = 1024
+VARIANTS = 4
+
+COMPARED_REGS = tuple(reg for reg in REGS8 if reg != 'F') + ('SP',)
+
+def encodings(opcode, variants, rng):
+    """ the instruction bytes of opcode with random immediates, None if it
+        doesn't decode """
+    if opcode == 0xCB:
+        return None
+    prefix = opcode_bytes(opcode)[:2 if opcode & 0x100 else 1]
+    found = []
+    for _ in range(variants):
+        data = prefix + bytes(rng.integers(0, 0x100, 2, dtype=numpy.uint8))
+        decoded = decode(data, ADDR)
+        if decoded.status != DECODE_STATUS.OK or decoded.len == 0:
+            return None
+        found.append(data[:decoded.len])
+    return found
+
+def differences(expected, actual):
+    """ [(field, lanes mismatching)] between two states """
+    fields = []
+    for reg in COMPARED_REGS:
+        fields.append((reg, expected.regs[reg] != actual.regs[reg]))
+    for flag in FLAGS:
+        fields.append((flag, expected.flags[flag] != actual.flags[flag]))
+    fields.append(('ime', expected.ime != actual.ime))
+    fields.append(('pc', expected.pc != actual.pc))
+    fields.append(('mem', (expected.mem != actual.mem).any(axis=1)))
+    return [(field, lanes) for field, lanes in fields if lanes.any()]
+
+def describe(state, lane):
+    regs = ' '.join('%s=%02x' % (reg, state.regs[reg][lane]) for reg in REGS8 if reg != 'F')
+    flags = ''.join(flag if state.flags[flag][lane] else '-' for flag in FLAGS)
+    return '%s SP=%04x %s ime=%d pc=%04x' % (regs, state.regs['SP'][lane], flags, state.ime[lane], state.pc[lane])
+
+def check(data, lanes, rng):
+    """ None if the lifted IL of data matches the reference, else the text
+        of the mismatch """
+    il = OfflineILFunction()
+    length = lift(data, ADDR, il)
+
+    before = random_states(lanes, rng)
+    expected = before.copy()
+    step(data, ADDR, expected)
+    actual = before.copy()
+    try:
+        run(il, actual, ADDR + length)
+    except FlagLifterMissing as e:
+        return 'no flag lifter for %s' % e
+    except Unimplemented as e:
+        return 'IL not interpretable: %s' % e
+
+    found = differences(expected, actual)
+    if not found:
+        return None
+    lane = int(numpy.flatnonzero(found[0][1])[0])
+    lines = ['%s in %d of %d lanes' % (', '.join(field for field, _ in found), max(int(mask.sum()) for _, mask in found), lanes)]
+    lines.append('    before    %s' % describe(before, lane))
+    lines.append('    reference %s' % describe(expected, lane))
+    lines.append('    lifted    %s' % describe(actual, lane))
+    return '\n'.join(lines)
+
+def parse_opcode(text):
+    value = int(text, 16)
+    # cbXX is the CB-prefixed XX
+    return 0x100 | (value & 0xFF) if len(text) > 2 else value
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='lift_check', description='check the lifted IL of every LR35902 encoding against a reference model')
+    parser.add_argument('opcodes', nargs='*', help='opcodes to check (hex, cbXX for CB-prefixed), default all')
+    parser.add_argument('--lanes', type=int, default=LANES, help='random CPU states per batch')
+    parser.add_argument('--variants', type=int, default=VARIANTS, help='random immediates per encoding')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    args = parser.parse_args(argv)
+
+    rng = numpy.random.default_rng(args.seed)
+    opcodes = [parse_opcode(text) for text in args.opcodes] or range(OPCODE_COUNT)
+
+    checked = failed = 0
+    for opcode in opcodes:
+        found = encodings(opcode, args.variants, rng)
+        if found is None:
+            continue
+        checked += 1
+        for data in found:
+            mismatch = check(data, args.lanes, rng)
+            if mismatch is not None:
+                failed += 1
+                print('%03X %-16s %s: %s' % (opcode, decoded2str(decode(data, ADDR)), data.hex(), mismatch))
+                break
+
+    print('LR35902 lift check: %d of %d encodings match the reference (%d lanes, %d variants)' % (
+        checked - failed, checked, args.lanes, args.variants))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# lifting coverage of the 512 encodings (base and CB-prefixed), lifted
+# headless through OfflineIL and printed as two 16x16 opcode matrices:
+#
+#   python -m LR35902.lift_coverage
+#   python -m LR35902.lift_coverage --list
+#
+#   .   lifted
+#   U   emits unimplemented
+#   W   reads or writes a register at the wrong width
+#   X   the lifter raised
+#   -   illegal opcode, doesn't decode
+#   >   CB prefix
+#
+# exits non-zero if any encoding is U, W or X.
+
+import sys
+import argparse
+import traceback
+
+from lr35902dis.lr35902 import decode, decoded2str, reg2str, DECODE_STATUS
+
+from .LR35902Decoder import OPCODE_COUNT, opcode_bytes
+from .OfflineIL import OfflineILFunction, LowLevelILOperation, lift
+from .LR35902IL import REG_TO_SIZE
+
+ADDR = 0x1000
+
+# operand bytes after the opcode, non-zero so immediates show up
+OPERAND_BYTES = b'\x34\x12\x00'
+
+REG_SIZE = dict((reg2str(reg), size) for reg, size in REG_TO_SIZE.items())
+
+LEGEND = '. lifted  U unimplemented  W register width  X lifter raised  - illegal  > CB prefix'
+
+def encoding(opcode):
+    if opcode & 0x100:
+        return opcode_bytes(opcode)[:2] + OPERAND_BYTES
+    return opcode_bytes(opcode)[:1] + OPERAND_BYTES
+
+def width_errors(il):
+    """ (register, size) of the reg/set_reg expressions of il not at the
+        register's width """
+    errors = []
+    for i, op in enumerate(il.ops):
+        if op in (LowLevelILOperation.LLIL_REG, LowLevelILOperation.LLIL_SET_REG):
+            name = il.operands[i][0]
+            if name in REG_SIZE and il.sizes[i] != REG_SIZE[name]:
+                errors.append((name, il.sizes[i]))
+    return errors
+
+def check(opcode):
+    """ (mark, text, detail) of an encoding """
+    if opcode == 0xCB:
+        return '>', 'PREFIX CB', None
+    data = encoding(opcode)
+    decoded = decode(data, ADDR)
+    if decoded.status != DECODE_STATUS.OK or decoded.len == 0:
+        return '-', None, None
+    text = decoded2str(decoded)
+
+    il = OfflineILFunction()
+    try:
+        lift(data, ADDR, il)
+    except Exception:
+        return 'X', text, traceback.format_exc().strip().splitlines()[-1]
+    if il.unimplemented_count():
+        return 'U', text, il.instruction_trees()
+    errors = width_errors(il)
+    if errors:
+        return 'W', text, ', '.join('%s at %d' % error for error in errors)
+    return '.', text, None
+
+def matrix(results, prefix):
+    lines = ['      ' + ' '.join('x%X' % low for low in range(16))]
+    for high in range(16):
+        marks = [results[prefix | high << 4 | low][0] for low in range(16)]
+        lines.append('%s%Xx  ' % ('CB ' if prefix else '   ', high) + ' '.join(' ' + mark for mark in marks))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='lift_coverage', description='LLIL coverage of every LR35902 encoding')
+    parser.add_argument('--list', action='store_true', help='list the failing encodings with the reason')
+    args = parser.parse_args(argv)
+
+    results = [check(opcode) for opcode in range(OPCODE_COUNT)]
+    failing = [(opcode, result) for opcode, result in enumerate(results) if result[0] in 'UWX']
+    legal = sum(1 for mark, _, _ in results if mark not in '->')
+
+    print('LR35902 lifting coverage: %d of %d encodings lifted' % (legal - len(failing), legal))
+    print('\n'.join(matrix(results, 0)))
+    print()
+    print('\n'.join(matrix(results, 0x100)))
+    print()
+    print(LEGEND)
+
+    if args.list:
+        for opcode, (mark, text, detail) in failing:
+            print('%03X %s %-16s %s' % (opcode, mark, text, detail))
+    return 1 if failing else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#
+# LR35902Flow.walk_blocks() on hand-assembled code, no Binary Ninja needed:
+#
+#   python -m pytest test_flow.py
+
+from .LR35902Flow import walk_blocks
+
+BASE = 0x150
+FATAL = 0x200
+
+def rom(code):
+    data = bytearray(0x100)
+    data[:len(code)] = code
+    data[FATAL - BASE] = 0x76               # fatal: halt
+    return bytes(data)
+
+def block_at(walk, addr):
+    return next(block for block in walk['blocks'] if block[0] == addr)
+
+def test_call_to_noreturn_ends_block():
+    data = rom(bytes([
+        0xCD, FATAL & 0xFF, FATAL >> 8,     # call fatal
+        0xC9,                               # ret
+    ]))
+    walk = walk_blocks(data, BASE, BASE, noreturn={FATAL})
+    assert walk['blocks'] == [(BASE, BASE + 3, ())]
+
+def test_conditional_call_to_noreturn_falls_through():
+    data = rom(bytes([
+        0xCC, FATAL & 0xFF, FATAL >> 8,     # call z,fatal
+        0x3C,                               # inc a
+        0xC9,                               # ret
+    ]))
+    walk = walk_blocks(data, BASE, BASE, noreturn={FATAL})
+    assert (BASE, FATAL) in walk['calls']
+    start, end, edges = block_at(walk, BASE)
+    assert end == BASE + 5
+    assert edges == (('FunctionReturn', None, False),)
+
+def test_rst_to_noreturn_ends_block():
+    data = rom(bytes([
+        0xFF,                               # rst 0x38
+        0xC9,                               # ret
+    ]))
+    walk = walk_blocks(data, BASE, BASE, noreturn={0x38})
+    assert walk['blocks'] == [(BASE, BASE + 1, ())]
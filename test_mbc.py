@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# GameBoyMBC bank switches on hand-assembled ROMs, no Binary Ninja needed:
+#
+#   python -m pytest test_mbc.py
+
+from .GameBoyROM import BANK_SIZE, CART_TYPE_OFFSET
+from .GameBoyMBC import is_bank_register, mbc_type, select_bank, sweep_bank_switches, Trampolines
+
+CODE = 0x150
+MBC2 = 0x05
+MBC5 = 0x19
+
+def rom(cart_type, code):
+    data = bytearray(4 * BANK_SIZE)
+    data[CART_TYPE_OFFSET] = cart_type
+    data[CODE:CODE+len(code)] = code
+    return bytes(data)
+
+def sweep(data):
+    return sweep_bank_switches(data, 0, Trampolines(data[:BANK_SIZE]), mbc_type(data))
+
+def test_mbc2_bank_register_by_address_bit_8():
+    assert is_bank_register(0x0100, 'MBC2')
+    assert is_bank_register(0x2100, 'MBC2')
+    assert not is_bank_register(0x2000, 'MBC2')
+    assert not is_bank_register(0x4100, 'MBC2')
+    assert select_bank('MBC2', 1, 0x0100, 3) == 3
+    assert select_bank('MBC2', 1, 0x0000, 3) == 1
+
+def test_mbc2_switch_below_0x2000():
+    data = rom(MBC2, bytes([
+        0x3E, 0x03,                         # ld a,3
+        0xEA, 0x00, 0x01,                   # ld (0x0100),a
+        0xCD, 0x00, 0x41,                   # call 0x4100
+    ]))
+    switches, far_calls = sweep(data)
+    assert switches == [(CODE + 2, 3)]
+    assert far_calls == [(CODE + 5, 3, 0x4100)]
+
+def test_mbc2_ram_enable_is_no_switch():
+    data = rom(MBC2, bytes([
+        0x3E, 0x0A,                         # ld a,0x0A
+        0xEA, 0x00, 0x00,                   # ld (0x0000),a
+        0xCD, 0x00, 0x41,                   # call 0x4100
+    ]))
+    assert sweep(data) == ([], [])
+
+def test_mbc5_switch():
+    data = rom(MBC5, bytes([
+        0x3E, 0x02,                         # ld a,2
+        0xEA, 0x00, 0x20,                   # ld (0x2000),a
+        0xCD, 0x00, 0x41,                   # call 0x4100
+    ]))
+    assert sweep(data) == ([(CODE + 2, 2)], [(CODE + 5, 2, 0x4100)])
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#
+# gbtriage's JSON lines report over a rerun, no Binary Ninja needed:
+#
+#   python -m pytest test_triage.py
+
+import json
+
+from .gbtriage import JsonLinesReport, read_records
+
+def record(path, mtime, title):
+    return {'path': path, 'size': 0x8000, 'mtime': mtime, 'title': title}
+
+def test_last_record_per_path_wins(tmp_path):
+    report_path = str(tmp_path / 'triage.jsonl')
+    with open(report_path, 'w') as fp:
+        for line in (record('a.gb', 1, 'OLD'), record('b.gb', 1, 'B'), record('a.gb', 2, 'NEW')):
+            fp.write(json.dumps(line) + '\n')
+        fp.write('{"path": "c.gb", "si')
+
+    records, stale = read_records(report_path)
+    assert stale
+    assert records['a.gb']['title'] == 'NEW'
+    assert sorted(records) == ['a.gb', 'b.gb']
+
+    report = JsonLinesReport(report_path)
+    report.close()
+    assert report.done == {('a.gb', 0x8000, 2), ('b.gb', 0x8000, 1)}
+    with open(report_path) as fp:
+        assert len(fp.readlines()) == 2
+    assert read_records(report_path) == (records, False)